@@ -0,0 +1,334 @@
+import os, sys, json, time, uuid, hmac, hashlib, random, shutil, argparse, platform, sqlite3, tempfile, threading, subprocess, contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Callable
+
+# Reproducible benchmarks of the control plane: runs the real app against a scratch database and fake git / docker binaries
+# Usage: python benchmark.py [--rows 10000,100000] [--output results.json] [--baseline previous.json]
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+COMMIT = "0123456789abcdef0123456789abcdef01234567"
+WEBHOOK_SECRET = "benchmark"
+
+FAKE_GIT = f'''#!/bin/sh
+# Stand-in for git: mirrors and fetches are no-ops, every revision resolves and worktrees get a minimal Dockerfile
+while [ "$1" = "--git-dir" ]; do shift 2; done
+case "$1" in
+  init) for last; do :; done; mkdir -p "$last" && touch "$last/HEAD" ;;
+  rev-parse) echo {COMMIT} ;;
+  worktree)
+    if [ "$2" = add ]; then
+      prev=""; for arg; do path="$prev"; prev="$arg"; done
+      mkdir -p "$path" && printf 'FROM scratch\\nEXPOSE 8080\\n' > "$path/Dockerfile"
+    elif [ "$2" = remove ]; then
+      for last; do :; done; rm -rf "$last"
+    fi ;;
+esac
+exit 0
+'''
+
+FAKE_DOCKER = '''#!/bin/sh
+# Stand-in for the docker CLI: no containers exist, every image has the same id and builds, pushes and runs succeed instantly
+case "$1" in
+  inspect) exit 1 ;;
+  image) [ "$2" = inspect ] && echo "sha256:0000000000000000000000000000000000000000000000000000000000000000" ;;
+  build) echo "#1 [1/1] FROM scratch"; echo "#1 DONE 0.0s" ;;
+esac
+exit 0
+'''
+
+SECTIONS = ["webhook", "jobs", "vault", "contention", "pipeline"]
+
+def percentile(samples: List[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def summarize(name: str, samples: List[float], elapsed: Optional[float] = None, **extra) -> Dict:
+    # samples are seconds, everything reported is milliseconds except the throughput
+    result = {
+        "name": name,
+        "count": len(samples),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3) if samples else 0.0,
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3) if samples else 0.0,
+        "ops_per_sec": round(len(samples) / elapsed, 1) if elapsed else None,
+    }
+    result.update(extra)
+    print(f"{name:<40} p50 {result['p50_ms']:>9.3f} ms  p95 {result['p95_ms']:>9.3f} ms  {result['ops_per_sec'] or '':>8} ops/s", file=sys.stderr)
+    return result
+
+def measure(name: str, operation: Callable[[int], None], iterations: int, concurrency: int = 1, **extra) -> Dict:
+    samples, lock = [], threading.Lock()
+
+    def timed(i: int):
+        started = time.perf_counter()
+        operation(i)
+        elapsed = time.perf_counter() - started
+        with lock:
+            samples.append(elapsed)
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(timed, range(iterations)))
+    else:
+        for i in range(iterations):
+            timed(i)
+    return summarize(name, samples, time.perf_counter() - started, concurrency=concurrency, **extra)
+
+def expect(response, status: int = 200):
+    if response.status_code != status:
+        raise RuntimeError(f"{response.request.method} {response.request.url} returned {response.status_code}: {response.text[:200]}")
+    return response
+
+def prepare_workdir(workdir: str):
+    # Fake binaries go first on PATH, the app finds them the same way it finds the real ones
+    bin_dir = os.path.join(workdir, "bin")
+    os.makedirs(bin_dir)
+    for name, script in (("git", FAKE_GIT), ("docker", FAKE_DOCKER)):
+        path = os.path.join(bin_dir, name)
+        with open(path, "w") as f:
+            f.write(script)
+        os.chmod(path, 0o755)
+
+    from cryptography.fernet import Fernet
+    with open(os.path.join(workdir, "key.key"), "wb") as f:
+        f.write(Fernet.generate_key())
+    os.makedirs(os.path.join(workdir, "database"))
+
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+    os.environ["DB_FILE"] = os.path.join(workdir, "database", "builds.db")
+    os.environ["DOCKER_BACKEND"] = "cli"
+    os.environ["TRACING_EXPORTER"] = "none"
+    os.environ["GITHUB_WEBHOOK_SECRET"] = WEBHOOK_SECRET
+    # Nothing listens on the discard port, registry lookups fail right away
+    os.environ.setdefault("REGISTRY_URL", "127.0.0.1:9")
+    os.environ.setdefault("BUILD_DEBOUNCE_SECONDS", "0")
+    os.chdir(workdir)
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "-C", APP_DIR, "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# sections
+
+def bench_webhook(client, args) -> List[Dict]:
+    def push(i: int):
+        body = json.dumps({"repository": {"name": f"bench-{i % args.projects:02d}", "owner": {"login": "bench"}},
+                           "after": uuid.uuid4().hex + uuid.uuid4().hex[:8]}).encode()
+        signature = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+        expect(client.post("/webhook", content=body, headers={"X-GitHub-Event": "push", "X-GitHub-Delivery": uuid.uuid4().hex,
+                                                              "X-Hub-Signature-256": f"sha256={signature}"}), 202)
+
+    return [measure("webhook_ingest", push, args.requests),
+            measure("webhook_ingest_concurrent", push, args.requests, concurrency=args.concurrency)]
+
+def seed_jobs(pool, target: int, projects: int, log_lines: int):
+    # Jobs are appended in time order, the way a long-running instance accumulates them
+    with pool.get_connection() as conn:
+        existing = conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+        names = [f"bench-{i:02d}" for i in range(projects)]
+        conn.executemany("INSERT OR IGNORE INTO projects (name) VALUES (?)", [(name,) for name in names])
+        ids = dict(conn.execute("SELECT name, id FROM projects"))
+        rng = random.Random(existing)
+        now = time.time()
+        rows = []
+        for i in range(existing, target):
+            created_at = now - (target - i) * 60
+            status = "failure" if rng.random() < 0.1 else "success"
+            rows.append((uuid.uuid4().hex, ids[names[i % projects]], status, f"{i:040x}", rng.choice(("webhook", "manual")), "seed.log",
+                         created_at, created_at + 30, 30.0))
+        conn.executemany('''INSERT INTO jobs (id, project_id, status, commit_hash, trigger, log_file, created_at, finished_at, duration)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+
+    for name in names:
+        path = os.path.join("build_logs", name, "seed.log")
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.writelines(f"#{i} [{i % 12 + 1}/12] RUN step {i} of the seeded build\n" for i in range(log_lines))
+
+def bench_jobs(client, pool, args) -> List[Dict]:
+    results = []
+    for rows in args.rows:
+        seed_jobs(pool, rows, args.projects, args.log_lines)
+        with pool.get_connection() as conn:
+            conn.execute("ANALYZE")
+        cursor = expect(client.get("/jobs", params={"summary": "true"})).headers.get("X-Next-Cursor")
+        project = lambda i: f"bench-{i % args.projects:02d}"
+
+        results += [
+            measure(f"jobs_first_page@{rows}", lambda i: expect(client.get("/jobs", params={"summary": "true"})), args.requests, rows=rows),
+            measure(f"jobs_next_page@{rows}", lambda i: expect(client.get("/jobs", params={"summary": "true", "cursor": cursor})),
+                    args.requests, rows=rows),
+            measure(f"jobs_by_project@{rows}", lambda i: expect(client.get("/jobs", params={"summary": "true", "project": project(i)})),
+                    args.requests, rows=rows),
+            measure(f"jobs_by_status@{rows}", lambda i: expect(client.get("/jobs", params={"summary": "true", "status": "failure"})),
+                    args.requests, rows=rows),
+            measure(f"jobs_full@{rows}", lambda i: expect(client.get("/jobs", params={"limit": 10})), max(args.requests // 10, 1), rows=rows),
+            measure(f"status@{rows}", lambda i: expect(client.get(f"/status/{project(i)}")), args.requests, rows=rows),
+            measure(f"status_tail@{rows}", lambda i: expect(client.get(f"/status/{project(i)}", params={"tail": 100})), args.requests, rows=rows),
+        ]
+    return results
+
+def bench_vault(client, args) -> List[Dict]:
+    import main, vault
+    variables = {f"VARIABLE_{i}": "x" * 32 for i in range(args.variables)}
+
+    def cold_read(i: int):
+        vault.invalidate()
+        vault.get_current("bench-vault", main.connection_pool, main.crypt)
+
+    results = [measure("vault_write", lambda i: expect(client.post("/vault/bench-vault", json=variables)), args.requests, variables=args.variables)]
+    results.append(measure("vault_read_cold", cold_read, args.requests, variables=args.variables))
+    results.append(measure("vault_read_cached", lambda i: vault.get_current("bench-vault", main.connection_pool, main.crypt),
+                           args.requests, variables=args.variables))
+    return results
+
+def bench_contention(args) -> List[Dict]:
+    # Finished builds being logged from every worker at once while pollers keep reading /jobs
+    import log
+    writes, reads, lock = [], [], threading.Lock()
+    stop = threading.Event()
+
+    def writer(worker: int):
+        for i in range(args.requests):
+            started = time.perf_counter()
+            log.log_build_request(f"bench-{(worker + i) % args.projects:02d}", "success", True, f"{i:040x}")
+            with lock:
+                writes.append(time.perf_counter() - started)
+
+    def reader():
+        while not stop.is_set():
+            started = time.perf_counter()
+            log.get_jobs(limit=50, summary=True)
+            with lock:
+                reads.append(time.perf_counter() - started)
+
+    readers = [threading.Thread(target=reader) for _ in range(max(args.concurrency // 2, 1))]
+    for thread in readers:
+        thread.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(writer, range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    return [summarize("contention_log_build_request", writes, elapsed, concurrency=args.concurrency),
+            summarize("contention_get_jobs", reads, elapsed, concurrency=len(readers))]
+
+def bench_pipeline(args) -> List[Dict]:
+    # Whole deploys through the queue and the build workers, git and docker are the fakes so this is the pipeline's own overhead
+    import main
+    pool, scheduler = main.connection_pool, main.scheduler
+    with pool.get_connection() as conn:
+        conn.execute("DELETE FROM build_queue")
+
+    job_ids = [scheduler.enqueue("bench", f"deploy-{i:03d}", webhook=True, commit_hash=COMMIT) for i in range(args.deploys)]
+    started = time.perf_counter()
+    scheduler.start()
+    try:
+        while True:
+            with pool.get_connection() as conn:
+                pending = conn.execute("SELECT COUNT(*) FROM build_queue WHERE status IN ('queued', 'running')").fetchone()[0]
+            if not pending:
+                break
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started
+    finally:
+        scheduler.stop()
+
+    with pool.get_connection() as conn:
+        rows = conn.execute(f"SELECT started_at, finished_at FROM build_queue WHERE id IN ({', '.join('?' * len(job_ids))})", job_ids).fetchall()
+        failed = conn.execute(f"SELECT COUNT(*) FROM jobs WHERE status != 'success' AND id IN ({', '.join('?' * len(job_ids))})", job_ids).fetchone()[0]
+    return [summarize("pipeline_deploy", [finished - started_at for started_at, finished in rows if started_at and finished], elapsed,
+                      workers=scheduler.workers, failed=failed)]
+
+def compare(results: List[Dict], baseline_path: str, tolerance: float) -> List[str]:
+    with open(baseline_path) as f:
+        baseline = {result["name"]: result for result in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["name"])
+        if previous and previous["p95_ms"] > 0 and result["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{result['name']}: p95 {previous['p95_ms']} ms -> {result['p95_ms']} ms")
+    return regressions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the prod-auto control plane against fake git and docker")
+    parser.add_argument("--rows", default="10000,100000", help="job table sizes to measure /jobs and /status at, comma separated")
+    parser.add_argument("--requests", type=int, default=200, help="iterations per measurement")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads for the concurrent measurements")
+    parser.add_argument("--projects", type=int, default=50, help="distinct projects the load is spread over")
+    parser.add_argument("--variables", type=int, default=20, help="secrets per vault write")
+    parser.add_argument("--deploys", type=int, default=20, help="deploys pushed through the pipeline")
+    parser.add_argument("--log-lines", type=int, default=5000, help="lines in each seeded build log")
+    parser.add_argument("--only", help=f"comma separated subset of {','.join(SECTIONS)}")
+    parser.add_argument("--output", help="write the JSON results here instead of stdout")
+    parser.add_argument("--baseline", help="earlier results to compare against, exits 1 when a p95 got worse than --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p95 slowdown against the baseline (0.25 = 25%%)")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args(argv)
+    args.rows = sorted(int(rows) for rows in args.rows.split(","))
+    sections = args.only.split(",") if args.only else SECTIONS
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+    meta = {"revision": git_revision(), "started_at": time.time(), "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(), "cpus": os.cpu_count(), "arguments": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")}}
+
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="prod-auto-bench-")
+    prepare_workdir(workdir)
+    sys.path.insert(0, APP_DIR)
+    results = []
+    try:
+        # The app reports through print, keep stdout for the results
+        with contextlib.redirect_stdout(sys.stderr):
+            from fastapi.testclient import TestClient
+            import main as app_main, helpers
+            helpers.first_time_database_init(app_main.connection_pool)
+            client = TestClient(app_main.app)
+
+            if "webhook" in sections:
+                results += bench_webhook(client, args)
+            if "jobs" in sections:
+                results += bench_jobs(client, app_main.connection_pool, args)
+            if "vault" in sections:
+                results += bench_vault(client, args)
+            if "contention" in sections:
+                results += bench_contention(args)
+            if "pipeline" in sections:
+                results += bench_pipeline(args)
+            app_main.connection_pool.flush()
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"Scratch directory kept at {workdir}", file=sys.stderr)
+
+    meta["duration"] = round(time.time() - meta["started_at"], 3)
+    report = json.dumps({"meta": meta, "results": results}, indent=2)
+    if output:
+        with open(output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression {regression}", file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+import os, re, hashlib, fnmatch
+from typing import Optional, List, Dict
+
+# Opt-in fast builds: BuildKit, layer cache shared through the registry and no build at all for an unchanged context
+FAST_BUILDS = os.getenv("FAST_BUILDS", "false").lower() in ("1", "true", "yes")
+# inline: cache metadata rides along in the pushed image | registry: full cache (mode=max) in its own tag, needs a buildx builder
+BUILD_CACHE_MODE = os.getenv("BUILD_CACHE_MODE", "inline").lower()
+BUILD_CACHE_REGISTRY = os.getenv("BUILD_CACHE_REGISTRY", os.getenv("REGISTRY_URL", "registry:5000"))
+
+HASH_CHUNK = 1024 * 1024
+STEP = re.compile(rb"^#(\d+) \[[^\]]*\d+/\d+\]")
+CACHED = re.compile(rb"^#(\d+) CACHED")
+
+def read_dockerignore(context_dir: str) -> List[str]:
+    path = os.path.join(context_dir, ".dockerignore")
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [line.strip().rstrip("/") for line in f if line.strip() and not line.startswith("#")]
+
+def ignored(path: str, patterns: List[str]) -> bool:
+    # Same rules as docker: patterns are matched in order, the last match wins and "!" re-includes
+    result = False
+    for pattern in patterns:
+        negate = pattern.startswith("!")
+        pattern = pattern.lstrip("!").lstrip("/")
+        if fnmatch.fnmatch(path, pattern) or fnmatch.fnmatch(path, f"{pattern}/*") or pattern == "**":
+            result = not negate
+    return result
+
+def context_hash(context_dir: str) -> str:
+    # Paths, modes and contents of everything docker would send as the build context, in a stable order
+    patterns = read_dockerignore(context_dir)
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(context_dir):
+        rel_root = os.path.relpath(root, context_dir)
+        dirs[:] = sorted(d for d in dirs if d != ".git" and not ignored(os.path.normpath(os.path.join(rel_root, d)), patterns))
+        for name in sorted(files):
+            rel_path = os.path.normpath(os.path.join(rel_root, name))
+            if name == ".git" or ignored(rel_path, patterns):
+                continue
+            path = os.path.join(root, name)
+            digest.update(rel_path.encode() + b"\0" + oct(os.lstat(path).st_mode).encode() + b"\0")
+            if os.path.islink(path):
+                digest.update(os.readlink(path).encode())
+            else:
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                        digest.update(chunk)
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+def build_env(env: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    # docker-compose 1.x only hands builds to the docker CLI (and so BuildKit) when asked to
+    return {**(env or os.environ), "DOCKER_BUILDKIT": "1", "COMPOSE_DOCKER_CLI_BUILD": "1", "BUILDKIT_PROGRESS": "plain"}
+
+def cache_ref(image: str) -> str:
+    return f"{BUILD_CACHE_REGISTRY}/{image}"
+
+def build_command(image: str, context_dir: str) -> List[str]:
+    if BUILD_CACHE_MODE == "registry":
+        ref = cache_ref(f"{image}:buildcache")
+        return ["docker", "buildx", "build", "--load", "--progress=plain",
+                "--cache-from", f"type=registry,ref={ref}", "--cache-to", f"type=registry,ref={ref},mode=max",
+                "-t", image, context_dir]
+    # The image pushed after the last build carries its own cache metadata
+    return ["docker", "build", "--progress=plain", "--build-arg", "BUILDKIT_INLINE_CACHE=1",
+            "--cache-from", cache_ref(f"{image}:latest"), "-t", image, context_dir]
+
+def compose_build_args() -> List[str]:
+    # docker-compose 1.x has no --cache-from, inline cache is all it can write
+    return ["--build-arg", "BUILDKIT_INLINE_CACHE=1"]
+
+def cache_result(log_file_path: str, offset: int) -> Optional[str]:
+    # Reads BuildKit's plain progress output written since offset: hit when every step came from cache, miss when none did
+    steps, cached = set(), set()
+    try:
+        with open(log_file_path, "rb") as log:
+            log.seek(offset)
+            for line in log:
+                if STEP.match(line):
+                    steps.add(line.strip())
+                elif CACHED.match(line):
+                    cached.add(line.strip())
+    except OSError as e:
+        print(f"Error reading build output of {log_file_path}: {e}")
+        return None
+
+    if not steps:
+        return None
+    if not cached:
+        return "miss"
+    return "hit" if len(cached) >= len(steps) else "partial"
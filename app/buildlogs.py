@@ -0,0 +1,109 @@
+import os, gzip, time, shutil, struct
+from collections import deque
+from typing import Optional, List
+
+LOGS_DIR = "build_logs"
+# Finished job logs are gzipped unless this is turned off
+LOG_COMPRESS = os.getenv("LOG_COMPRESS", "true").lower() in ("1", "true", "yes")
+# Retention per project: job logs older than this many days are deleted (0 keeps them forever)
+LOG_RETENTION_DAYS = float(os.getenv("LOG_RETENTION_DAYS", "30"))
+# ...only the newest N job logs are kept (0 = no limit)
+LOG_RETENTION_COUNT = int(os.getenv("LOG_RETENTION_COUNT", "50"))
+# ...and the oldest ones go once the project's logs take more than this many bytes on disk (0 = no limit)
+LOG_RETENTION_BYTES = int(os.getenv("LOG_RETENTION_BYTES", str(512 * 1024 * 1024)))
+
+def job_log_name(job_id: str) -> str:
+    return f"{job_id}.log"
+
+def resolve_log_path(project_name: str, log_file: str, logs_dir: Optional[str] = None) -> Optional[str]:
+    # A finished log may have been compressed since the job row was written
+    path = os.path.join(logs_dir or LOGS_DIR, project_name, log_file)
+    for candidate in (path, f"{path}.gz"):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def open_log(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+def log_size(path: str) -> int:
+    if not path.endswith(".gz"):
+        return os.path.getsize(path)
+    # gzip keeps the uncompressed size (mod 4GiB) in its last four bytes
+    with open(path, "rb") as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack("<I", f.read(4))[0]
+
+def tail_offset(path: str, start: int, end: int, lines: int) -> int:
+    # Compressed logs can't be read backwards, stream them once and remember where the last lines began
+    starts = deque([start], maxlen=lines)
+    position = start
+    with open_log(path) as log:
+        log.seek(start)
+        for line in log:
+            position += len(line)
+            if position >= end:
+                break
+            starts.append(position)
+    return starts[0]
+
+def compress_log(path: str) -> str:
+    if path.endswith(".gz") or not os.path.exists(path):
+        return path
+
+    compressed = f"{path}.gz"
+    with open(path, "rb") as source, gzip.open(f"{compressed}.tmp", "wb") as target:
+        shutil.copyfileobj(source, target)
+    os.replace(f"{compressed}.tmp", compressed)
+    os.remove(path)
+    return compressed
+
+def apply_retention(project_name: str, keep: Optional[List[str]] = None, logs_dir: Optional[str] = None, dry_run: bool = False) -> List[str]:
+    # Oldest first: drop whatever is past the age limit, then trim to the count and size budgets
+    project_dir = os.path.join(logs_dir or LOGS_DIR, project_name)
+    if not os.path.isdir(project_dir):
+        return []
+
+    keep = set(keep or [])
+    logs = []
+    for entry in os.scandir(project_dir):
+        if entry.is_file() and (entry.name.endswith(".log") or entry.name.endswith(".log.gz")) and entry.name not in keep:
+            stat = entry.stat()
+            logs.append((stat.st_mtime, stat.st_size, entry.path))
+    logs.sort()
+
+    now = time.time()
+    total = sum(size for _, size, _ in logs) + sum(
+        os.path.getsize(os.path.join(project_dir, name)) for name in keep if os.path.exists(os.path.join(project_dir, name)))
+    removed = []
+    for index, (mtime, size, path) in enumerate(logs):
+        remaining = len(logs) - index + len(keep)
+        expired = LOG_RETENTION_DAYS and now - mtime > LOG_RETENTION_DAYS * 86400
+        too_many = LOG_RETENTION_COUNT and remaining > LOG_RETENTION_COUNT
+        too_big = LOG_RETENTION_BYTES and total > LOG_RETENTION_BYTES
+        if not (expired or too_many or too_big):
+            break
+        if dry_run:
+            removed.append(path)
+            total -= size
+            continue
+        try:
+            os.remove(path)
+            removed.append(path)
+            total -= size
+        except OSError as e:
+            print(f"Error removing old build log {path}: {e}")
+    return removed
+
+def finish_job_log(project_name: str, job_id: str, logs_dir: Optional[str] = None):
+    # Called once a job is done writing: compress its log and enforce the project's retention policy
+    path = os.path.join(logs_dir or LOGS_DIR, project_name, job_log_name(job_id))
+    name = os.path.basename(path)
+    try:
+        if LOG_COMPRESS and os.path.exists(path):
+            name = os.path.basename(compress_log(path))
+        apply_retention(project_name, keep=[name], logs_dir=logs_dir)
+    except OSError as e:
+        print(f"Error finishing build log of {job_id}: {e}")
@@ -0,0 +1,153 @@
+import json, time, threading
+from typing import Optional, List, Dict
+import docker_api
+from docker_api import DockerError
+
+# Events that don't change anything we keep track of
+IGNORED_ACTIONS = ("exec_", "attach", "detach", "resize", "top", "export", "commit", "copy", "archive-path", "extract-to-dir")
+RESYNC_BACKOFF = 5
+
+class ContainerStateCache:
+    # In-memory view of every container on the host, keyed by project and kept fresh by `docker events`
+
+    def __init__(self, client: Optional[docker_api.DockerClient] = None):
+        self.client = client
+        self._containers: Dict[str, Dict] = {}
+        self._projects: Dict[str, set] = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._stream = None
+
+    @property
+    def docker(self) -> docker_api.DockerClient:
+        return self.client or docker_api.client
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="container-events", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._ready.clear()
+        if self._stream is not None:
+            self._stream.close()
+        self._thread = None
+
+    def prime(self):
+        containers = self.docker.containers(all=True)
+        details = self.docker.inspect_containers([container["Id"] for container in containers])
+
+        with self._lock:
+            self._containers = {}
+            self._projects = {}
+            for detail in details:
+                self._store(detail)
+        self._ready.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if not self.docker.available():
+                self._stopping.wait(RESYNC_BACKOFF)
+                continue
+            try:
+                # Subscribe from the moment we start priming so nothing happening in between is lost
+                since = int(time.time())
+                self.prime()
+                self._watch(since)
+            except (DockerError, OSError, ValueError) as e:
+                print(f"Container state cache lost the docker events stream, resyncing: {e}")
+            # Until the next prime the cache may be stale, let callers fall back to asking docker
+            self._ready.clear()
+            self._stopping.wait(RESYNC_BACKOFF)
+
+    def _watch(self, since: int):
+        self._stream = self.docker.request("GET", "/events", params={"since": since, "filters": {"type": ["container"]}},
+                                           stream=True, timeout=None)
+        for line in self._stream.lines():
+            if self._stopping.is_set():
+                break
+            if line.strip():
+                self.apply_event(json.loads(line))
+
+    def apply_event(self, event: Dict):
+        action = event.get("Action") or event.get("status") or ""
+        container_id = event.get("id") or event.get("Actor", {}).get("ID")
+        if not container_id or action.startswith(IGNORED_ACTIONS):
+            return
+
+        if action == "destroy":
+            with self._lock:
+                self._discard(container_id)
+            return
+
+        try:
+            detail = self.docker.inspect_container(container_id)
+        except DockerError as e:
+            if e.status != 404:
+                raise
+            with self._lock:
+                self._discard(container_id)
+            return
+
+        with self._lock:
+            self._discard(container_id)
+            self._store(detail)
+
+    def _store(self, detail: Dict):
+        state = detail.get("State", {})
+        labels = detail.get("Config", {}).get("Labels") or {}
+        name = detail.get("Name", "").lstrip("/")
+        project = labels.get("com.docker.compose.project") or name.lower()
+
+        self._containers[detail["Id"]] = {
+            "container_name": name,
+            "status": state.get("Status"),
+            "started_at": state.get("StartedAt"),
+            "finished_at": state.get("FinishedAt"),
+            "project": project,
+        }
+        self._projects.setdefault(project, set()).add(detail["Id"])
+
+    def _discard(self, container_id: str):
+        # Events carry full ids, inspect may have been asked with a name, match both
+        for key, container in list(self._containers.items()):
+            if key == container_id or key.startswith(container_id) or container["container_name"] == container_id:
+                del self._containers[key]
+                ids = self._projects.get(container["project"])
+                if ids is not None:
+                    ids.discard(key)
+                    if not ids:
+                        del self._projects[container["project"]]
+
+    def project_containers(self, project_name: str) -> List[Dict[str, str]]:
+        key = project_name.lower()
+        with self._lock:
+            ids = set(self._projects.get(key, ()))
+            # Same matching rules as before: any container whose name mentions the project
+            ids.update(container_id for container_id, container in self._containers.items() if key in container["container_name"])
+            containers = [self._containers[container_id] for container_id in ids]
+
+        return sorted(({k: v for k, v in container.items() if k != "project"} for container in containers),
+                      key=lambda container: container["container_name"])
+
+    def container_names(self, container_name: str) -> List[str]:
+        # Exact name first, otherwise every running container whose name contains it (like `docker ps`)
+        with self._lock:
+            names = [container["container_name"] for container in self._containers.values()]
+            running = [container["container_name"] for container in self._containers.values() if container["status"] == "running"]
+
+        if container_name in names:
+            return [container_name]
+        return sorted(name for name in running if container_name in name)
+
+# Shared cache, started from the app lifespan
+cache = ContainerStateCache()
@@ -0,0 +1,149 @@
+import os, re, time, heapq, queue, threading, subprocess, http.client
+from typing import Optional, List, Dict, Iterator, Tuple, Callable
+from docker_api import DockerError, DockerUnavailable
+import dockr
+
+# Followed lines waiting for a slow client, once full the container readers stop reading until it catches up
+CONTAINER_LOG_BUFFER = int(os.getenv("CONTAINER_LOG_BUFFER", "1000"))
+# An empty chunk is sent after this long without output (seconds), a client that went away is noticed and its streams closed
+CONTAINER_LOG_HEARTBEAT = float(os.getenv("CONTAINER_LOG_HEARTBEAT", "5"))
+
+DURATION = re.compile(r"^(\d+(?:\.\d+)?)([smhd])$")
+SECONDS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+DONE = object()
+
+def parse_time(value: Optional[str]) -> Optional[float]:
+    # Unix timestamps, or durations back from now ("30s", "10m", "2h", "1d") like `docker logs --since`
+    if value is None or not value.strip():
+        return None
+    match = DURATION.match(value.strip())
+    if match:
+        return time.time() - float(match.group(1)) * SECONDS[match.group(2)]
+    return float(value)
+
+def _timestamp(value: Optional[float]) -> Optional[str]:
+    return f"{value:.9f}" if value is not None else None
+
+def project_containers(project_name: str) -> List[Dict]:
+    # Every container of the project, compose services included, or the one container with exactly that name
+    names = [container["container_name"] for container in dockr.get_project_containers(project_name)]
+    if not names:
+        try:
+            names = dockr.resolve_container_names(project_name) if dockr.docker.available() else []
+        except DockerError as e:
+            print(f"Error resolving containers of {project_name}: {e}")
+    if not names:
+        return []
+
+    if dockr.docker.available():
+        try:
+            # TTY containers send raw output, the others stdout/stderr frames
+            return [{"name": name, "tty": bool(detail.get("Config", {}).get("Tty"))}
+                    for name, detail in zip(names, dockr.docker.inspect_containers(names))]
+        except DockerError as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+    return [{"name": name, "tty": False, "cli": True} for name in names]
+
+def _open(container: Dict, tail: str, since: Optional[float], until: Optional[float], follow: bool) -> Tuple[Iterator[bytes], Callable[[], None]]:
+    # One container's log lines, each starting with docker's fixed width RFC3339 timestamp, and how to stop reading them
+    if not container.get("cli"):
+        try:
+            stream = dockr.docker.container_logs(container["name"], timestamps=True, tail=tail, since=_timestamp(since),
+                                                 until=_timestamp(until), follow=follow, stream=True)
+            return stream.log_lines(container["tty"]), stream.close
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+
+    command = ["docker", "logs", "--timestamps", "--tail", tail]
+    if since is not None:
+        command += ["--since", _timestamp(since)]
+    if until is not None:
+        command += ["--until", _timestamp(until)]
+    if follow:
+        command.append("--follow")
+    process = subprocess.Popen(command + [container["name"]], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def close():
+        process.kill()
+        process.wait()
+        process.stdout.close()
+    return iter(process.stdout.readline, b""), close
+
+def _labelled(name: str, lines: Iterator[bytes]) -> Iterator[Tuple[bytes, bytes]]:
+    prefix = f"{name} | ".encode()
+    try:
+        for line in lines:
+            yield line.split(b" ", 1)[0], prefix + (line if line.endswith(b"\n") else line + b"\n")
+    except (DockerError, OSError, ValueError, http.client.HTTPException) as e:
+        print(f"Error reading logs of {name}: {e}")
+
+def _merge(sources: List[Tuple[str, Iterator[bytes]]]) -> Iterator[bytes]:
+    # Each container's lines are already in order, a lazy k-way merge on the timestamp keeps the whole stream in order
+    for _, line in heapq.merge(*(_labelled(name, lines) for name, lines in sources), key=lambda item: item[0]):
+        yield line
+
+def _fan_in(sources: List[Tuple[str, Iterator[bytes]]], stopping: threading.Event) -> Iterator[bytes]:
+    # Followed containers never end, every one gets a reader and their lines are passed on as they arrive
+    lines = queue.Queue(CONTAINER_LOG_BUFFER)
+
+    def put(item):
+        while not stopping.is_set():
+            try:
+                lines.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read(name: str, source: Iterator[bytes]):
+        for item in _labelled(name, source):
+            if not put(item[1]):
+                return
+        put(DONE)
+
+    for name, source in sources:
+        threading.Thread(target=read, args=(name, source), name=f"logs-{name}", daemon=True).start()
+
+    remaining = len(sources)
+    while remaining:
+        try:
+            item = lines.get(timeout=CONTAINER_LOG_HEARTBEAT)
+        except queue.Empty:
+            yield b""
+            continue
+        if item is DONE:
+            remaining -= 1
+        else:
+            yield item
+
+def stream_logs(containers: List[Dict], tail: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+                follow: bool = False) -> Iterator[bytes]:
+    # Lines are read from docker only as fast as the client takes them, nothing is collected in memory first
+    tail = tail or dockr.CONTAINER_LOG_TAIL
+    stopping = threading.Event()
+    closers = []
+
+    def open_all(tail, since, until, follow):
+        sources = []
+        for container in containers:
+            try:
+                lines, close = _open(container, tail, since, until, follow)
+            except DockerError as e:
+                # e.g. removed since it was listed, the other containers are still worth reading
+                print(f"Error reading logs of {container['name']}: {e}")
+                continue
+            closers.append(close)
+            sources.append((container["name"], lines))
+        return sources
+
+    try:
+        follow = follow and (until is None or until > time.time())
+        # The history up to now comes out in timestamp order, what is logged after that as it arrives
+        cutoff = time.time() if follow else until
+        yield from _merge(open_all(tail, since, cutoff, False))
+        if follow:
+            yield from _fan_in(open_all("all", cutoff, until, True), stopping)
+    finally:
+        stopping.set()
+        for close in closers:
+            close()
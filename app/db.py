@@ -1,43 +1,168 @@
-import sqlite3
+import sqlite3, os, time
 from sqlite3 import Connection, Cursor
-from typing import Optional, List, Dict
-from queue import Queue
-from threading import Lock
+from typing import Optional, List, Dict, Tuple
+from queue import Queue, Empty
+from threading import Lock, Event, Thread
+import metrics
+
+# Tuning knobs, the defaults favour many concurrent readers with a few writers
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()  # OFF | NORMAL | FULL | EXTRA
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))  # milliseconds
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-16000"))  # negative means KiB, so 16MB per connection
+SQLITE_WRITE_BATCH_SIZE = int(os.getenv("SQLITE_WRITE_BATCH_SIZE", "200"))
+# How long the writer waits for more statements before committing a batch (seconds)
+SQLITE_WRITE_BATCH_DELAY = float(os.getenv("SQLITE_WRITE_BATCH_DELAY", "0"))
 
 # Connection pool
 class ConnectionPool:
 
-    DB_FILE = "database/builds.db"
+    DB_FILE = os.getenv("DB_FILE", "database/builds.db")
 
     def __init__(self, max_connections: int = 10):
         self.max_connections = max_connections
         self._connections = Queue(max_connections)
         self._lock = Lock()
-        
-        for _ in range(max_connections):
-            connection = sqlite3.connect(self.DB_FILE, check_same_thread=False)
-            self._connections.put(connection)
+        self._created = 0
+        self._writer = None
+
+    def _connect(self) -> Connection:
+        # Connections are opened on demand, up to max_connections
+        connection = sqlite3.connect(self.DB_FILE, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT / 1000, cached_statements=256)
+        connection.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}")
+        connection.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        connection.execute(f"PRAGMA cache_size={SQLITE_CACHE_SIZE}")
+        connection.execute("PRAGMA temp_store=MEMORY")
+        if self._created == 0:
+            # WAL is stored in the database file itself, switching once is enough for every connection
+            connection.execute("PRAGMA journal_mode=WAL")
+        self._created += 1
+        return connection
+
+    def acquire(self) -> Connection:
+        try:
+            return self._connections.get_nowait()
+        except Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.max_connections:
+                return self._connect()
+        return self._connections.get()
 
     def execute(self, query: str, args: Optional[tuple] = None) -> Cursor:
         with self.get_connection() as connection:
             cursor = connection.cursor()
-            cursor.execute(query, args)
+            cursor.execute(query, args or ())
             return cursor
 
-    def get_connection(self) -> Connection:
-        return ConnectionContextManager(self)
+    def get_connection(self, kind: str = "query") -> Connection:
+        return ConnectionContextManager(self, kind)
 
     def release_connection(self, connection: Connection):
         self._connections.put(connection)
 
+    @property
+    def writer(self) -> "WriteBatcher":
+        with self._lock:
+            if self._writer is None:
+                self._writer = WriteBatcher(self)
+            return self._writer
+
+    def write(self, statements: List[Tuple[str, tuple]], wait: bool = True) -> bool:
+        return self.writer.submit(statements, wait)
+
+    def flush(self):
+        if self._writer is not None:
+            self._writer.flush()
+
 class ConnectionContextManager:
-    def __init__(self, connection_pool: ConnectionPool):
+    # Commits when the block succeeds, rolls back when it raises, and always hands the connection back
+    def __init__(self, connection_pool: ConnectionPool, kind: str = "query"):
         self.connection_pool = connection_pool
         self.connection = None
+        self.kind = kind
+        self.started = None
 
     def __enter__(self) -> Connection:
-        self.connection = self.connection_pool._connections.get()
+        self.connection = self.connection_pool.acquire()
+        self.started = time.monotonic()
         return self.connection
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.connection_pool.release_connection(self.connection)
\ No newline at end of file
+        try:
+            if exc_type is None:
+                self.connection.commit()
+            else:
+                self.connection.rollback()
+        finally:
+            metrics.DB_QUERY_SECONDS.observe(time.monotonic() - self.started, kind=self.kind)
+            self.connection_pool.release_connection(self.connection)
+
+class WriteBatcher:
+    # Single writer thread: everything submitted while it was busy goes into the next transaction
+
+    def __init__(self, connection_pool: ConnectionPool, max_batch: int = SQLITE_WRITE_BATCH_SIZE, max_delay: float = SQLITE_WRITE_BATCH_DELAY):
+        self.connection_pool = connection_pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = Queue()
+        self._thread = Thread(target=self._run, name="sqlite-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, statements: List[Tuple[str, tuple]], wait: bool = True) -> bool:
+        item = {"statements": statements, "done": Event(), "ok": True}
+        self._queue.put(item)
+        if wait:
+            item["done"].wait()
+        return item["ok"]
+
+    def flush(self):
+        self.submit([], wait=True)
+
+    def _collect(self) -> List[Dict]:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                with self.connection_pool.get_connection("write_batch") as conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    for item in batch:
+                        # A savepoint per submission keeps one bad write from sinking the whole batch
+                        conn.execute("SAVEPOINT batched_write")
+                        try:
+                            for query, args in item["statements"]:
+                                conn.execute(query, args)
+                            conn.execute("RELEASE batched_write")
+                        except sqlite3.Error as e:
+                            print(f"Error in batched write: {e}")
+                            conn.execute("ROLLBACK TO batched_write")
+                            conn.execute("RELEASE batched_write")
+                            item["ok"] = False
+            except sqlite3.Error as e:
+                print(f"Error committing batched writes: {e}")
+                for item in batch:
+                    item["ok"] = False
+            finally:
+                for item in batch:
+                    item["done"].set()
+
+# One pool per process, shared by every module that talks to the database
+_shared_pool = None
+_shared_lock = Lock()
+
+def get_pool() -> ConnectionPool:
+    global _shared_pool
+    with _shared_lock:
+        if _shared_pool is None:
+            _shared_pool = ConnectionPool()
+        return _shared_pool
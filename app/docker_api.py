@@ -0,0 +1,309 @@
+import os, json, time, socket, struct, base64, http.client
+from urllib.parse import urlencode, quote
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Iterator
+from queue import Queue, Empty, Full
+
+DOCKER_SOCKET = os.getenv("DOCKER_SOCKET", "/var/run/docker.sock")
+# auto: use the Engine API when the socket answers and fall back to the CLI, api / cli force one of them
+DOCKER_BACKEND = os.getenv("DOCKER_BACKEND", "auto").lower()
+# Empty means "whatever the daemon speaks", pin it (e.g. v1.43) if the daemon is newer than you trust
+DOCKER_API_VERSION = os.getenv("DOCKER_API_VERSION", "")
+DOCKER_API_TIMEOUT = float(os.getenv("DOCKER_API_TIMEOUT", "30"))
+
+# Marks "use the client's default timeout", None already means "wait forever"
+DEFAULT_TIMEOUT = object()
+
+class DockerError(Exception):
+
+    def __init__(self, message: str, status: int = 0):
+        super().__init__(message)
+        self.status = status
+
+class DockerUnavailable(DockerError):
+    pass
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+class DockerStream:
+    # A response that keeps its connection busy until the caller is done reading it
+
+    def __init__(self, client, connection: UnixHTTPConnection, response: http.client.HTTPResponse):
+        self.client = client
+        self.connection = connection
+        self.response = response
+
+    def __iter__(self) -> Iterator[bytes]:
+        try:
+            while True:
+                chunk = self.response.read1(65536)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def lines(self) -> Iterator[bytes]:
+        try:
+            for line in self.response:
+                yield line
+        finally:
+            self.close()
+
+    def log_lines(self, tty: bool = False) -> Iterator[bytes]:
+        # Container logs a line at a time, non-TTY output is demultiplexed frame by frame instead of read whole
+        if tty:
+            yield from self.lines()
+            return
+        try:
+            pending = b""
+            while True:
+                header = self.response.read(8)
+                if len(header) < 8:
+                    break
+                pending += self.response.read(struct.unpack(">I", header[4:8])[0])
+                *complete, pending = pending.split(b"\n")
+                for line in complete:
+                    yield line + b"\n"
+            if pending:
+                yield pending + b"\n"
+        finally:
+            self.close()
+
+    def close(self):
+        if self.connection is None:
+            return
+        # A half read stream can't be reused, only hand back connections that reached the end
+        if self.response.isclosed():
+            self.client._release(self.connection)
+        else:
+            self.connection.close()
+        self.connection = None
+
+class DockerClient:
+
+    def __init__(self, socket_path: str = DOCKER_SOCKET, max_connections: int = 8, timeout: float = DOCKER_API_TIMEOUT):
+        self.socket_path = socket_path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._connections = Queue(max_connections)
+        self._available = None
+        self._checked_at = 0.0
+
+    # connection pool
+
+    def _acquire(self, timeout=DEFAULT_TIMEOUT) -> UnixHTTPConnection:
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        try:
+            connection = self._connections.get_nowait()
+        except Empty:
+            return UnixHTTPConnection(self.socket_path, timeout=timeout)
+
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection
+
+    def _release(self, connection: UnixHTTPConnection):
+        try:
+            self._connections.put_nowait(connection)
+        except Full:
+            connection.close()
+
+    def close(self):
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except Empty:
+                break
+
+    def _path(self, path: str, params: Optional[Dict] = None) -> str:
+        prefix = f"/{DOCKER_API_VERSION}" if DOCKER_API_VERSION else ""
+        query = {}
+        for key, value in (params or {}).items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = int(value)
+            elif isinstance(value, (dict, list)):
+                value = json.dumps(value)
+            query[key] = value
+        return prefix + path + (f"?{urlencode(query)}" if query else "")
+
+    def request(self, method: str, path: str, params: Optional[Dict] = None, body=None, headers: Optional[Dict] = None,
+                stream: bool = False, timeout=DEFAULT_TIMEOUT):
+        headers = dict(headers or {})
+        if body is not None and not isinstance(body, (bytes, str)):
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+
+        url = self._path(path, params)
+        for attempt in range(2):
+            connection = self._acquire(timeout)
+            try:
+                connection.request(method, url, body=body, headers=headers)
+                response = connection.getresponse()
+            except (ConnectionError, http.client.HTTPException, OSError) as e:
+                connection.close()
+                # Pooled connections may have been dropped by the daemon, retry once on a fresh one
+                if attempt == 0 and not isinstance(e, (FileNotFoundError, ConnectionRefusedError, PermissionError)):
+                    continue
+                raise DockerUnavailable(f"Docker daemon not reachable at {self.socket_path}: {e}")
+            break
+
+        if response.status >= 400:
+            data = response.read()
+            self._release(connection)
+            try:
+                message = json.loads(data).get("message", data.decode(errors="replace"))
+            except ValueError:
+                message = data.decode(errors="replace")
+            raise DockerError(f"{method} {path} failed with {response.status}: {message}", response.status)
+
+        if stream:
+            return DockerStream(self, connection, response)
+
+        data = response.read()
+        self._release(connection)
+        if response.getheader("Content-Type", "").startswith("application/json") and data:
+            return json.loads(data)
+        return data
+
+    def available(self, ttl: float = 30) -> bool:
+        if DOCKER_BACKEND == "cli":
+            return False
+        if DOCKER_BACKEND == "api":
+            return True
+
+        now = time.monotonic()
+        if self._available is not None and now - self._checked_at < ttl:
+            return self._available
+
+        self._available = os.path.exists(self.socket_path) and self.ping()
+        self._checked_at = now
+        return self._available
+
+    def ping(self) -> bool:
+        try:
+            return self.request("GET", "/_ping", timeout=2) == b"OK"
+        except DockerError:
+            return False
+
+    # containers
+
+    def containers(self, all: bool = True, filters: Optional[Dict[str, List[str]]] = None) -> List[Dict]:
+        return self.request("GET", "/containers/json", params={"all": all, "filters": filters})
+
+    def inspect_container(self, container: str, size: bool = False) -> Dict:
+        # size adds SizeRw, what the container wrote on top of its image
+        return self.request("GET", f"/containers/{quote(container)}/json", params={"size": True} if size else None)
+
+    def inspect_containers(self, containers: List[str]) -> List[Dict]:
+        # Fan the inspects out over the pool instead of doing them one round trip at a time
+        if len(containers) <= 1:
+            return [self.inspect_container(container) for container in containers]
+        with ThreadPoolExecutor(max_workers=min(len(containers), self.max_connections)) as executor:
+            return list(executor.map(self.inspect_container, containers))
+
+    def restart_container(self, container: str, timeout: int = 10):
+        self.request("POST", f"/containers/{quote(container)}/restart", params={"t": timeout}, timeout=self.timeout + timeout)
+
+    def stop_container(self, container: str, timeout: int = 10):
+        try:
+            self.request("POST", f"/containers/{quote(container)}/stop", params={"t": timeout}, timeout=self.timeout + timeout)
+        except DockerError as e:
+            # 304: already stopped
+            if e.status != 304:
+                raise
+
+    def remove_container(self, container: str, force: bool = False):
+        self.request("DELETE", f"/containers/{quote(container)}", params={"force": force})
+
+    def container_logs(self, container: str, stdout: bool = True, stderr: bool = True, timestamps: bool = False,
+                       tail: Optional[str] = None, since: Optional[int] = None, until: Optional[int] = None,
+                       follow: bool = False, tty: bool = False, stream: bool = False):
+        # Followed or stream=True logs come back as a DockerStream, read them with log_lines()
+        params = {"stdout": stdout, "stderr": stderr, "timestamps": timestamps, "tail": tail, "since": since, "until": until, "follow": follow}
+        response = self.request("GET", f"/containers/{quote(container)}/logs", params=params, stream=follow or stream,
+                                timeout=None if follow else DEFAULT_TIMEOUT)
+        if follow or stream:
+            return response
+        return response if tty else demux_logs(response)
+
+    # images
+
+    def images(self, filters: Optional[Dict[str, List[str]]] = None) -> List[Dict]:
+        return self.request("GET", "/images/json", params={"filters": filters})
+
+    def inspect_image(self, image: str) -> Dict:
+        return self.request("GET", f"/images/{quote(image, safe='')}/json")
+
+    def tag_image(self, image: str, repository: str, tag: str = "latest"):
+        self.request("POST", f"/images/{quote(image, safe='')}/tag", params={"repo": repository, "tag": tag})
+
+    def push_image(self, repository: str, tag: str = "latest") -> List[Dict]:
+        # The registry is our own insecure one, an empty auth config is all the daemon needs
+        headers = {"X-Registry-Auth": base64.urlsafe_b64encode(b"{}").decode()}
+        stream = self.request("POST", f"/images/{quote(repository, safe='/:')}/push", params={"tag": tag}, headers=headers,
+                              stream=True, timeout=None)
+        return self._progress(stream, f"Pushing {repository}:{tag}")
+
+    def pull_image(self, repository: str, tag: str = "latest") -> List[Dict]:
+        headers = {"X-Registry-Auth": base64.urlsafe_b64encode(b"{}").decode()}
+        stream = self.request("POST", "/images/create", params={"fromImage": repository, "tag": tag}, headers=headers,
+                              stream=True, timeout=None)
+        return self._progress(stream, f"Pulling {repository}:{tag}")
+
+    def remove_image(self, image: str, force: bool = False) -> List[Dict]:
+        # Untags, and deletes the image once that was its last tag: [{"Untagged": ...}, {"Deleted": ...}]
+        return self.request("DELETE", f"/images/{quote(image, safe='')}", params={"force": force})
+
+    def prune_images(self, filters: Optional[Dict[str, List[str]]] = None) -> Dict:
+        return self.request("POST", "/images/prune", params={"filters": filters}, timeout=None)
+
+    def prune_build_cache(self, filters: Optional[Dict[str, List[str]]] = None) -> Dict:
+        return self.request("POST", "/build/prune", params={"filters": filters}, timeout=None)
+
+    def disk_usage(self) -> Dict:
+        # Images, containers and builder cache with their sizes, what `docker system df -v` shows
+        return self.request("GET", "/system/df", timeout=None)
+
+    def _progress(self, stream: DockerStream, action: str) -> List[Dict]:
+        # Push and pull answer 200 right away, failures only show up as an error event in the progress stream
+        progress = []
+        for line in stream.lines():
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if "error" in event:
+                stream.close()
+                raise DockerError(f"{action} failed: {event['error']}")
+            progress.append(event)
+        return progress
+
+def demux_logs(data: bytes) -> bytes:
+    # Non-TTY containers multiplex stdout/stderr as frames of [stream, 0, 0, 0, size(4 bytes)] + payload
+    output = bytearray()
+    offset = 0
+    while offset + 8 <= len(data):
+        stream_type, size = data[offset], struct.unpack(">I", data[offset + 4:offset + 8])[0]
+        if stream_type not in (0, 1, 2) or data[offset + 1:offset + 4] != b"\x00\x00\x00":
+            # Not multiplexed after all (TTY container), hand it back untouched
+            return data
+        output += data[offset + 8:offset + 8 + size]
+        offset += 8 + size
+    return bytes(output) if offset else data
+
+# Shared client, connections are opened lazily on first use
+client = DockerClient()
@@ -1,6 +1,33 @@
-from typing import Optional, List, Dict
-import subprocess, os, requests
+from typing import Optional, List, Dict, Tuple
+import subprocess, os, re, json, time, uuid, requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import log as logs
+from helpers import run_cancellable, BuildCancelled
+from docker_api import client as docker, DockerError, DockerUnavailable
+import container_state, gitcache, buildcache, tracing
+
+# Every build is pushed here, rollbacks pull from it when the local daemon no longer has the image
+REGISTRY_URL = os.getenv("REGISTRY_URL", "registry:5000")
+# The bundled registry speaks plain http
+REGISTRY_SCHEME = os.getenv("REGISTRY_SCHEME", "http")
+# How many images are pushed at the same time
+REGISTRY_PUSH_PARALLELISM = int(os.getenv("REGISTRY_PUSH_PARALLELISM", "3"))
+
+# recreate: stop the old container, then build and start the new one | bluegreen: build first, swap once the new one is healthy
+DEPLOY_STRATEGY = os.getenv("DEPLOY_STRATEGY", "recreate").lower()
+# Network traefik watches, blue/green containers are only reachable through it
+TRAEFIK_NETWORK = os.getenv("TRAEFIK_NETWORK", "prod-automation_prod-auto-inet")
+HEALTH_CHECK_PATH = os.getenv("HEALTH_CHECK_PATH", "/")
+# How long a new container gets to become healthy before the deploy is rolled back (seconds)
+HEALTH_CHECK_TIMEOUT = float(os.getenv("HEALTH_CHECK_TIMEOUT", "60"))
+HEALTH_CHECK_INTERVAL = 1.0
+# Without a HEALTHCHECK or an exposed port, staying up this long counts as healthy (seconds)
+HEALTH_CHECK_GRACE = float(os.getenv("HEALTH_CHECK_GRACE", "5"))
+
+# Lines read per container when a caller doesn't ask for a tail, a container's whole history is never read by default
+CONTAINER_LOG_TAIL = os.getenv("CONTAINER_LOG_TAIL", "500")
+
+MANIFEST_TYPES = "application/vnd.docker.distribution.manifest.v2+json, application/vnd.oci.image.manifest.v1+json"
 
 def read_exposed_ports_from_dockerfile(dockerfile_path: str) -> List[int]:
     exposed_ports = []
@@ -17,16 +44,77 @@ def read_exposed_ports_from_dockerfile(dockerfile_path: str) -> List[int]:
                         print(f"Invalid port number: {port}")
     return exposed_ports
 
+def compose_project_name(project_name: str) -> str:
+    # Passed to docker-compose as -p, the same name it used to derive from the old projects/<repo> checkout
+    return re.sub(r"[^-_a-z0-9]", "", project_name.lower())
+
+def compose_command(project_name: str, compose_file_path: str) -> List[str]:
+    # Every job builds from its own worktree, -p keeps them all on the one compose project
+    return ["docker-compose", "-p", compose_project_name(project_name), "-f", compose_file_path]
+
+def compose_file(project_name: str) -> str:
+    checkout = gitcache.current_checkout(project_name) or os.path.join("projects", project_name)
+    return os.path.join(checkout, "docker-compose.yml")
+
+def relative_bind_sources(compose_file_path: str) -> List[str]:
+    # Host paths like ./data in "./data:/var/lib/data" or a long syntax bind, named volumes and absolute paths are left out
+    # yaml is imported here, not at startup, only compose deploys need it
+    import yaml
+    try:
+        with open(compose_file_path) as f:
+            config = yaml.safe_load(f) or {}
+    except (OSError, yaml.YAMLError) as e:
+        print(f"Error reading volumes of {compose_file_path}: {e}")
+        return []
+
+    sources = []
+    for service in (config.get("services") or {}).values():
+        for volume in (service or {}).get("volumes") or []:
+            if isinstance(volume, dict):
+                source = volume.get("source") if volume.get("type") == "bind" else None
+            else:
+                source = str(volume).split(":", 1)[0] if ":" in str(volume) else None
+            if source and source.startswith(("./", "../")):
+                sources.append(source)
+    return sources
+
+def persist_bind_mounts(project_name: str, compose_file_path: str, log=None):
+    # Runs before every `up`, a job's worktree is new so its relative bind mounts would otherwise start out empty
+    linked = gitcache.link_data_dirs(project_name, os.path.dirname(os.path.abspath(compose_file_path)), relative_bind_sources(compose_file_path))
+    if linked and log is not None:
+        log.write(f"Keeping {', '.join(linked)} in {gitcache.data_dir(project_name)}\n")
+        log.flush()
+
+def _compose_containers(project_name: str) -> List[Dict]:
+    return docker.containers(all=True, filters={"label": [f"com.docker.compose.project={compose_project_name(project_name)}"]})
+
 def docker_restart_container(container_name: str):
+    if docker.available():
+        try:
+            compose_containers = _compose_containers(container_name)
+            if compose_containers:
+                for container in compose_containers:
+                    docker.restart_container(container["Id"])
+                print(f"Containers of {container_name} restarted successfully using the docker API.")
+            else:
+                docker.restart_container(container_name)
+                print(f"Container {container_name} restarted successfully using the docker API.")
+            return
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+        except DockerError as e:
+            print(f"Error restarting container {container_name}: {e}")
+            return
+
     try:
         # Check if the container exists
         subprocess.run(["docker", "inspect", container_name], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         
         # Check if the container was deployed using docker-compose
-        compose_file_path = os.path.join("projects", container_name, "docker-compose.yml")
+        compose_file_path = compose_file(container_name)
 
         if os.path.exists(compose_file_path):
-            subprocess.run(["docker-compose", "-f", compose_file_path, "restart", container_name], check=True)
+            subprocess.run([*compose_command(container_name, compose_file_path), "restart", container_name], check=True)
             print(f"Container {container_name} restarted successfully using docker-compose.")
         else:
             subprocess.run(["docker", "restart", container_name], check=True)
@@ -35,15 +123,44 @@ def docker_restart_container(container_name: str):
     except subprocess.CalledProcessError as e:
         print(f"Error restarting container {container_name}: {e}")
 
+def _api_stop_and_remove_container(container_name: str, compose_file_path: str):
+    # docker-compose down is kept since it also cleans up the project networks, but only when something is running
+    if os.path.exists(compose_file_path) and _compose_containers(container_name):
+        try:
+            subprocess.run([*compose_command(container_name, compose_file_path), "down"], check=True)
+        except subprocess.CalledProcessError as e:
+            print(f"Error stopping and removing containers for {container_name} with docker-compose: {e}")
+            return
+
+    try:
+        docker.inspect_container(container_name)
+    except DockerError as e:
+        if e.status != 404:
+            raise
+        print(f"Container {container_name} not found.")
+        return
+
+    docker.stop_container(container_name)
+    docker.remove_container(container_name)
+
 def stop_and_remove_container(container_name: str):
 
-    compose_file_path = os.path.join("projects", container_name, "docker-compose.yml")
+    compose_file_path = compose_file(container_name)
+
+    if docker.available():
+        try:
+            return _api_stop_and_remove_container(container_name, compose_file_path)
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+        except DockerError as e:
+            print(f"Error stopping and removing container {container_name} with docker: {e}")
+            return
 
     if os.path.exists(compose_file_path):
         try:
-            existing_containers = subprocess.run(["docker-compose", "-f", compose_file_path, "ps", "-q"], capture_output=True, text=True)
+            existing_containers = subprocess.run([*compose_command(container_name, compose_file_path), "ps", "-q"], capture_output=True, text=True)
             if existing_containers.stdout:
-                subprocess.run(["docker-compose", "-f", compose_file_path, "down"], check=True)
+                subprocess.run([*compose_command(container_name, compose_file_path), "down"], check=True)
         except subprocess.CalledProcessError as e:
             print(f"Error stopping and removing containers for {container_name} with docker-compose: {e}")
             return
@@ -60,104 +177,486 @@ def stop_and_remove_container(container_name: str):
     except subprocess.CalledProcessError as e:
         print(f"Error stopping and removing container {container_name} with docker: {e}")
 
-def docker_push_images(registry_url: str = "registry:5000", project_name: str = None):
+def _with_tag(image: str) -> str:
+    # "power-dns" and "power-dns:latest" are the same image, a registry path may carry a port so only look after the last /
+    return image if ":" in image.rsplit("/", 1)[-1] else f"{image}:latest"
+
+def _local_image_id(image: str) -> Optional[str]:
+    if docker.available():
+        try:
+            return docker.inspect_image(image).get("Id")
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+        except DockerError:
+            return None
+
+    result = subprocess.run(["docker", "image", "inspect", "--format", "{{.Id}}", image], capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def _registry_config_digest(image: str, registry_url: str) -> Optional[str]:
+    # The registry's manifest names the image config it holds, equal to the local image id when nothing changed
+    repository, _, tag = _with_tag(image).rpartition(":")
     try:
-        images_output = subprocess.check_output(["docker", "images", "--format", "{{.Repository}}:{{.Tag}}"]).decode("utf-8")
-        images_list = images_output.strip().split("\n")
-        last_three_images = images_list[-3:]
-        
-        if project_name is not None:
-            project_images = [image for image in images_list if project_name.lower() in image and not image.startswith(f"{registry_url}/")]
-
-            for image in project_images:
-                # Tag the image with the registry URL and project name
-                tagged_image = f"{registry_url}/{image}"
-                subprocess.run(["docker", "tag", image, tagged_image], check=True)
-                
-                # Push the tagged image to the registry
-                subprocess.run(["docker", "push", tagged_image], check=True)
-                
-                print(f"Image {tagged_image} pushed to {registry_url} successfully.")
-        else:
-            for image in last_three_images:
-                if not image.startswith(f"{registry_url}/"):
-                    # Tag the image with the registry URL
-                    tagged_image = f"{registry_url}/{image}"
-                    subprocess.run(["docker", "tag", image, tagged_image], check=True)
+        response = requests.get(f"{REGISTRY_SCHEME}://{registry_url}/v2/{repository}/manifests/{tag}",
+                                headers={"Accept": MANIFEST_TYPES}, timeout=10)
+        if response.status_code != 200:
+            return None
+        return response.json().get("config", {}).get("digest")
+    except (requests.RequestException, ValueError):
+        return None
 
-                    # Push the tagged image to the registry
-                    subprocess.run(["docker", "push", tagged_image], check=True)
-                    print(f"Image {tagged_image} pushed to {registry_url} successfully.")
+def _pushed_bytes(progress: List[Dict]) -> int:
+    # Layers the registry already had report "Layer already exists" and cost nothing
+    totals, pushed = {}, set()
+    for event in progress:
+        layer, detail = event.get("id"), event.get("progressDetail") or {}
+        if layer and detail.get("total"):
+            totals[layer] = max(totals.get(layer, 0), detail["total"])
+        if layer and event.get("status") == "Pushed":
+            pushed.add(layer)
+    return sum(totals.get(layer, 0) for layer in pushed)
 
-    except subprocess.CalledProcessError as e:
-        print(f"Error pushing images to {registry_url}: {e}")
+def _push_image(image: str, registry_url: str) -> int:
+    # Tag the image with the registry URL and push the tagged image to the registry
+    tagged_image = f"{registry_url}/{_with_tag(image)}"
+    repository, _, tag = tagged_image.rpartition(":")
+
+    if docker.available():
+        try:
+            docker.tag_image(image, repository, tag)
+            pushed_bytes = _pushed_bytes(docker.push_image(repository, tag))
+            print(f"Image {tagged_image} pushed to {registry_url} successfully.")
+            return pushed_bytes
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+
+    subprocess.run(["docker", "tag", image, tagged_image], check=True)
+    subprocess.run(["docker", "push", tagged_image], check=True)
+    print(f"Image {tagged_image} pushed to {registry_url} successfully.")
+    return 0
 
-def deploy_docker_compose(project_name: str, compose_file_path: str, log_file_path: str, webhook: bool , commit_hash: str):
+def push_image_if_changed(image: str, registry_url: str = REGISTRY_URL) -> Optional[int]:
+    # None when the registry already holds this exact image, otherwise the bytes uploaded
+    image_id = _local_image_id(image)
+    if image_id and image_id == _registry_config_digest(image, registry_url):
+        return None
+    return _push_image(image, registry_url)
+
+def docker_push_images(images: List[str], registry_url: str = REGISTRY_URL, job_id: str = None) -> Dict:
+    # Pushes exactly the images a build produced, several at once, and records how long it took and how much went up
+    started = time.monotonic()
+    result = {"pushed": [], "skipped": [], "failed": [], "bytes": 0}
+
+    with ThreadPoolExecutor(max_workers=max(1, REGISTRY_PUSH_PARALLELISM), thread_name_prefix="push") as pool:
+        futures = {pool.submit(push_image_if_changed, image, registry_url): image for image in dict.fromkeys(images)}
+        for future in as_completed(futures):
+            image = futures[future]
+            try:
+                pushed_bytes = future.result()
+            except (subprocess.CalledProcessError, DockerError) as e:
+                print(f"Error pushing {image} to {registry_url}: {e}")
+                result["failed"].append(image)
+                continue
+            if pushed_bytes is None:
+                result["skipped"].append(image)
+            else:
+                result["pushed"].append(image)
+                result["bytes"] += pushed_bytes
+
+    result["duration"] = time.monotonic() - started
+    logs.record_job_details(job_id, push_duration=result["duration"], push_bytes=result["bytes"])
+    return result
+
+def deploy_docker_compose(project_name: str, compose_file_path: str, log_file_path: str, webhook: bool , commit_hash: str, job_id: str = None, cancel_event = None,
+                          env: Optional[Dict[str, str]] = None) -> bool:
+    # env is this job's environment (helpers.project_env), compose substitutes the project's secrets from it
+    compose = compose_command(project_name, compose_file_path)
     try:
         # Check if there are existing containers for the project
-        existing_containers = subprocess.run(["docker-compose", "-f", compose_file_path, "ps", "-q"], capture_output=True, text=True)
+        existing_containers = subprocess.run([*compose, "ps", "-q"], capture_output=True, text=True, env=env)
         if existing_containers.stdout:
             # Stop and remove existing containers for the project
-            subprocess.run(["docker-compose", "-f", compose_file_path, "down"], check=True)
+            subprocess.run([*compose, "down"], check=True, env=env)
 
         # Build and start the services defined in the docker-compose file
         with open(log_file_path, "a") as log:
-            subprocess.run(["docker-compose", "-f", compose_file_path, "build"], stdout=log, stderr=subprocess.STDOUT, check=True)
-            subprocess.run(["docker-compose", "-f", compose_file_path, "up", "-d"], stdout=log, stderr=subprocess.STDOUT, check=True)
+            if buildcache.FAST_BUILDS:
+                context_hash = buildcache.context_hash(os.path.dirname(compose_file_path))
+                reused = reuse_unchanged_build(project_name, context_hash, log)
+                offset = log.tell()
+                if reused is None:
+                    with tracing.stage(project_name, "build", job_id):
+                        run_cancellable([*compose, "build", *buildcache.compose_build_args()], cancel_event, env=buildcache.build_env(env),
+                                        stdout=log, stderr=subprocess.STDOUT, check=True)
+                logs.record_build_cache(job_id, context_hash, "skipped" if reused is not None else buildcache.cache_result(log_file_path, offset))
+                with tracing.stage(project_name, "up", job_id):
+                    persist_bind_mounts(project_name, compose_file_path, log)
+                    run_cancellable([*compose, "up", "-d", "--no-build"], cancel_event, env=env, stdout=log, stderr=subprocess.STDOUT, check=True)
+            else:
+                with tracing.stage(project_name, "build", job_id):
+                    run_cancellable([*compose, "build"], cancel_event, env=env, stdout=log, stderr=subprocess.STDOUT, check=True)
+                with tracing.stage(project_name, "up", job_id):
+                    persist_bind_mounts(project_name, compose_file_path, log)
+                    run_cancellable([*compose, "up", "-d"], cancel_event, env=env, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+        # Keep this build's images under its commit so a rollback can start them again
+        images = tag_release_images(project_name, commit_hash, compose=True)
 
         # push build images to registry
         try:
-            docker_push_images(project_name=project_name)
+            with tracing.stage(project_name, "push", job_id):
+                docker_push_images([*images, *images.values()] or _project_images(project_name, compose=True), job_id=job_id)
         except:
             pass
 
-        logs.log_build_request(project_name, "success", webhook, commit_hash)
-        logs.update_project_counts(project_name, True)
+        logs.log_build_request(project_name, "success", webhook, commit_hash, job_id=job_id, images=images)
+        return True
     except subprocess.CalledProcessError as e:
         print(f"Error deploying {project_name} with Docker Compose: {e}")
-        logs.log_build_request(project_name, "failure", webhook, commit_hash)
-        logs.update_project_counts(project_name, False)
+        logs.log_build_request(project_name, "failure", webhook, commit_hash, job_id=job_id)
+        return False
+
+def run_command(project_name: str, exposed_ports: List[int], envs = None, name: Optional[str] = None, labels: Optional[Dict[str, str]] = None,
+                network: Optional[str] = None) -> List[str]:
+    # Construct the command to run the container
+    command = ["docker", "run", "-d", "--name", name or project_name]
+    
+    # Add exposed ports to the run command
+    if exposed_ports:
+        for port in exposed_ports:
+            command.extend(["-p", f"{port}:{port}"])
+
+    if envs:
+        command.extend(["-e", f"{envs}"])
+
+    for key, value in (labels or {}).items():
+        command.extend(["--label", f"{key}={value}"])
+
+    if network:
+        command.extend(["--network", network])
+
+    # Add the image name
+    command.append(project_name.lower())
+    return command
+
+def build_image(project_name: str, project_dir: str, log, job_id: str = None, cancel_event = None):
+    with tracing.stage(project_name, "build", job_id):
+        _build_image(project_name, project_dir, log, job_id, cancel_event)
+
+def _build_image(project_name: str, project_dir: str, log, job_id: str = None, cancel_event = None):
+    if buildcache.FAST_BUILDS:
+        context_hash = buildcache.context_hash(project_dir)
+        reused = reuse_unchanged_build(project_name, context_hash, log)
+        offset = log.tell()
+        if reused is None:
+            run_cancellable(buildcache.build_command(project_name.lower(), project_dir), cancel_event, env=buildcache.build_env(),
+                            stdout=log, stderr=subprocess.STDOUT, check=True)
+        logs.record_build_cache(job_id, context_hash, "skipped" if reused is not None else buildcache.cache_result(log.name, offset))
+    else:
+        run_cancellable(["docker", "build", "-t", project_name.lower(), project_dir], cancel_event, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+def deploy_docker_run(project_name: str, project_dir: str, log_file_path: str, exposed_ports: List[int], webhook: bool, commit_hash: str, envs = None, job_id: str = None, cancel_event = None) -> bool:
+    if DEPLOY_STRATEGY == "bluegreen":
+        return deploy_blue_green(project_name, project_dir, log_file_path, webhook, commit_hash, envs=envs, job_id=job_id, cancel_event=cancel_event)
 
-def deploy_docker_run(project_name: str, project_dir: str, log_file_path: str, exposed_ports: List[int], webhook: bool, commit_hash: str, envs = None):
     try:
         stop_and_remove_container(project_name)
         with open(log_file_path, "a") as log:
-            subprocess.run(["docker", "build", "-t", project_name.lower(), project_dir], stdout=log, stderr=subprocess.STDOUT, check=True)
+            build_image(project_name, project_dir, log, job_id=job_id, cancel_event=cancel_event)
 
-        # Construct the command to run the container
-        run_command = ["docker", "run", "-d", "--name", project_name]
-        
-        # Add exposed ports to the run command
-        if exposed_ports:
-            for port in exposed_ports:
-                run_command.extend(["-p", f"{port}:{port}"])
+        # Run the container
+        with tracing.stage(project_name, "up", job_id):
+            subprocess.run(run_command(project_name, exposed_ports, envs))
 
-        if envs:
-            run_command.extend(["-e", f"{envs}"])
+        return _finish_docker_run(project_name, webhook, commit_hash, job_id)
+    except subprocess.CalledProcessError as e:
+        print(f"Error deploying {project_name}: {e}")
+        logs.log_build_request(project_name, "failure", webhook, commit_hash, job_id=job_id)
+        return False
 
-        # Add the image name
-        run_command.append(project_name.lower())
-        
-        # Run the container
-        subprocess.run(run_command)
+def _finish_docker_run(project_name: str, webhook: bool, commit_hash: str, job_id: str = None) -> bool:
+    # Keep this build's image under its commit so a rollback can start it again
+    images = tag_release_images(project_name, commit_hash)
 
-        # push build images to registry
+    # push build images to registry
+    try:
+        with tracing.stage(project_name, "push", job_id):
+            docker_push_images([*images, *images.values()] or _project_images(project_name), job_id=job_id)
+    except:
+        pass
+    
+    logs.log_build_request(project_name, "success", webhook, commit_hash, job_id=job_id, images=images)
+    return True
+
+def traefik_labels(project_name: str, port: Optional[int]) -> Dict[str, str]:
+    # Old and new container share one router and service, traefik sends traffic to whichever of them passes its checks
+    name = compose_project_name(project_name)
+    labels = {
+        "traefik.enable": "true",
+        "traefik.docker.network": TRAEFIK_NETWORK,
+        f"traefik.http.routers.{name}.rule": f"PathPrefix(`/{name}`)",
+        f"traefik.http.routers.{name}.service": name,
+        f"traefik.http.routers.{name}.middlewares": f"{name}@docker",
+        f"traefik.http.middlewares.{name}.stripprefix.prefixes": f"/{name}",
+    }
+    if port:
+        labels[f"traefik.http.services.{name}.loadbalancer.server.port"] = str(port)
+        labels[f"traefik.http.services.{name}.loadbalancer.healthcheck.path"] = HEALTH_CHECK_PATH
+        labels[f"traefik.http.services.{name}.loadbalancer.healthcheck.interval"] = "5s"
+    return labels
+
+def _inspect_container(container_name: str) -> Dict:
+    if docker.available():
         try:
-            docker_push_images(project_name=project_name)
-        except:
-            pass
-        
-        logs.log_build_request(project_name, "success", webhook, commit_hash)
-        logs.update_project_counts(project_name, True)  
-    except subprocess.CalledProcessError as e:
+            return docker.inspect_container(container_name)
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+
+    result = subprocess.run(["docker", "inspect", container_name], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)[0]
+
+def _container_address(detail: Dict) -> Optional[str]:
+    networks = detail.get("NetworkSettings", {}).get("Networks") or {}
+    preferred = networks.get(TRAEFIK_NETWORK) or {}
+    return preferred.get("IPAddress") or next((network.get("IPAddress") for network in networks.values() if network.get("IPAddress")), None)
+
+def wait_until_healthy(container_name: str, port: Optional[int], cancel_event = None) -> Tuple[bool, str]:
+    # The image's HEALTHCHECK decides when it has one, otherwise an HTTP probe on its first exposed port
+    started = time.monotonic()
+    while time.monotonic() - started < HEALTH_CHECK_TIMEOUT:
+        if cancel_event is not None and cancel_event.is_set():
+            raise BuildCancelled(container_name)
+
+        detail = _inspect_container(container_name)
+        state = detail.get("State", {})
+        if not state.get("Running") or state.get("Restarting"):
+            return False, f"exited with code {state.get('ExitCode')}"
+
+        health = (state.get("Health") or {}).get("Status")
+        if health in ("healthy", "unhealthy"):
+            return health == "healthy", health
+        if health is None and port is None and time.monotonic() - started >= HEALTH_CHECK_GRACE:
+            return True, f"running for {HEALTH_CHECK_GRACE:g}s"
+        if health is None and port is not None:
+            address = _container_address(detail)
+            try:
+                response = requests.get(f"http://{address}:{port}{HEALTH_CHECK_PATH}", timeout=HEALTH_CHECK_INTERVAL)
+                if response.status_code < 500:
+                    return True, f"HTTP {response.status_code}"
+            except requests.RequestException:
+                pass
+
+        time.sleep(HEALTH_CHECK_INTERVAL)
+    return False, f"not healthy after {HEALTH_CHECK_TIMEOUT:g}s"
+
+def _remove_container(container_name: str):
+    subprocess.run(["docker", "rm", "-f", container_name], capture_output=True)
+
+def start_blue_green(project_name: str, log, envs = None, job_id: str = None, cancel_event = None) -> bool:
+    # Start the image next to the old container and only retire the old one once the new one is healthy, False leaves the old one serving
+    candidate = f"{project_name}-{(job_id or uuid.uuid4().hex)[:8]}"
+    try:
+        with tracing.stage(project_name, "up", job_id):
+            ports = _image_ports(project_name.lower())
+            port = ports[0] if ports else None
+            _remove_container(candidate)
+            run_cancellable(run_command(project_name, [], envs, name=candidate, labels=traefik_labels(project_name, port), network=TRAEFIK_NETWORK),
+                            cancel_event, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+            healthy, reason = wait_until_healthy(candidate, port, cancel_event)
+        if not healthy:
+            log.write(f"{candidate} did not become healthy ({reason}), keeping the running version\n")
+            log.flush()
+            subprocess.run(["docker", "logs", "--tail", "100", candidate], stdout=log, stderr=subprocess.STDOUT)
+            _remove_container(candidate)
+            return False
+        log.write(f"{candidate} is healthy ({reason}), retiring the old container\n")
+        log.flush()
+
+        stop_and_remove_container(project_name)
+        subprocess.run(["docker", "rename", candidate, project_name], check=True)
+        return True
+    except (BuildCancelled, subprocess.CalledProcessError, DockerError):
+        _remove_container(candidate)
+        raise
+
+def deploy_blue_green(project_name: str, project_dir: str, log_file_path: str, webhook: bool, commit_hash: str, envs = None,
+                      job_id: str = None, cancel_event = None) -> bool:
+    # Build while the old container keeps serving, then swap it out the same way a rollback does
+    try:
+        with open(log_file_path, "a") as log:
+            build_image(project_name, project_dir, log, job_id=job_id, cancel_event=cancel_event)
+            started = start_blue_green(project_name, log, envs, job_id=job_id, cancel_event=cancel_event)
+        if not started:
+            logs.log_build_request(project_name, "failure", webhook, commit_hash, job_id=job_id)
+            return False
+        return _finish_docker_run(project_name, webhook, commit_hash, job_id)
+    except (subprocess.CalledProcessError, DockerError) as e:
         print(f"Error deploying {project_name}: {e}")
-        logs.log_build_request(project_name, "failure", webhook, commit_hash)
-        logs.update_project_counts(project_name, False)
+        logs.log_build_request(project_name, "failure", webhook, commit_hash, job_id=job_id)
+        return False
+
+def _tag_image(image: str, target: str):
+    repository, _, tag = target.rpartition(":")
+    if docker.available():
+        try:
+            return docker.tag_image(image, repository, tag)
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+    subprocess.run(["docker", "tag", image, target], check=True, capture_output=True)
+
+def _compose_images(project_name: str) -> List[str]:
+    if docker.available():
+        try:
+            return [container["Image"] for container in _compose_containers(project_name)]
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+
+    result = subprocess.run(["docker", "ps", "-a", "--filter", f"label=com.docker.compose.project={compose_project_name(project_name)}",
+                             "--format", "{{.Image}}"], capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+def _project_images(project_name: str, compose: bool = False) -> List[str]:
+    if compose:
+        # Only what compose built for this project, pulled images are pinned by the compose file anyway
+        return sorted({image for image in _compose_images(project_name) if image.startswith(compose_project_name(project_name))})
+    return [project_name.lower()]
+
+def tag_release_images(project_name: str, commit_hash: str, compose: bool = False) -> Dict[str, str]:
+    # Maps the image name a deployment runs from to the same image tagged with its commit, e.g. power-dns -> power-dns:3f2a9c1d0b7e
+    if not commit_hash:
+        return {}
 
-def get_container_logs(container_name: str) -> Dict[str, str]:
+    images = {}
+    for name in _project_images(project_name, compose):
+        repository = name.rsplit(":", 1)[0] if ":" in name.rsplit("/", 1)[-1] else name
+        release = f"{repository}:{commit_hash[:12]}"
+        try:
+            _tag_image(name, release)
+            images[name] = release
+        except (subprocess.CalledProcessError, DockerError) as e:
+            print(f"Error tagging {name} as {release}: {e}")
+    return images
+
+def _ensure_image(image: str, registry_url: str = REGISTRY_URL):
+    # Use the local copy if the daemon still has it, otherwise pull the pushed one back from the registry
+    remote = f"{registry_url}/{image}"
+    if docker.available():
+        try:
+            try:
+                docker.inspect_image(image)
+                return
+            except DockerError as e:
+                if e.status != 404:
+                    raise
+            repository, _, tag = remote.rpartition(":")
+            docker.pull_image(repository, tag)
+            return _tag_image(remote, image)
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+
+    if subprocess.run(["docker", "image", "inspect", image], capture_output=True).returncode == 0:
+        return
+    subprocess.run(["docker", "pull", remote], check=True)
+    _tag_image(remote, image)
+
+def _image_ports(image: str) -> List[int]:
+    # The Dockerfile of that commit may be gone, the image remembers what it exposes
+    if docker.available():
+        try:
+            exposed = docker.inspect_image(image).get("Config", {}).get("ExposedPorts") or {}
+            return sorted(int(port.split("/")[0]) for port in exposed)
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+
+    result = subprocess.run(["docker", "image", "inspect", "--format", "{{json .Config.ExposedPorts}}", image], capture_output=True, text=True, check=True)
+    exposed = json.loads(result.stdout.strip() or "null") or {}
+    return sorted(int(port.split("/")[0]) for port in exposed)
+
+def restore_images(images: Dict[str, str], log):
+    for name, release in images.items():
+        log.write(f"Restoring {name} from {release}\n")
+        _ensure_image(release)
+        _tag_image(release, name)
+
+def reuse_unchanged_build(project_name: str, context_hash: Optional[str], log) -> Optional[Dict[str, str]]:
+    # An earlier successful build of the exact same context already produced these images
+    release = logs.find_release_by_context(project_name, context_hash) if context_hash else None
+    if release is None:
+        return None
+    try:
+        log.write(f"Build context unchanged since job {release['job_id']}, skipping the build\n")
+        log.flush()
+        restore_images(release["images"], log)
+        return release["images"]
+    except (subprocess.CalledProcessError, DockerError) as e:
+        log.write(f"Could not reuse the images of job {release['job_id']}, building instead: {e}\n")
+        return None
+
+def rollback(project_name: str, images: Dict[str, str], log_file_path: str, webhook: bool, commit_hash: str, envs = None,
+             job_id: str = None, cancel_event = None, env: Optional[Dict[str, str]] = None, project_dir: Optional[str] = None) -> bool:
+    # Put the released images back under the names the deployment runs from and restart it, no build
+    # project_dir is the release's own checkout, its compose file is the one those images were started with
+    try:
+        with open(log_file_path, "a") as log:
+            with tracing.stage(project_name, "restore", job_id):
+                restore_images(images, log)
+
+            compose_file_path = os.path.join(project_dir, "docker-compose.yml") if project_dir else compose_file(project_name)
+            if os.path.exists(compose_file_path):
+                with tracing.stage(project_name, "up", job_id):
+                    persist_bind_mounts(project_name, compose_file_path, log)
+                    run_cancellable([*compose_command(project_name, compose_file_path), "up", "-d", "--no-build"], cancel_event, env=env,
+                                    stdout=log, stderr=subprocess.STDOUT, check=True)
+            elif DEPLOY_STRATEGY == "bluegreen":
+                # A release that no longer comes up healthy must not take down the version that is serving now
+                if not start_blue_green(project_name, log, envs, job_id=job_id, cancel_event=cancel_event):
+                    logs.log_build_request(project_name, "failure", webhook, commit_hash, job_id=job_id)
+                    return False
+            else:
+                with tracing.stage(project_name, "up", job_id):
+                    exposed_ports = _image_ports(project_name.lower())
+                    stop_and_remove_container(project_name)
+                    run_cancellable(run_command(project_name, exposed_ports, envs), cancel_event, stdout=log, stderr=subprocess.STDOUT, check=True)
+
+        logs.log_build_request(project_name, "success", webhook, commit_hash, job_id=job_id, images=images)
+        return True
+    except (subprocess.CalledProcessError, DockerError) as e:
+        print(f"Error rolling back {project_name}: {e}")
+        logs.log_build_request(project_name, "failure", webhook, commit_hash, job_id=job_id)
+        return False
+
+def resolve_container_names(container_name: str) -> List[str]:
+    # Exact name first, otherwise every running container containing it, same as the `docker ps` fallback
+    if container_state.cache.ready:
+        return container_state.cache.container_names(container_name)
+
+    try:
+        return [docker.inspect_container(container_name)["Name"].lstrip("/")]
+    except DockerError as e:
+        if e.status != 404:
+            raise
+
+    names = [name.lstrip("/") for container in docker.containers(all=False) for name in container.get("Names", [])]
+    return [name for name in names if container_name in name]
+
+def get_container_logs(container_name: str, tail: Optional[str] = None) -> Dict[str, str]:
+    # Held in memory whole, so only the last lines, /containers/{project}/logs streams instead
+    tail = tail or CONTAINER_LOG_TAIL
     container_logs = {}
 
-    logs_result = subprocess.run(["docker", "logs", container_name], capture_output=True, text=True)
+    if docker.available():
+        try:
+            for name in resolve_container_names(container_name):
+                container_logs[name] = docker.container_logs(name, tail=tail).decode("utf-8", errors="replace")
+            return container_logs
+        except DockerUnavailable as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+        except DockerError as e:
+            print(f"Error reading logs of {container_name}: {e}")
+            return container_logs
+
+    logs_result = subprocess.run(["docker", "logs", "--tail", tail, container_name], capture_output=True, text=True)
     
     if logs_result.returncode == 0:
         container_logs[container_name] = logs_result.stdout
@@ -165,19 +664,45 @@ def get_container_logs(container_name: str) -> Dict[str, str]:
         all_container_names = subprocess.run(["docker", "ps", "--format", "{{.Names}}"], capture_output=True, text=True)
         for name in all_container_names.stdout.splitlines():
             if container_name in name:
-                logs_result = subprocess.run(["docker", "logs", name], capture_output=True, text=True)
+                logs_result = subprocess.run(["docker", "logs", "--tail", tail, name], capture_output=True, text=True)
                 if logs_result.returncode == 0:
                     container_logs[name] = logs_result.stdout
 
     return container_logs
 
+def _api_project_containers(project_name: str) -> List[Dict[str, str]]:
+    # One list call for every container on the host, then the matching inspects in parallel over the pool
+    names = [name.lstrip("/") for container in docker.containers(all=True) for name in container.get("Names", [])]
+    names = [name for name in names if project_name.lower() in name]
+
+    container_info = []
+    for name, details in zip(names, docker.inspect_containers(names)):
+        state = details.get("State", {})
+        container_info.append({
+            "container_name": name,
+            "status": state.get("Status"),
+            "started_at": state.get("StartedAt"),
+            "finished_at": state.get("FinishedAt")
+        })
+    return container_info
+
 def get_project_containers(project_name: str) -> List[Dict[str, str]]:
+    # Served from memory while the events stream keeps the cache current
+    if container_state.cache.ready:
+        return container_state.cache.project_containers(project_name)
+
+    if docker.available():
+        try:
+            return _api_project_containers(project_name)
+        except DockerError as e:
+            print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+
     container_info = []
     
     all_container_names = subprocess.run(["docker", "ps", "-a", "--format", "{{.Names}}"], capture_output=True, text=True)
     for name in all_container_names.stdout.splitlines():
         if project_name.lower() in name:
-            container_details = subprocess.run(["docker", "inspect", "--format='{{.State.Status}} {{.State.StartedAt}} {{.State.FinishedAt}}'", name], capture_output=True, text=True)
+            container_details = subprocess.run(["docker", "inspect", "--format={{.State.Status}} {{.State.StartedAt}} {{.State.FinishedAt}}", name], capture_output=True, text=True)
             details = container_details.stdout.strip().split()
             status = details[0]
             started_at = details[1]
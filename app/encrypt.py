@@ -3,7 +3,15 @@ from cryptography.fernet import Fernet
 class Encryptor:
     
     def __init__(self, key_file="key.key"):
-        self.key = self.load_key(key_file)
+        self.key_file = key_file
+        self._fernet = None
+
+    @property
+    def fernet(self) -> Fernet:
+        # Read on first use so importing the app doesn't touch the key, then built once per process since it derives the keys
+        if self._fernet is None:
+            self._fernet = Fernet(self.load_key(self.key_file))
+        return self._fernet
 
     def load_key(self, key_file):
         with open(key_file, "rb") as key_file:
@@ -11,11 +19,9 @@ class Encryptor:
         return key
 
     def en(self, message):
-        f = Fernet(self.key)
-        encrypted_message = f.encrypt(message.encode())
+        encrypted_message = self.fernet.encrypt(message.encode())
         return encrypted_message
 
     def de(self, encrypted_message):
-        f = Fernet(self.key)
-        decrypted_message = f.decrypt(encrypted_message).decode()
+        decrypted_message = self.fernet.decrypt(encrypted_message).decode()
         return decrypted_message
@@ -0,0 +1,171 @@
+import os, shutil, subprocess, threading
+from typing import Optional, List
+from helpers import run_cancellable
+
+# One bare mirror per repository, every build fetches into it instead of cloning
+GIT_MIRROR_DIR = os.getenv("GIT_MIRROR_DIR", os.path.join("projects", ".mirrors"))
+# Each job checks its commit out into a worktree of its own under here
+GIT_WORKTREE_DIR = os.getenv("GIT_WORKTREE_DIR", os.path.join("projects", ".worktrees"))
+# Commits of history fetched per build (0 fetches everything)
+GIT_FETCH_DEPTH = int(os.getenv("GIT_FETCH_DEPTH", "1"))
+# Finished worktrees kept per repository, the deployed one is never removed
+GIT_WORKTREE_KEEP = int(os.getenv("GIT_WORKTREE_KEEP", "3"))
+# Relative bind mounts of compose projects live here, one directory per repository that outlives every worktree
+PROJECT_DATA_DIR = os.getenv("PROJECT_DATA_DIR", os.path.join("projects", ".data"))
+
+CURRENT = "current"
+
+# Fetches into the same mirror must not overlap
+_locks = {}
+_locks_lock = threading.Lock()
+
+def _lock(repo: str) -> threading.Lock:
+    with _locks_lock:
+        return _locks.setdefault(repo, threading.Lock())
+
+def mirror_path(repo: str) -> str:
+    return os.path.abspath(os.path.join(GIT_MIRROR_DIR, f"{repo}.git"))
+
+def worktree_root(repo: str) -> str:
+    return os.path.abspath(os.path.join(GIT_WORKTREE_DIR, repo))
+
+def current_checkout(repo: str) -> Optional[str]:
+    # The worktree of the last successful deploy, or the checkout older versions cloned into projects/<repo>
+    link = os.path.join(worktree_root(repo), CURRENT)
+    if os.path.isdir(link):
+        return os.path.realpath(link)
+    legacy = os.path.abspath(os.path.join("projects", repo))
+    return legacy if os.path.isdir(legacy) else None
+
+def _git(repo: str, *args, cancel_event=None, **kwargs) -> subprocess.CompletedProcess:
+    return run_cancellable(["git", "--git-dir", mirror_path(repo), *args], cancel_event, check=True, **kwargs)
+
+def _rev_parse(repo: str, revision: str) -> Optional[str]:
+    result = subprocess.run(["git", "--git-dir", mirror_path(repo), "rev-parse", "--verify", "--quiet", f"{revision}^{{commit}}"],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    return result.stdout.strip() if result.returncode == 0 else None
+
+def ensure_mirror(owner: str, repo: str):
+    # init + remote instead of `clone --mirror` so even the first fetch is shallow
+    mirror = mirror_path(repo)
+    if os.path.exists(os.path.join(mirror, "HEAD")):
+        return
+    os.makedirs(mirror, exist_ok=True)
+    subprocess.run(["git", "init", "--bare", "--quiet", mirror], check=True)
+    _git(repo, "remote", "add", "origin", f"https://github.com/{owner}/{repo}.git")
+
+def fetch(owner: str, repo: str, commit_hash: str = "", depth: int = GIT_FETCH_DEPTH, cancel_event=None) -> str:
+    # Fetch only the pushed commit (or the default branch when none was given) and return the resolved hash
+    with _lock(repo):
+        ensure_mirror(owner, repo)
+        if commit_hash and _rev_parse(repo, commit_hash):
+            return _rev_parse(repo, commit_hash)
+
+        shallow = [f"--depth={depth}"] if depth > 0 else []
+        try:
+            _git(repo, "fetch", "--no-tags", "--quiet", *shallow, "origin", commit_hash or "HEAD", cancel_event=cancel_event)
+        except subprocess.CalledProcessError:
+            if not commit_hash:
+                raise
+            # Servers that won't hand out a bare commit get a full fetch of every branch instead
+            unshallow = ["--unshallow"] if os.path.exists(os.path.join(mirror_path(repo), "shallow")) else []
+            _git(repo, "fetch", "--no-tags", "--quiet", *unshallow, "origin", "+refs/heads/*:refs/heads/*", cancel_event=cancel_event)
+
+        commit = _rev_parse(repo, commit_hash or "FETCH_HEAD")
+        if commit is None:
+            raise subprocess.CalledProcessError(1, ["git", "rev-parse", commit_hash or "FETCH_HEAD"])
+        return commit
+
+def parent_commit(owner: str, repo: str, commit_hash: str) -> Optional[str]:
+    # Shallow mirrors may not have the parent yet, one more commit of history is enough
+    with _lock(repo):
+        ensure_mirror(owner, repo)
+        parent = _rev_parse(repo, f"{commit_hash}^")
+        if parent is None:
+            _git(repo, "fetch", "--no-tags", "--quiet", "--depth=2", "origin", commit_hash)
+            parent = _rev_parse(repo, f"{commit_hash}^")
+        return parent
+
+def add_worktree(repo: str, job_id: str, commit_hash: str, cancel_event=None) -> str:
+    path = os.path.join(worktree_root(repo), job_id)
+    with _lock(repo):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(worktree_root(repo), exist_ok=True)
+        _git(repo, "worktree", "add", "--quiet", "--detach", "--force", path, commit_hash, cancel_event=cancel_event)
+    return path
+
+def data_dir(repo: str) -> str:
+    return os.path.abspath(os.path.join(PROJECT_DATA_DIR, repo))
+
+def link_data_dirs(repo: str, checkout: str, sources: List[str]) -> List[str]:
+    # Paths the commit doesn't have become links into the repository's data directory, so what a container writes
+    # there is still around for the next deploy and isn't deleted with the worktree. Paths git tracks stay as checked out
+    checkout = os.path.abspath(checkout)
+    legacy = os.path.abspath(os.path.join("projects", repo))
+    linked = []
+    for source in sources:
+        path = os.path.normpath(os.path.join(checkout, source))
+        if not path.startswith(checkout + os.sep) or os.path.lexists(path):
+            continue
+        relative = os.path.relpath(path, checkout)
+        target = os.path.join(data_dir(repo), relative)
+        # Versions before worktrees kept this data in the projects/<repo> clone, the first link takes it over from there
+        old_data = os.path.join(legacy, relative)
+        if not os.path.lexists(target) and os.path.lexists(old_data) and not os.path.islink(old_data):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            shutil.move(old_data, target)
+            print(f"Moved {old_data} to {target}")
+        elif not os.path.lexists(target):
+            os.makedirs(target)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.symlink(target, path)
+        linked.append(path)
+    return linked
+
+def finish_worktree(repo: str, job_id: str, deployed: bool) -> List[str]:
+    # A deployed worktree becomes the project's current checkout, then old ones past the budget are removed
+    root = worktree_root(repo)
+    path = os.path.join(root, job_id)
+    link = os.path.join(root, CURRENT)
+    if not os.path.isdir(root):
+        return []
+
+    with _lock(repo):
+        if deployed and os.path.isdir(path):
+            tmp_link = f"{link}.tmp"
+            if os.path.lexists(tmp_link):
+                os.remove(tmp_link)
+            os.symlink(job_id, tmp_link)
+            os.replace(tmp_link, link)
+        return _prune(repo)
+
+def prune_worktrees(repo: str, active=(), dry_run: bool = False) -> List[str]:
+    # Same budget as after a job, for worktrees no job finished, e.g. when the service died mid-build
+    if not os.path.isdir(worktree_root(repo)):
+        return []
+    with _lock(repo):
+        return _prune(repo, set(active), dry_run)
+
+def _prune(repo: str, active=frozenset(), dry_run: bool = False) -> List[str]:
+    root = worktree_root(repo)
+    link = os.path.join(root, CURRENT)
+    current = os.path.realpath(link) if os.path.isdir(link) else None
+    worktrees = sorted((entry for entry in os.scandir(root) if entry.is_dir(follow_symlinks=False) and os.path.realpath(entry.path) != current
+                        and entry.name not in active),
+                       key=lambda entry: entry.stat(follow_symlinks=False).st_mtime)
+    keep = max(GIT_WORKTREE_KEEP - (1 if current else 0), 0)
+    stale = worktrees[:max(len(worktrees) - keep, 0)]
+    if dry_run:
+        return [entry.path for entry in stale]
+
+    removed = []
+    for entry in stale:
+        try:
+            _git(repo, "worktree", "remove", "--force", entry.path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except subprocess.CalledProcessError:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        removed.append(entry.path)
+    if removed:
+        subprocess.run(["git", "--git-dir", mirror_path(repo), "worktree", "prune"], check=False)
+    return removed
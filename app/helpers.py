@@ -1,38 +1,18 @@
-from hashlib import sha1
-import hmac, os , sqlite3, socket
+from hashlib import sha1, sha256
+from typing import Optional, Dict
+import hmac, os , sqlite3, socket, subprocess
 from fastapi import HTTPException
+import vault
 
 GITHUB_WEBHOOK_SECRET = os.getenv("GITHUB_WEBHOOK_SECRET")
 
-def set_project_env(envs):
+def project_env(envs: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    # One environment per job for docker-compose to substitute from, builds running side by side never see each other's secrets
+    return {**os.environ, **(envs or {})}
 
-    for key, value in envs.items():
-        os.environ[key] = value
-        print(f"set key as : {key}")
-    
 def get_vault_secrets(project_name: str, connection_pool, crypt):
-    env_variables = {}
-
-    try:
-        with connection_pool.get_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT variable_name, variable_value FROM project_environment_variables WHERE project_name = ?",
-                (project_name,)
-            )
-            rows = cursor.fetchall()
-
-            for row in rows:
-                variable_name = row[0]
-                encrypted_value = row[1]
-                decrypted_value = crypt.de(encrypted_value)  # Decrypt the value
-                env_variables[variable_name] = decrypted_value
-
-    except sqlite3.Error as e:
-        # Handle the error as needed
-        print(f"Error retrieving environment variables: {e}")
-
-    return env_variables
+    # Served from the decrypted per-project cache
+    return vault.get_secrets(project_name, connection_pool, crypt)
 
 def get_container_ip():
 
@@ -44,11 +24,16 @@ def get_container_ip():
 
     return container_ip
 
-def verify_signature(payload: bytes, signature: str):
+def verify_signature(payload: bytes, signature_256: Optional[str], signature: Optional[str] = None):
+    # X-Hub-Signature-256 when GitHub sent it, the SHA-1 header only for senders that don't
     if GITHUB_WEBHOOK_SECRET:
         secret = bytes(GITHUB_WEBHOOK_SECRET, "utf-8")
-        hashed_payload = hmac.new(secret, payload, sha1).hexdigest()
-        expected_signature = f"sha1={hashed_payload}"
+        if signature_256:
+            expected_signature, signature = f"sha256={hmac.new(secret, payload, sha256).hexdigest()}", signature_256
+        elif signature:
+            expected_signature = f"sha1={hmac.new(secret, payload, sha1).hexdigest()}"
+        else:
+            raise HTTPException(status_code=401, detail="Missing signature")
         if not hmac.compare_digest(expected_signature, signature):
             raise HTTPException(status_code=401, detail="Invalid signature")
 
@@ -69,15 +54,145 @@ def first_time_database_init(connection_pool):
                             project_name TEXT,
                             variable_name TEXT,
                             variable_value TEXT)''')
+
+            # Deployments waiting for, or held by, a build worker
+            cur.execute('''CREATE TABLE IF NOT EXISTS build_queue (
+                            id TEXT PRIMARY KEY,
+                            owner TEXT,
+                            repo TEXT,
+                            commit_hash TEXT,
+                            webhook INTEGER DEFAULT 0,
+                            revert INTEGER DEFAULT 0,
+                            status TEXT DEFAULT 'queued',
+                            enqueued_at REAL,
+                            not_before REAL,
+                            started_at REAL,
+                            finished_at REAL)''')
+
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_build_queue_status ON build_queue (status, enqueued_at)")
+
+            # Every vault write snapshots the project's full secret set, jobs point at the version they deployed with
+            cur.execute('''CREATE TABLE IF NOT EXISTS vault_versions (
+                            id INTEGER PRIMARY KEY,
+                            project_name TEXT,
+                            version INTEGER,
+                            created_at REAL,
+                            variable_count INTEGER,
+                            secrets BLOB,
+                            UNIQUE (project_name, version))''')
+
+            # Start and end of every stage a deploy job went through, read back by /jobs/{id}/timeline
+            cur.execute('''CREATE TABLE IF NOT EXISTS job_stages (
+                            id INTEGER PRIMARY KEY,
+                            job_id TEXT,
+                            project_name TEXT,
+                            stage TEXT,
+                            started_at REAL,
+                            finished_at REAL,
+                            duration REAL,
+                            status TEXT)''')
+
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_job_stages_job ON job_stages (job_id, started_at)")
+
+            # Every webhook delivery as it arrived, keyed by GitHub's delivery id so retries are only stored once
+            cur.execute('''CREATE TABLE IF NOT EXISTS webhook_inbox (
+                            delivery_id TEXT PRIMARY KEY,
+                            event TEXT,
+                            received_at REAL,
+                            payload BLOB,
+                            status TEXT DEFAULT 'pending',
+                            processed_at REAL,
+                            job_id TEXT,
+                            error TEXT)''')
+
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_webhook_inbox_status ON webhook_inbox (status, received_at)")
+
+            # What every garbage collection removed, or would have in a dry run
+            cur.execute('''CREATE TABLE IF NOT EXISTS gc_runs (
+                            id INTEGER PRIMARY KEY,
+                            started_at REAL,
+                            finished_at REAL,
+                            dry_run INTEGER,
+                            reclaimed_bytes INTEGER,
+                            report TEXT)''')
+
+            migrate_database(cur)
             conn.commit()
 
     except sqlite3.Error as e:
         print(f"Error logging build request: {e}")
 
+def add_missing_columns(cur, table: str, columns: dict):
+    cur.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in cur.fetchall()}
+    for column, definition in columns.items():
+        if column not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def migrate_database(cur):
+    # Columns added after the first release, CREATE TABLE IF NOT EXISTS won't add them to existing databases
+    add_missing_columns(cur, "build_queue", {"not_before": "REAL", "log_offset": "INTEGER", "log_file": "TEXT", "secret_version": "INTEGER",
+                                             "rollback_of": "TEXT", "context_hash": "TEXT", "build_cache": "TEXT",
+                                             "push_duration": "REAL", "push_bytes": "INTEGER"})
+    add_missing_columns(cur, "jobs", {"created_at": "REAL", "finished_at": "REAL", "duration": "REAL", "log_offset": "INTEGER", "log_end": "INTEGER",
+                                      "secret_version": "INTEGER", "images": "TEXT", "rollback_of": "TEXT",
+                                      "context_hash": "TEXT", "build_cache": "TEXT", "push_duration": "REAL", "push_bytes": "INTEGER"})
+
+    # Jobs logged before timestamps existed sort as the oldest ones
+    cur.execute("UPDATE jobs SET created_at = 0 WHERE created_at IS NULL")
+
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_at, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_project_created ON jobs (project_id, created_at, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_project_context ON jobs (project_id, context_hash)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_project_status ON jobs (project_id, status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at, id)")
+
+    # Concurrent vault writes used to be able to insert the same variable twice, keep the newest row before enforcing uniqueness
+    cur.execute('''DELETE FROM project_environment_variables WHERE id NOT IN
+                   (SELECT MAX(id) FROM project_environment_variables GROUP BY project_name, variable_name)''')
+    cur.execute("DROP INDEX IF EXISTS idx_project_env_project_variable")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS uq_project_env_project_variable ON project_environment_variables (project_name, variable_name)")
+
 def is_valid_kubeconfig(config_content: str) -> bool:
     # Perform basic validation by checking for common kubeconfig keywords
     required_keywords = ["apiVersion", "kind", "clusters", "users", "contexts"]
     for keyword in required_keywords:
         if keyword not in config_content:
             return False
-    return True
\ No newline at end of file
+    return True
+
+class BuildCancelled(Exception):
+    pass
+
+def run_cancellable(command, cancel_event=None, check=False, poll_interval: float = 0.5, input=None, capture_output: bool = False,
+                    **kwargs) -> subprocess.CompletedProcess:
+    # subprocess.run that kills the child process as soon as the build gets cancelled
+    if cancel_event is None:
+        return subprocess.run(command, check=check, input=input, capture_output=capture_output, **kwargs)
+
+    if cancel_event.is_set():
+        raise BuildCancelled(" ".join(command))
+
+    if capture_output:
+        kwargs["stdout"] = kwargs["stderr"] = subprocess.PIPE
+    if input is not None:
+        kwargs.setdefault("stdin", subprocess.PIPE)
+
+    with subprocess.Popen(command, **kwargs) as process:
+        # communicate keeps draining piped output while polling, a child never blocks on a full pipe
+        while True:
+            try:
+                stdout, stderr = process.communicate(input, timeout=poll_interval)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_event.is_set():
+                    process.terminate()
+                    try:
+                        process.communicate(timeout=10)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+                    raise BuildCancelled(" ".join(command))
+
+    if check and process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+    return subprocess.CompletedProcess(command, process.returncode, stdout, stderr)
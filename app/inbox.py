@@ -0,0 +1,84 @@
+import os, time, json, sqlite3, threading
+from typing import Callable, Optional, Dict
+
+# How often the dispatcher re-checks the inbox when nobody wakes it up (seconds)
+INBOX_POLL_INTERVAL = float(os.getenv("WEBHOOK_INBOX_POLL_INTERVAL", "2"))
+
+class WebhookInbox:
+    # Deliveries are stored before the webhook is answered and turned into builds by a thread of their own
+
+    def __init__(self, connection_pool, handler: Callable[[str, Dict], Optional[str]]):
+        self.connection_pool = connection_pool
+        self.handler = handler
+        self._thread = None
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def receive(self, delivery_id: str, event: str, body: bytes) -> bool:
+        # GitHub retries with the same delivery id, only the first copy is kept
+        with self.connection_pool.get_connection() as conn:
+            cur = conn.execute('''INSERT INTO webhook_inbox (delivery_id, event, received_at, payload, status) VALUES (?, ?, ?, ?, 'pending')
+                                  ON CONFLICT (delivery_id) DO NOTHING''', (delivery_id, event, time.time(), body))
+        accepted = cur.rowcount == 1
+        if accepted:
+            self.notify()
+        return accepted
+
+    def notify(self):
+        self._wakeup.set()
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="webhook-inbox", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stopping.set()
+        self.notify()
+        if self._thread:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def pending(self) -> int:
+        with self.connection_pool.get_connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM webhook_inbox WHERE status = 'pending'").fetchone()[0]
+
+    def drain(self) -> int:
+        # Oldest first, a delivery left pending by a crash is simply picked up again
+        processed = 0
+        while not self._stopping.is_set():
+            with self.connection_pool.get_connection() as conn:
+                row = conn.execute("SELECT delivery_id, event, payload FROM webhook_inbox WHERE status = 'pending' ORDER BY received_at LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._process(*row)
+            processed += 1
+        return processed
+
+    def _process(self, delivery_id: str, event: str, body: bytes):
+        status, job_id, error = "processed", None, None
+        try:
+            job_id = self.handler(event, json.loads(body))
+            if job_id is None:
+                status = "ignored"
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            # A payload that can't be handled now never will be, keep it for inspection and move on
+            print(f"Error processing webhook delivery {delivery_id}: {e}")
+            status, error = "failed", str(e)
+
+        with self.connection_pool.get_connection() as conn:
+            conn.execute("UPDATE webhook_inbox SET status = ?, processed_at = ?, job_id = ?, error = ? WHERE delivery_id = ?",
+                         (status, time.time(), job_id, error, delivery_id))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            # Cleared before draining so a delivery stored meanwhile still wakes the next pass
+            self._wakeup.clear()
+            try:
+                self.drain()
+            except sqlite3.Error as e:
+                # The delivery stays pending and is retried on the next pass
+                print(f"Error draining webhook inbox: {e}")
+            self._wakeup.wait(INBOX_POLL_INTERVAL)
@@ -0,0 +1,414 @@
+import os, re, json, time, shutil, sqlite3, threading, subprocess
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Set, Tuple
+from docker_api import DockerError, DockerUnavailable
+from containerlogs import parse_time
+import dockr, gitcache, buildlogs, metrics
+
+# Successful releases per project whose images stay on this host, older ones can still be pulled back from the registry to roll back
+GC_KEEP_RELEASES = int(os.getenv("GC_KEEP_RELEASES", "5"))
+# How often the collector runs (seconds), 0 leaves it to POST /gc and low disk
+GC_INTERVAL = float(os.getenv("GC_INTERVAL", str(6 * 3600)))
+# Less free space than this (percent of the disk holding projects/ and build_logs/) starts a run right away
+GC_MIN_FREE_PERCENT = float(os.getenv("GC_MIN_FREE_PERCENT", "10"))
+# How often free space is checked (seconds)
+GC_CHECK_INTERVAL = float(os.getenv("GC_CHECK_INTERVAL", "60"))
+# Builder cache not used for this long is pruned ("30m", "12h", "7d")
+GC_BUILD_CACHE_UNTIL = os.getenv("GC_BUILD_CACHE_UNTIL", "7d")
+# Exited containers of a project are removed once they have been stopped this long (seconds)
+GC_CONTAINER_MAX_AGE = float(os.getenv("GC_CONTAINER_MAX_AGE", str(24 * 3600)))
+# projects/<repo> clones from before worktrees may hold a compose project's ./data bind mounts, they are only removed when this is on
+GC_REMOVE_CHECKOUTS = os.getenv("GC_REMOVE_CHECKOUTS", "false").lower() in ("1", "true", "yes")
+# Only report what would be removed, for scheduled runs and POST /gc without ?dry_run
+GC_DRY_RUN = os.getenv("GC_DRY_RUN", "false").lower() in ("1", "true", "yes")
+
+# A low disk that collecting can't fix shouldn't turn into back to back runs
+LOW_DISK_COOLDOWN = 900
+SIZE = re.compile(r"^([\d.]+)\s*([kKMGTP]?)i?B$")
+UNITS = {"": 1, "k": 1000, "K": 1000, "M": 1000 ** 2, "G": 1000 ** 3, "T": 1000 ** 4, "P": 1000 ** 5}
+
+def parse_size(value: str) -> int:
+    # The docker CLI prints sizes like "1.2GB" or "512kB"
+    match = SIZE.match(value.strip().split(" ")[0])
+    return int(float(match.group(1)) * UNITS[match.group(2)]) if match else 0
+
+def disk_usage(path: str) -> int:
+    # Blocks actually allocated, a directory tree is walked without following links
+    if not os.path.lexists(path):
+        return 0
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_blocks * 512
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+def _finished_at(value: Optional[str]) -> float:
+    # Docker's RFC3339 with nanoseconds, only seconds matter here
+    try:
+        return datetime.fromisoformat(value[:19]).replace(tzinfo=timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return 0
+
+def _owned_by(name: str, project_name: str) -> bool:
+    # The project's own container, its blue/green candidates and its compose services
+    name, project = name.lower(), project_name.lower()
+    return name == project or name.startswith(f"{project}-") or name.startswith(f"{dockr.compose_project_name(project_name)}-")
+
+class Janitor:
+    # Removes what builds leave behind on the host: old release images, dangling layers, builder cache, stale containers,
+    # worktrees and checkouts no job needs any more, and build logs past their retention
+
+    def __init__(self, connection_pool, logs_dir: str = buildlogs.LOGS_DIR, projects_dir: str = "projects"):
+        self.connection_pool = connection_pool
+        self.logs_dir = logs_dir
+        self.projects_dir = projects_dir
+        self._running = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._last_run = 0.0
+
+    def start(self):
+        if self._thread:
+            return
+        self._stopping.clear()
+        # The first scheduled run is an interval away, a restart loop shouldn't turn into a collection loop
+        self._last_run = time.time()
+        self._thread = threading.Thread(target=self._run, name="janitor", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def low_on_disk(self, path: str = ".") -> bool:
+        usage = shutil.disk_usage(path)
+        return usage.free * 100 < usage.total * GC_MIN_FREE_PERCENT
+
+    def _run(self):
+        while not self._stopping.wait(GC_CHECK_INTERVAL):
+            since_last = time.time() - self._last_run
+            try:
+                due = GC_INTERVAL and since_last >= GC_INTERVAL
+                if due or (since_last >= LOW_DISK_COOLDOWN and self.low_on_disk()):
+                    self.collect()
+            except (OSError, sqlite3.Error) as e:
+                print(f"Error collecting garbage: {e}")
+
+    # policy
+
+    def active_jobs(self) -> Set[str]:
+        with self.connection_pool.get_connection() as conn:
+            return {row[0] for row in conn.execute("SELECT id FROM build_queue WHERE status IN ('queued', 'running')")}
+
+    def projects(self) -> List[str]:
+        with self.connection_pool.get_connection() as conn:
+            return [row[0] for row in conn.execute("SELECT name FROM projects ORDER BY name")]
+
+    def release_tags(self, keep: int = GC_KEEP_RELEASES) -> Tuple[Set[str], Set[str]]:
+        # Release tags of the newest `keep` successful jobs per project are kept, the older ones may go
+        # unless a kept job reuses them (an unchanged build context records the earlier build's images)
+        with self.connection_pool.get_connection() as conn:
+            rows = conn.execute('''SELECT p.name, j.images FROM jobs j JOIN projects p ON p.id = j.project_id
+                                   WHERE j.status = 'success' AND j.images IS NOT NULL ORDER BY p.name, j.created_at DESC''').fetchall()
+        kept, old, seen = set(), set(), {}
+        for project_name, images in rows:
+            try:
+                tags = set(json.loads(images).values())
+            except ValueError:
+                continue
+            seen[project_name] = seen.get(project_name, 0) + 1
+            (kept if seen[project_name] <= keep else old).update(tags)
+        return kept, old - kept
+
+    # collection
+
+    def collect(self, dry_run: bool = GC_DRY_RUN, keep_releases: int = GC_KEEP_RELEASES) -> Optional[Dict]:
+        # None when a collection is already running
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            started = time.time()
+            self._last_run = started
+            report = {"dry_run": dry_run, "started_at": started, "reclaimed_bytes": 0, "sections": {}}
+            # Containers go before images, an image is only freed once no container uses it
+            steps = [("containers", self._containers), ("images", lambda section, dry_run: self._images(section, dry_run, keep_releases)),
+                     ("dangling_images", self._dangling_images), ("build_cache", self._build_cache), ("worktrees", self._worktrees),
+                     ("checkouts", self._checkouts), ("logs", self._logs)]
+            for kind, step in steps:
+                section = {"removed": [], "bytes": 0}
+                try:
+                    step(section, dry_run)
+                except (DockerError, OSError, ValueError, sqlite3.Error, subprocess.CalledProcessError) as e:
+                    print(f"Error collecting {kind}: {e}")
+                    section["error"] = str(e)
+                report["sections"][kind] = section
+                report["reclaimed_bytes"] += section["bytes"]
+                if not dry_run and section["bytes"]:
+                    metrics.GC_RECLAIMED_BYTES.inc(section["bytes"], kind=kind)
+
+            report["finished_at"] = time.time()
+            report["duration"] = report["finished_at"] - started
+            print(f"Garbage collection {'would reclaim' if dry_run else 'reclaimed'} {report['reclaimed_bytes']} bytes in {report['duration']:.1f}s")
+            self.save(report)
+            return report
+        finally:
+            self._running.release()
+
+    def save(self, report: Dict):
+        try:
+            with self.connection_pool.get_connection() as conn:
+                conn.execute("INSERT INTO gc_runs (started_at, finished_at, dry_run, reclaimed_bytes, report) VALUES (?, ?, ?, ?, ?)",
+                             (report["started_at"], report["finished_at"], int(report["dry_run"]), report["reclaimed_bytes"], json.dumps(report)))
+        except sqlite3.Error as e:
+            print(f"Error saving garbage collection report: {e}")
+
+    def runs(self, limit: int = 10) -> List[Dict]:
+        with self.connection_pool.get_connection() as conn:
+            rows = conn.execute("SELECT id, report FROM gc_runs ORDER BY started_at DESC LIMIT ?", (limit,)).fetchall()
+        return [{"id": run_id, **json.loads(report)} for run_id, report in rows]
+
+    def _containers(self, section: Dict, dry_run: bool):
+        # Exited for longer than GC_CONTAINER_MAX_AGE, e.g. blue/green candidates left behind when the service died mid-deploy
+        cutoff = time.time() - GC_CONTAINER_MAX_AGE
+        for project_name in self.projects():
+            for container in dockr.get_project_containers(project_name):
+                name = container["container_name"]
+                if container["status"] not in ("exited", "dead") or not _owned_by(name, project_name):
+                    continue
+                if not 0 < _finished_at(container.get("finished_at")) < cutoff:
+                    continue
+                size = self._container_size(name)
+                if not dry_run:
+                    try:
+                        self._remove_container(name)
+                    except (DockerError, subprocess.CalledProcessError) as e:
+                        print(f"Error removing container {name}: {e}")
+                        continue
+                section["removed"].append(name)
+                section["bytes"] += size
+
+    def _container_size(self, name: str) -> int:
+        if dockr.docker.available():
+            try:
+                return dockr.docker.inspect_container(name, size=True).get("SizeRw") or 0
+            except DockerUnavailable as e:
+                print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+        result = subprocess.run(["docker", "ps", "-a", "--size", "--filter", f"name=^{name}$", "--format", "{{.Size}}"], capture_output=True, text=True)
+        return parse_size(result.stdout.strip()) if result.returncode == 0 and result.stdout.strip() else 0
+
+    def _remove_container(self, name: str):
+        # Never forced, a container started again in the meantime stays
+        if dockr.docker.available():
+            try:
+                return dockr.docker.remove_container(name)
+            except DockerUnavailable as e:
+                print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+        subprocess.run(["docker", "rm", name], check=True, capture_output=True)
+
+    def _images(self, section: Dict, dry_run: bool, keep_releases: int):
+        # Old release tags and the registry copies docker_push_images tagged next to them
+        _, old = self.release_tags(keep_releases)
+        tags = set()
+        for release in old:
+            tags.update((release, f"{dockr.REGISTRY_URL}/{release}"))
+        if not tags:
+            return
+
+        if dockr.docker.available():
+            try:
+                return self._api_images(section, dry_run, tags)
+            except DockerUnavailable as e:
+                print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+
+        counted = set()
+        for tag in sorted(tags):
+            result = subprocess.run(["docker", "image", "inspect", "--format", '{{.Id}} {{.Size}} {{join .RepoTags " "}}', tag],
+                                    capture_output=True, text=True)
+            if result.returncode != 0:
+                continue
+            image_id, size, *image_tags = result.stdout.split()
+            if dry_run:
+                section["removed"].append(tag)
+                # Only freed once every tag of the image goes
+                if set(image_tags) <= tags and image_id not in counted:
+                    counted.add(image_id)
+                    section["bytes"] += int(size)
+                continue
+            removed = subprocess.run(["docker", "image", "rm", tag], capture_output=True, text=True)
+            if removed.returncode != 0:
+                print(f"Error removing image {tag}: {removed.stderr.strip()}")
+                continue
+            section["removed"].append(tag)
+            if "Deleted:" in removed.stdout:
+                section["bytes"] += int(size)
+
+    def _api_images(self, section: Dict, dry_run: bool, tags: Set[str]):
+        # /system/df knows how much of each image is shared with others, only the rest is freed by deleting it
+        for image in dockr.docker.disk_usage().get("Images") or []:
+            image_tags = set(image.get("RepoTags") or [])
+            doomed = sorted(image_tags & tags)
+            if not doomed:
+                continue
+            unique = image.get("Size", 0) - max(image.get("SharedSize", 0), 0)
+            freed = image_tags <= tags and not image.get("Containers", 0) > 0
+            if dry_run:
+                section["removed"].extend(doomed)
+                section["bytes"] += unique if freed else 0
+                continue
+
+            deleted = False
+            for tag in doomed:
+                try:
+                    deleted = any("Deleted" in entry for entry in dockr.docker.remove_image(tag)) or deleted
+                    section["removed"].append(tag)
+                except DockerError as e:
+                    if isinstance(e, DockerUnavailable):
+                        raise
+                    # 409: a container still runs from it
+                    print(f"Error removing image {tag}: {e}")
+            section["bytes"] += unique if deleted else 0
+
+    def _dangling_images(self, section: Dict, dry_run: bool):
+        # Layers left untagged when a newer build took over the name
+        if dockr.docker.available():
+            try:
+                if dry_run:
+                    for image in dockr.docker.disk_usage().get("Images") or []:
+                        if set(image.get("RepoTags") or ["<none>:<none>"]) <= {"<none>:<none>"} and not image.get("Containers", 0) > 0:
+                            section["removed"].append(image["Id"])
+                            section["bytes"] += image.get("Size", 0) - max(image.get("SharedSize", 0), 0)
+                    return
+                result = dockr.docker.prune_images({"dangling": ["true"]})
+                section["removed"].extend(entry.get("Deleted") for entry in result.get("ImagesDeleted") or [] if entry.get("Deleted"))
+                section["bytes"] += result.get("SpaceReclaimed") or 0
+                return
+            except DockerUnavailable as e:
+                print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+
+        if dry_run:
+            result = subprocess.run(["docker", "images", "--filter", "dangling=true", "--format", "{{.ID}} {{.Size}}"], capture_output=True, text=True, check=True)
+            for line in result.stdout.splitlines():
+                image_id, size = line.split(" ", 1)
+                section["removed"].append(image_id)
+                section["bytes"] += parse_size(size)
+            return
+        result = subprocess.run(["docker", "image", "prune", "--force", "--filter", "dangling=true"], capture_output=True, text=True, check=True)
+        self._cli_reclaimed(section, result.stdout)
+
+    def _build_cache(self, section: Dict, dry_run: bool):
+        until = GC_BUILD_CACHE_UNTIL
+        if dockr.docker.available():
+            try:
+                if dry_run:
+                    cutoff = parse_time(until)
+                    for entry in dockr.docker.disk_usage().get("BuildCache") or []:
+                        if entry.get("InUse") or entry.get("Shared"):
+                            continue
+                        if _finished_at(entry.get("LastUsedAt") or entry.get("CreatedAt")) < cutoff:
+                            section["removed"].append(entry.get("ID"))
+                            section["bytes"] += entry.get("Size", 0)
+                    return
+                # The builder takes Go durations, "7d" isn't one
+                result = dockr.docker.prune_build_cache({"until": [f"{int(time.time() - parse_time(until))}s"]})
+                section["removed"].extend(result.get("CachesDeleted") or [])
+                section["bytes"] += result.get("SpaceReclaimed") or 0
+                return
+            except DockerUnavailable as e:
+                print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+
+        if dry_run:
+            # The CLI has no dry run for the builder, report everything it could reclaim
+            result = subprocess.run(["docker", "system", "df", "--format", "{{.Type}}\t{{.Reclaimable}}"], capture_output=True, text=True, check=True)
+            for line in result.stdout.splitlines():
+                kind, _, reclaimable = line.partition("\t")
+                if kind == "Build Cache":
+                    section["bytes"] += parse_size(reclaimable)
+            return
+        result = subprocess.run(["docker", "builder", "prune", "--force", "--filter", f"until={int(time.time() - parse_time(until))}s"],
+                                capture_output=True, text=True, check=True)
+        self._cli_reclaimed(section, result.stdout)
+
+    @staticmethod
+    def _cli_reclaimed(section: Dict, output: str):
+        for line in output.splitlines():
+            if line.startswith("deleted:") or line.startswith("Deleted"):
+                section["removed"].append(line.split(":", 1)[-1].strip())
+            elif line.startswith("Total"):
+                section["bytes"] += parse_size(line.split(":", 1)[-1])
+
+    def _worktrees(self, section: Dict, dry_run: bool):
+        # Worktrees no finished job cleaned up, the deployed one and those of queued or running jobs stay
+        if not os.path.isdir(gitcache.GIT_WORKTREE_DIR):
+            return
+        active = self.active_jobs()
+        for repo in sorted(os.listdir(gitcache.GIT_WORKTREE_DIR)):
+            stale = gitcache.prune_worktrees(repo, active, dry_run=True)
+            sizes = {path: disk_usage(path) for path in stale}
+            for path in stale if dry_run else gitcache.prune_worktrees(repo, active):
+                section["removed"].append(path)
+                section["bytes"] += sizes.get(path, 0)
+
+    def _mount_sources(self) -> List[str]:
+        # Host paths bind mounted into any container, stopped ones included
+        if dockr.docker.available():
+            try:
+                return [mount["Source"] for container in dockr.docker.containers(all=True) for mount in container.get("Mounts") or [] if mount.get("Source")]
+            except DockerUnavailable as e:
+                print(f"Docker API unavailable, falling back to the docker CLI: {e}")
+        ids = subprocess.run(["docker", "ps", "-a", "-q"], capture_output=True, text=True, check=True).stdout.split()
+        if not ids:
+            return []
+        result = subprocess.run(["docker", "inspect", "--format", "{{range .Mounts}}{{.Source}}\n{{end}}", *ids], capture_output=True, text=True, check=True)
+        return [line for line in result.stdout.splitlines() if line.strip()]
+
+    def _checkouts(self, section: Dict, dry_run: bool):
+        # projects/<repo> clones from before worktrees, unused once the project has deployed from a worktree,
+        # unless a container still mounts something from them. Listed either way, removed only with GC_REMOVE_CHECKOUTS
+        root = os.path.abspath(self.projects_dir)
+        internal = {os.path.abspath(gitcache.GIT_WORKTREE_DIR), os.path.abspath(gitcache.GIT_MIRROR_DIR), os.path.abspath(gitcache.PROJECT_DATA_DIR)}
+        if not os.path.isdir(root):
+            return
+        candidates = [entry.path for entry in sorted(os.scandir(root), key=lambda entry: entry.name)
+                      if entry.is_dir(follow_symlinks=False) and entry.path not in internal
+                      and os.path.isdir(os.path.join(gitcache.worktree_root(entry.name), gitcache.CURRENT))]
+        if not candidates:
+            return
+
+        # Can't tell what is mounted, so nothing goes (a DockerError here fails the section)
+        sources = [os.path.abspath(source) for source in self._mount_sources()]
+        section["skipped"] = []
+        for path in candidates:
+            if any(source == path or source.startswith(path + os.sep) for source in sources):
+                section["skipped"].append({"path": path, "reason": "mounted by a container"})
+                continue
+            if not GC_REMOVE_CHECKOUTS:
+                section["skipped"].append({"path": path, "reason": "GC_REMOVE_CHECKOUTS is off"})
+                continue
+            size = disk_usage(path)
+            if not dry_run:
+                shutil.rmtree(path)
+            section["removed"].append(path)
+            section["bytes"] += size
+
+    def _logs(self, section: Dict, dry_run: bool):
+        # The retention finish_job_log applies, also for projects that haven't built in a while
+        if not os.path.isdir(self.logs_dir):
+            return
+        active = [buildlogs.job_log_name(job_id) for job_id in self.active_jobs()]
+        for entry in sorted(os.scandir(self.logs_dir), key=lambda entry: entry.name):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            # Kept logs count against the budget, so only name the ones in this project
+            keep = [name for name in active if os.path.exists(os.path.join(entry.path, name))]
+            stale = buildlogs.apply_retention(entry.name, keep=keep, logs_dir=self.logs_dir, dry_run=True)
+            sizes = {path: disk_usage(path) for path in stale}
+            for path in stale if dry_run else buildlogs.apply_retention(entry.name, keep=keep, logs_dir=self.logs_dir):
+                section["removed"].append(path)
+                section["bytes"] += sizes.get(path, 0)
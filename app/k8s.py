@@ -1,32 +1,94 @@
-import yaml
-from jinja2 import Template
+import os, re, glob, hashlib, yaml
+from typing import Optional, List, Dict, Union
+from jinja2 import Environment, FileSystemLoader
 
+# Every *.yml in here is rendered once per compose service
+MANIFEST_TEMPLATE_DIR = os.getenv("MANIFEST_TEMPLATE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "manifests"))
 
 class ManifestGen():
 
-    deployment_template_file = "manifests/deployment_template.yml"  # Path to your deployment template file
-    service_template_file = "manifests/service_template.yml"  # Path to your service template file
+    def __init__(self, template_dir: str = MANIFEST_TEMPLATE_DIR):
+        # trim/lstrip keep the {% for %} lines from leaving blank, indented lines in the YAML
+        self.environment = Environment(loader=FileSystemLoader(template_dir), trim_blocks=True, lstrip_blocks=True, keep_trailing_newline=True)
+        # Compiled once, every render after that is just the template code running
+        self.templates = {os.path.basename(path): self.environment.get_template(os.path.basename(path))
+                          for path in sorted(glob.glob(os.path.join(template_dir, "*.yml")))}
+        # Digest of the last output per (project, service, template), what hasn't changed isn't emitted again
+        self._digests: Dict[tuple, str] = {}
 
-    def load_template(template_file):
-        with open(template_file, 'r') as f:
-            return yaml.safe_load(f)
+    @staticmethod
+    def resource_name(name: str) -> str:
+        # Compose allows names Kubernetes doesn't (underscores, capitals)
+        return re.sub(r"[^a-z0-9-]+", "-", name.lower()).strip("-")
 
-    def generate_kubernetes_manifests(self, compose_file):
-        deployment_template = self.load_template(self.deployment_template_file)
-        service_template = self.load_template(self.service_template_file)
+    @staticmethod
+    def container_ports(ports) -> List[int]:
+        # "8080:80", "127.0.0.1:8080:80/tcp", 80 and {target: 80} all expose container port 80
+        result = []
+        for port in ports or []:
+            target = port.get("target") if isinstance(port, dict) else str(port).split(":")[-1].split("/")[0]
+            if target and str(target).isdigit():
+                result.append(int(target))
+        return result
 
-        with open(compose_file, 'r') as f:
-            docker_compose = yaml.safe_load(f)
+    def load_compose(self, compose: Union[str, Dict]) -> Dict:
+        if isinstance(compose, dict):
+            return compose
+        with open(compose, "r") as f:
+            return yaml.safe_load(f) or {}
 
-        for service_name, service_config in docker_compose['services'].items():
-            # Render Deployment YAML
-            deployment_yaml = Template(yaml.dump(deployment_template)).render(service_name=service_name, **service_config)
+    def render(self, compose: Union[str, Dict], project_name: Optional[str] = None) -> List[Dict]:
+        # Every service of a compose file through every template, in memory
+        docker_compose = self.load_compose(compose)
+        manifests = []
+        for service_name, service_config in (docker_compose.get("services") or {}).items():
+            service_config = service_config or {}
+            context = {**service_config, "service_name": self.resource_name(service_name), "project_name": project_name,
+                       "image": service_config.get("image", self.resource_name(service_name)),
+                       "ports": self.container_ports(service_config.get("ports") or service_config.get("expose"))}
+            for template_name, template in self.templates.items():
+                text = template.render(**context)
+                # A template may render nothing for a service, e.g. no Service for one without ports
+                if not text.strip():
+                    continue
+                manifests.append({"project": project_name, "service": service_name, "template": template_name, "text": text,
+                                  "digest": hashlib.sha256(text.encode()).hexdigest()})
+        return manifests
 
-            # Render Service YAML
-            service_yaml = Template(yaml.dump(service_template)).render(service_name=service_name, **service_config)
+    def render_many(self, projects: Dict[str, Union[str, Dict]]) -> List[Dict]:
+        # project name -> compose file (or already parsed compose), all rendered in one pass
+        return [manifest for project_name, compose in projects.items() for manifest in self.render(compose, project_name)]
 
-            # Write to files
-            with open(f'{service_name}_deployment.yml', 'w') as deployment_file:
-                deployment_file.write(deployment_yaml)
-            with open(f'{service_name}_service.yml', 'w') as service_file:
-                service_file.write(service_yaml)
\ No newline at end of file
+    def changed(self, manifests: List[Dict]) -> List[Dict]:
+        # Only what differs from the last time it was emitted, the digests are updated as a side effect
+        result = []
+        for manifest in manifests:
+            key = (manifest["project"], manifest["service"], manifest["template"])
+            if self._digests.get(key) != manifest["digest"]:
+                self._digests[key] = manifest["digest"]
+                result.append(manifest)
+        return result
+
+    def forget(self, project_name: Optional[str] = None):
+        # Next render of the project is emitted in full, e.g. after the cluster was reset
+        self._digests = {key: digest for key, digest in self._digests.items() if project_name is not None and key[0] != project_name}
+
+    @staticmethod
+    def to_stream(manifests: List[Dict]) -> str:
+        return "".join(f"---\n{manifest['text'].rstrip()}\n" for manifest in manifests)
+
+    @staticmethod
+    def to_objects(manifests: List[Dict]) -> List[Dict]:
+        return [yaml.safe_load(manifest["text"]) for manifest in manifests]
+
+    def generate_kubernetes_manifests(self, compose_file: str, project_name: Optional[str] = None, only_changed: bool = True,
+                                      output_file: Optional[str] = None) -> str:
+        # One multi-document stream for the whole compose file, empty when nothing changed since the last call
+        manifests = self.render(compose_file, project_name)
+        if only_changed:
+            manifests = self.changed(manifests)
+        stream = self.to_stream(manifests)
+        if output_file and stream:
+            with open(output_file, "w") as f:
+                f.write(stream)
+        return stream
@@ -0,0 +1,108 @@
+import os, time, asyncio, httpx
+from typing import Optional
+
+# kube-o-matic, the CD service started with `make cd`
+KUBE_O_MATIC_URL = os.getenv("KUBE_O_MATIC_URL", "http://kube-o-matic:8555")
+# Per request, connecting included (seconds)
+KUBE_O_MATIC_TIMEOUT = float(os.getenv("KUBE_O_MATIC_TIMEOUT", "10"))
+# Extra attempts after a connection error or a 502/503/504, waiting KUBE_O_MATIC_BACKOFF seconds, doubled each time
+KUBE_O_MATIC_RETRIES = int(os.getenv("KUBE_O_MATIC_RETRIES", "2"))
+KUBE_O_MATIC_BACKOFF = float(os.getenv("KUBE_O_MATIC_BACKOFF", "0.5"))
+# How long a health probe result is trusted (seconds)
+KUBE_O_MATIC_HEALTH_TTL = float(os.getenv("KUBE_O_MATIC_HEALTH_TTL", "30"))
+# Kept-alive connections to the service
+KUBE_O_MATIC_MAX_CONNECTIONS = int(os.getenv("KUBE_O_MATIC_MAX_CONNECTIONS", "10"))
+# Released kube-o-matic only takes kubeconfig uploads, turn this on for a deployment that also serves POST /manifests
+KUBE_O_MATIC_MANIFESTS = os.getenv("KUBE_O_MATIC_MANIFESTS", "false").lower() in ("1", "true", "yes")
+
+RETRY_STATUSES = (502, 503, 504)
+# The service is up but has no such endpoint, e.g. a kube-o-matic release without POST /manifests
+MISSING_STATUSES = (404, 405)
+
+class KubeOMaticError(Exception):
+    pass
+
+class KubeOMaticUnsupported(KubeOMaticError):
+    pass
+
+class KubeOMaticClient:
+    # One pooled async client for every call to kube-o-matic, none of them may block the event loop or hang forever
+
+    def __init__(self, base_url: str = KUBE_O_MATIC_URL, timeout: float = KUBE_O_MATIC_TIMEOUT, retries: int = KUBE_O_MATIC_RETRIES,
+                 backoff: float = KUBE_O_MATIC_BACKOFF, health_ttl: float = KUBE_O_MATIC_HEALTH_TTL,
+                 max_connections: int = KUBE_O_MATIC_MAX_CONNECTIONS):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.health_ttl = health_ttl
+        self.max_connections = max_connections
+        self._client: Optional[httpx.AsyncClient] = None
+        self._loop = None
+        self._healthy: Optional[bool] = None
+        self._checked_at = 0.0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Pooled connections belong to the loop that opened them
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._loop is not loop:
+            limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout, limits=limits)
+            self._loop = loop
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+        self._client = None
+        self._loop = None
+
+    async def request(self, method: str, path: str, retries: Optional[int] = None, **kwargs) -> httpx.Response:
+        retries = self.retries if retries is None else retries
+        client = self._get_client()
+        for attempt in range(retries + 1):
+            try:
+                response = await client.request(method, path, **kwargs)
+                if response.status_code not in RETRY_STATUSES or attempt == retries:
+                    return response
+            except httpx.TransportError as e:
+                if attempt == retries:
+                    self._remember_health(False)
+                    raise KubeOMaticError(f"{method} {self.base_url}{path} failed after {attempt + 1} attempt(s): {e!r}") from e
+            await asyncio.sleep(self.backoff * 2 ** attempt)
+
+    def _remember_health(self, healthy: bool):
+        self._healthy = healthy
+        self._checked_at = time.monotonic()
+
+    async def healthy(self, refresh: bool = False) -> bool:
+        # Probed at most once per TTL, the answer in between comes from memory
+        if not refresh and self._healthy is not None and time.monotonic() - self._checked_at < self.health_ttl:
+            return self._healthy
+        try:
+            response = await self.request("GET", "/", retries=0)
+            self._remember_health(response.status_code == 200)
+        except KubeOMaticError:
+            self._remember_health(False)
+        return self._healthy
+
+    async def _checked(self, method: str, path: str, **kwargs) -> httpx.Response:
+        response = await self.request(method, path, **kwargs)
+        if response.status_code in MISSING_STATUSES:
+            self._remember_health(True)
+            raise KubeOMaticUnsupported(f"{self.base_url} does not serve {method} {path} ({response.status_code})")
+        if response.status_code >= 400:
+            raise KubeOMaticError(f"{method} {self.base_url}{path} returned {response.status_code}: {response.text[:200]}")
+        self._remember_health(True)
+        return response
+
+    async def upload_kubeconfig(self, filename: str, content: bytes) -> httpx.Response:
+        return await self._checked("POST", "/upload", files={"file": (filename, content, "application/octet-stream")})
+
+    async def apply_manifests(self, project_name: str, stream: str) -> httpx.Response:
+        # Everything a project needs applied in one multi-document YAML body instead of a request per object
+        # This endpoint and its X-Project header are what prod-auto expects of kube-o-matic, /upload is the only call it documents
+        return await self._checked("POST", "/manifests", content=stream.encode(),
+                                   headers={"Content-Type": "application/yaml", "X-Project": project_name})
+
+client = KubeOMaticClient()
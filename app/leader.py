@@ -0,0 +1,70 @@
+import os, fcntl, threading
+from typing import Callable, Optional
+
+# Every worker process serves the API, only the one holding this lock runs the build scheduler and the webhook dispatcher
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", os.path.join("database", "leader.lock"))
+# How often the other workers try to take over (seconds), the lock is freed by the OS as soon as the leader's process dies
+LEADER_RETRY_INTERVAL = float(os.getenv("LEADER_RETRY_INTERVAL", "5"))
+
+class LeaderElection:
+
+    def __init__(self, on_elected: Callable[[], None], on_resigned: Callable[[], None], path: str = LEADER_LOCK_FILE,
+                 retry_interval: float = LEADER_RETRY_INTERVAL):
+        self.on_elected = on_elected
+        self.on_resigned = on_resigned
+        self.path = path
+        self.retry_interval = retry_interval
+        self._file = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    @property
+    def is_leader(self) -> bool:
+        return self._file is not None
+
+    def try_acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        lock_file = open(self.path, "a+")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(f"{os.getpid()}\n")
+        lock_file.flush()
+        self._file = lock_file
+        print(f"Worker {os.getpid()} is the leader, running the build scheduler")
+        self.on_elected()
+        return True
+
+    def start(self):
+        # Either lead right away or keep trying in the background until the current leader goes away
+        self._stopping.clear()
+        if self.try_acquire():
+            return
+        self._thread = threading.Thread(target=self._run, name="leader-election", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(self.retry_interval + 1)
+            self._thread = None
+        if self._file is not None:
+            self.on_resigned()
+            # Closing the file drops the lock, a waiting worker takes over on its next try
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        while not self._stopping.wait(self.retry_interval):
+            try:
+                if self.try_acquire():
+                    return
+            except OSError as e:
+                print(f"Error acquiring leader lock {self.path}: {e}")
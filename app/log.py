@@ -1,50 +1,276 @@
-from db import ConnectionPool
-from typing import Optional, List, Dict
-import sqlite3, uuid, os, dockr, json
+from db import get_pool
+from typing import Optional, List, Dict, Tuple
+import sqlite3, uuid, os, dockr, json, time, base64, buildlogs, metrics
 
 LOGS_DIR = "build_logs"
+# Largest piece of a build log returned by a single /status call (bytes)
+LOG_CHUNK_LIMIT = int(os.getenv("LOG_CHUNK_LIMIT", str(1024 * 1024)))
+# How often a followed build log is checked for new output (seconds)
+LOG_FOLLOW_INTERVAL = float(os.getenv("LOG_FOLLOW_INTERVAL", "0.5"))
 
-connection_pool = ConnectionPool()
+connection_pool = get_pool()
 
-def log_build_request(project_name: str, status: str, webhook: bool, commit_hash: str):
+# Per-job details set on the queue row while the job runs and copied onto the job when it is logged
+JOB_DETAILS = ["secret_version", "rollback_of", "context_hash", "build_cache", "push_duration", "push_bytes"]
+
+def log_build_request(project_name: str, status: str, webhook: bool, commit_hash: str, job_id: str = None, images: Optional[Dict[str, str]] = None):
+    if webhook:
+        trigger = "webhook"
+    else:
+        trigger = "manual"   
+
+    try:
+        # Builds that went through the queue know when they were requested and when they started
+        finished_at = time.time()
+        created_at, started_at, log_offset, log_end, log_file = finished_at, None, None, None, None
+        details = dict.fromkeys(JOB_DETAILS)
+        if job_id:
+            with connection_pool.get_connection() as conn:
+                row = conn.execute(f"SELECT enqueued_at, started_at, log_offset, log_file, {', '.join(JOB_DETAILS)} FROM build_queue WHERE id=?",
+                                   (job_id,)).fetchone()
+            if row:
+                created_at, started_at, log_offset, log_file = row[0] or finished_at, row[1], row[2], row[3]
+                details = dict(zip(JOB_DETAILS, row[4:]))
+        duration = finished_at - started_at if started_at else None
+
+        # Jobs that never started a log of their own point at the old shared project log
+        log_file = log_file or f"{project_name}.log"
+        log_file_path = os.path.join(LOGS_DIR, project_name, log_file)
+        if log_offset is not None and os.path.exists(log_file_path):
+            log_end = os.path.getsize(log_file_path)
+
+        # Goes through the shared writer so bursts of finishing builds share one transaction
+        # Outcomes are counted by prod_auto_deploys_total and per project from the jobs rows, not in projects
+        ok = connection_pool.write([
+            ("INSERT OR IGNORE INTO projects (name) VALUES (?)", (project_name,)),
+            (f'''INSERT INTO jobs (id, project_id, status, commit_hash, trigger, log_file, created_at, finished_at, duration, log_offset, log_end,
+                                    images, {', '.join(JOB_DETAILS)})
+                 VALUES (?, (SELECT id FROM projects WHERE name=?), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?{', ?' * len(JOB_DETAILS)})''',
+             (job_id or uuid.uuid4().hex, project_name, status, commit_hash, trigger, log_file,
+              created_at, finished_at, duration, log_offset, log_end, json.dumps(images) if images else None, *details.values()))
+        ])
+        metrics.DEPLOYS.inc(project=project_name, status=status)
+        if not ok:
+            print(f"Error logging build request for {project_name}")
+    except sqlite3.Error as e:
+        print(f"Error logging build request: {e}")
+
+def record_job_details(job_id: Optional[str], **details):
+    # Set on the queue row while the job runs and copied onto the job once it finishes
+    if not job_id:
+        return
     try:
         with connection_pool.get_connection() as conn:
-            cur = conn.cursor()
-            if webhook:
-                trigger = "webhook"
-            else:
-                trigger = "manual"   
-            cur.execute("INSERT INTO jobs (id, project_id, status, commit_hash, trigger, log_file) VALUES (?, ?, ?, ?, ?, ?)", 
-                        (uuid.uuid4().hex, get_or_create_project_id(project_name), status, commit_hash, trigger,f"{project_name}.log"))
+            conn.execute(f"UPDATE build_queue SET {', '.join(f'{column} = ?' for column in details)} WHERE id = ?", (*details.values(), job_id))
+    except sqlite3.Error as e:
+        print(f"Error recording details of {job_id}: {e}")
+
+def record_secret_version(job_id: str, version: Optional[int]):
+    record_job_details(job_id, secret_version=version)
+
+def record_build_cache(job_id: Optional[str], context_hash: Optional[str], build_cache: Optional[str]):
+    record_job_details(job_id, context_hash=context_hash, build_cache=build_cache)
+
+def start_job_log(project_name: str, job_id: str, commit_hash: str) -> str:
+    # Every job writes its own log file, the header marks which build it belongs to
+    log_file = buildlogs.job_log_name(job_id)
+    log_file_path = os.path.join(LOGS_DIR, project_name, log_file)
+    os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
+    with open(log_file_path, "ab") as log:
+        log_offset = log.tell()
+        log.write(f"==== job {job_id} commit {commit_hash} ====\n".encode())
+
+    try:
+        with connection_pool.get_connection() as conn:
+            conn.execute("UPDATE build_queue SET log_offset = ?, log_file = ? WHERE id = ?", (log_offset, log_file, job_id))
             conn.commit()
     except sqlite3.Error as e:
-        print(f"Error logging build request: {e}")
-    finally:
-        conn.close()
+        print(f"Error recording log offset of {job_id}: {e}")
+    return log_file_path
+
+def previous_secret_version(project_name: str) -> Optional[int]:
+    # A revert goes back to the commit before the latest deploy, so it wants the secrets that commit was deployed with
+    try:
+        with connection_pool.get_connection() as conn:
+            rows = conn.execute('''SELECT j.secret_version FROM jobs j JOIN projects p ON p.id = j.project_id
+                                    WHERE p.name = ? AND j.status = 'success' AND j.secret_version IS NOT NULL
+                                    ORDER BY j.created_at DESC LIMIT 2''', (project_name,)).fetchall()
+    except sqlite3.Error as e:
+        print(f"Error retrieving secret version of {project_name}: {e}")
+        return None
+    return rows[-1][0] if rows else None
+
+def last_deployed_commit(project_name: str) -> Optional[str]:
+    with connection_pool.get_connection() as conn:
+        row = conn.execute('''SELECT j.commit_hash FROM jobs j JOIN projects p ON p.id = j.project_id
+                              WHERE p.name = ? AND j.status = 'success' AND j.commit_hash != ''
+                              ORDER BY j.created_at DESC LIMIT 1''', (project_name,)).fetchone()
+    return row[0] if row else None
+
+RELEASE_COLUMNS = "j.id, j.commit_hash, j.images, j.secret_version, j.created_at, j.rollback_of"
 
-def get_build_status(project_name: str) -> Dict[str, str]:
+def _release(row) -> Dict:
+    return {"job_id": row[0], "commit_hash": row[1], "images": json.loads(row[2]) if row[2] else {}, "secret_version": row[3],
+            "rollback_of": row[5]}
+
+def get_release(project_name: str, job_id: str) -> Optional[Dict]:
+    # A successful job of this project whose images were kept
+    with connection_pool.get_connection() as conn:
+        row = conn.execute(f'''SELECT {RELEASE_COLUMNS} FROM jobs j JOIN projects p ON p.id = j.project_id
+                               WHERE p.name = ? AND j.id = ? AND j.status = 'success' AND j.images IS NOT NULL''',
+                           (project_name, job_id)).fetchone()
+    return _release(row) if row else None
+
+def find_release_by_context(project_name: str, context_hash: str) -> Optional[Dict]:
+    # The newest successful build of exactly this build context whose images were kept
+    with connection_pool.get_connection() as conn:
+        row = conn.execute(f'''SELECT {RELEASE_COLUMNS} FROM jobs j JOIN projects p ON p.id = j.project_id
+                               WHERE p.name = ? AND j.context_hash = ? AND j.status = 'success' AND j.images IS NOT NULL
+                               ORDER BY j.created_at DESC LIMIT 1''', (project_name, context_hash)).fetchone()
+    return _release(row) if row else None
+
+def rollback_target(project_name: str) -> Optional[Dict]:
+    # The release deployed before the current one; if the current one is itself a rollback, step back from what it restored
+    with connection_pool.get_connection() as conn:
+        current = conn.execute(f'''SELECT {RELEASE_COLUMNS} FROM jobs j JOIN projects p ON p.id = j.project_id
+                                   WHERE p.name = ? AND j.status = 'success' ORDER BY j.created_at DESC LIMIT 1''', (project_name,)).fetchone()
+        if current is None:
+            return None
+
+        before = current[4]
+        if current[5]:
+            origin = conn.execute("SELECT created_at FROM jobs WHERE id = ?", (current[5],)).fetchone()
+            before = origin[0] if origin else before
+
+        row = conn.execute(f'''SELECT {RELEASE_COLUMNS} FROM jobs j JOIN projects p ON p.id = j.project_id
+                               WHERE p.name = ? AND j.status = 'success' AND j.images IS NOT NULL AND j.created_at < ?
+                               ORDER BY j.created_at DESC LIMIT 1''', (project_name, before)).fetchone()
+    return _release(row) if row else None
+
+def find_log_segment(project_name: str, job_id: Optional[str] = None) -> Optional[Dict]:
     try:
         with connection_pool.get_connection() as conn:
             cur = conn.cursor()
-            cur.execute('''SELECT j.status, j.log_file 
-                           FROM jobs j
-                           JOIN projects p ON j.project_id = p.id
-                           WHERE p.name=?''', (project_name,))
+            # A build in progress is the current job, its segment ends wherever the log ends right now
+            if job_id:
+                cur.execute("SELECT id, log_offset, log_file FROM build_queue WHERE id = ? AND status = 'running'", (job_id,))
+            else:
+                cur.execute('''SELECT id, log_offset, log_file FROM build_queue
+                               WHERE repo = ? AND status = 'running' ORDER BY started_at DESC LIMIT 1''', (project_name,))
             row = cur.fetchone()
             if row:
-                status = row[0]
-                log_file = row[1]
-                log_file_path = os.path.join(LOGS_DIR, project_name, log_file)
-                if os.path.exists(log_file_path):
-                    with open(log_file_path, "r") as log:
-                        log_content = log.read()
-                    return {"status": status, "output": log_content}
-                else:
-                    return {"status": "not_started", "output": f"Build log for {project_name} not available."}
+                return {"job_id": row[0], "status": "running", "log_file": row[2] or f"{project_name}.log", "start": row[1], "end": None}
+
+            query = '''SELECT j.id, j.status, j.log_file, j.log_offset, j.log_end
+                       FROM jobs j
+                       JOIN projects p ON j.project_id = p.id
+                       WHERE p.name = ?'''
+            if job_id:
+                cur.execute(query + " AND j.id = ?", (project_name, job_id))
             else:
-                return {"status": "not_started", "output": f"No build record found for {project_name}."}
+                # Superseded commits never built anything, skip them
+                cur.execute(query + " AND j.status != 'superseded' ORDER BY j.created_at DESC, j.id DESC LIMIT 1", (project_name,))
+            row = cur.fetchone()
+            if row:
+                return {"job_id": row[0], "status": row[1], "log_file": row[2], "start": row[3], "end": row[4]}
     except sqlite3.Error as e:
         print(f"Error retrieving build status: {e}")
+    return None
+
+def find_tail_offset(log, start: int, end: int, lines: int, block_size: int = 65536) -> int:
+    # Walk backwards from the end a block at a time until enough newlines were seen
+    position, newlines = end, 0
+    while position > start:
+        read_size = min(block_size, position - start)
+        position -= read_size
+        log.seek(position)
+        block = log.read(read_size)
+        # A trailing newline terminates the last line, it doesn't start a new one
+        if position + read_size == end and block.endswith(b"\n"):
+            block = block[:-1]
+        for index in range(len(block) - 1, -1, -1):
+            if block[index] == 10:
+                newlines += 1
+                if newlines == lines:
+                    return position + index + 1
+    return start
+
+def read_log_segment(log_file_path: str, start: int = 0, end: Optional[int] = None, offset: Optional[int] = None,
+                     tail: Optional[int] = None, limit: int = LOG_CHUNK_LIMIT) -> Dict:
+    # Offsets are relative to the start of the segment, the file itself is never read whole
+    compressed = log_file_path.endswith(".gz")
+    with buildlogs.open_log(log_file_path) as log:
+        size = buildlogs.log_size(log_file_path)
+        end = size if end is None else min(end, size)
+        start = min(start or 0, end)
+
+        if offset is not None:
+            position = min(start + offset, end)
+        elif tail is not None and compressed:
+            position = buildlogs.tail_offset(log_file_path, start, end, tail)
+        elif tail is not None:
+            position = find_tail_offset(log, start, end, tail)
+        else:
+            # Default view is the end of the segment, that's where a build fails
+            position = max(start, end - limit)
+
+        length = min(limit, end - position)
+        log.seek(position)
+        data = log.read(length)
+
+    return {
+        "output": data.decode("utf-8", errors="replace"),
+        "offset": position - start,
+        "next_offset": position - start + len(data),
+        "size": end - start,
+        "truncated": position > start or position + len(data) < end
+    }
+
+def get_build_status(project_name: str, job_id: Optional[str] = None, offset: Optional[int] = None, tail: Optional[int] = None,
+                     limit: int = LOG_CHUNK_LIMIT) -> Dict[str, str]:
+    segment = find_log_segment(project_name, job_id)
+    if segment is None:
+        return {"status": "not_started", "output": f"No build record found for {project_name}."}
+
+    log_file_path = buildlogs.resolve_log_path(project_name, segment["log_file"], LOGS_DIR)
+    if segment["status"] == "running" and segment["start"] is None:
+        return {"status": "running", "job_id": segment["job_id"], "output": ""}
+    if log_file_path is None:
+        return {"status": "not_started", "output": f"Build log for {project_name} not available."}
+
+    status = {"status": segment["status"], "job_id": segment["job_id"]}
+    status.update(read_log_segment(log_file_path, segment["start"], segment["end"], offset, tail, limit))
+    return status
+
+def follow_build_log(project_name: str, job_id: Optional[str] = None, offset: int = 0, sse: bool = False):
+    # Yields new output as it is appended and stops once the job is no longer running
+    segment = find_log_segment(project_name, job_id)
+    if segment is None:
+        return
+    job_id = segment["job_id"]
+
+    while True:
+        # Nothing to read until a running job has written its start marker
+        log_file_path = buildlogs.resolve_log_path(project_name, segment["log_file"], LOGS_DIR)
+        if (segment["start"] is not None or segment["status"] != "running") and log_file_path:
+            chunk = read_log_segment(log_file_path, segment["start"], segment["end"], offset, limit=65536)
+            if chunk["output"]:
+                offset = chunk["next_offset"]
+                if sse:
+                    data = "\n".join(f"data: {line}" for line in chunk["output"].split("\n"))
+                    yield f"id: {offset}\n{data}\n\n"
+                else:
+                    yield chunk["output"]
+                continue
+
+        if segment["status"] != "running":
+            break
+
+        time.sleep(LOG_FOLLOW_INTERVAL)
+        segment = find_log_segment(project_name, job_id) or segment
+
+    if sse:
+        yield f"event: end\ndata: {segment['status']}\n\n"
 
 def get_or_create_project_id(project_name: str) -> int:
     try:
@@ -62,32 +288,74 @@ def get_or_create_project_id(project_name: str) -> int:
     except sqlite3.Error as e:
         print(f"Error logging build request: {e}")
 
-def update_project_counts(project_name: str, success: bool):
+def encode_cursor(created_at: float, job_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at, job_id]).encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[float, str]:
     try:
-        with connection_pool.get_connection() as conn:
-            cur = conn.cursor()
-        if success:
-            cur.execute("UPDATE projects SET success_count = success_count + 1 WHERE name=?", (project_name,))
-        else:
-            cur.execute("UPDATE projects SET failure_count = failure_count + 1 WHERE name=?", (project_name,))
-        conn.commit()
+        created_at, job_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(created_at), str(job_id)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
 
-    except sqlite3.Error as e:
-        print(f"Error logging build request: {e}")
+def _deploy_counts(conn, project_ids) -> Dict[int, Tuple[int, int]]:
+    # Successful and failed jobs per project, for the projects on one page of /jobs
+    if not project_ids:
+        return {}
+    rows = conn.execute(f'''SELECT project_id, SUM(status = 'success'), SUM(status = 'failure') FROM jobs
+                           WHERE project_id IN ({', '.join('?' * len(project_ids))}) GROUP BY project_id''', tuple(project_ids))
+    return {row[0]: (row[1] or 0, row[2] or 0) for row in rows}
+
+def get_jobs(limit: int = 50, cursor: Optional[str] = None, project: Optional[str] = None, status: Optional[str] = None,
+             trigger: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+             summary: bool = False) -> Tuple[List[Dict], Optional[str]]:
+    # Newest first, keyset paginated on (created_at, id) so every page is an index range scan
+    filters, args = [], []
+    if cursor:
+        filters.append("(j.created_at, j.id) < (?, ?)")
+        args.extend(decode_cursor(cursor))
+    if project:
+        filters.append("p.name = ?")
+        args.append(project)
+    if status:
+        filters.append("j.status = ?")
+        args.append(status)
+    if trigger:
+        filters.append("j.trigger = ?")
+        args.append(trigger)
+    if since is not None:
+        filters.append("j.created_at >= ?")
+        args.append(since)
+    if until is not None:
+        filters.append("j.created_at < ?")
+        args.append(until)
+
+    where = f"WHERE {' AND '.join(filters)}" if filters else ""
+    args.append(limit + 1)
 
-def get_jobs():
     try:
         with connection_pool.get_connection() as conn:
             cur = conn.cursor()
-            # Return the details of all jobs including project details
-            cur.execute('''SELECT j.id, j.status, j.commit_hash, j.trigger, j.log_file, p.name as project_name, p.success_count, p.failure_count 
+            # Return the details of the requested jobs including project details
+            cur.execute(f'''SELECT j.id, j.status, j.commit_hash, j.trigger, j.log_file, p.name as project_name, j.project_id,
+                        j.created_at, j.finished_at, j.duration, j.build_cache,
+                        j.push_duration, j.push_bytes
                         FROM jobs j
-                        JOIN projects p ON j.project_id = p.id''')
-            jobs = []
-            for row in cur.fetchall():
-                # Get container data associated with the project name
-                container_data = dockr.get_project_containers(row[5])
+                        JOIN projects p ON j.project_id = p.id
+                        {where}
+                        ORDER BY j.created_at DESC, j.id DESC
+                        LIMIT ?''', args)
+            rows = cur.fetchall()
+
+            next_cursor = None
+            if len(rows) > limit:
+                rows = rows[:limit]
+                next_cursor = encode_cursor(rows[-1][7], rows[-1][0])
 
+            counts = _deploy_counts(conn, {row[6] for row in rows})
+            jobs = []
+            project_containers = {}
+            for row in rows:
                 job = {
                     "id": row[0],
                     "status": row[1],
@@ -95,10 +363,26 @@ def get_jobs():
                     "trigger": row[3],
                     "log_file": row[4],
                     "project_name": row[5],
-                    "success_count": str(row[6]),  # Convert to string
-                    "failure_count": str(row[7])   # Convert to string
+                    "success_count": str(counts.get(row[6], (0, 0))[0]),  # Convert to string
+                    "failure_count": str(counts.get(row[6], (0, 0))[1]),  # Convert to string
+                    "created_at": row[7],
+                    "finished_at": row[8],
+                    "duration": row[9],
+                    "build_cache": row[10],
+                    "push_duration": row[11],
+                    "push_bytes": row[12]
                 }
 
+                # Summary mode is for pollers, it never touches docker
+                if summary:
+                    jobs.append(job)
+                    continue
+
+                # Get container data associated with the project name, once per project rather than per job
+                if row[5] not in project_containers:
+                    project_containers[row[5]] = dockr.get_project_containers(row[5])
+                container_data = project_containers[row[5]]
+
                 if row[1] == "success" and container_data:
                     job["containers"] = json.dumps(container_data)
                 
@@ -114,7 +398,8 @@ def get_jobs():
                                         "container_logs": container_logs
                                     }
                 jobs.append(job)
-            return jobs
+            return jobs, next_cursor
         
     except sqlite3.Error as e:
-        print(f"Error logging build request: {e}")
\ No newline at end of file
+        print(f"Error logging build request: {e}")
+        return [], None
\ No newline at end of file
@@ -1,32 +1,87 @@
-import os , json, subprocess ,logging , uvicorn, sqlite3, sentry_sdk, requests
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Request, UploadFile, File, HTTPException
+import time
+# Import time is reported at startup, so this is taken before the heavy imports
+_import_started = time.perf_counter()
+import os , hashlib, subprocess ,logging , uvicorn, sqlite3
+from fastapi import FastAPI, HTTPException, Request, Response, Query, UploadFile, File, HTTPException
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional, List, Dict
-from db import ConnectionPool
+from contextlib import asynccontextmanager
+from logging.handlers import RotatingFileHandler
+from db import get_pool
+from scheduler import BuildScheduler
+from inbox import WebhookInbox
+from janitor import Janitor, GC_DRY_RUN, GC_KEEP_RELEASES
 from encrypt import Encryptor
-import dockr , log , helpers
+from leader import LeaderElection
+import dockr , log , helpers, container_state, containerlogs, buildlogs, repository, vault, gitcache, metrics, tracing, kubeomatic
 
-sentry_sdk.init(
-    dsn="https://4f856c3765722c946a61baf82463fd8a@o4503956234764288.ingest.sentry.io/4506832041017344",
-    traces_sample_rate=1.0,
-    profiles_sample_rate=1.0,
-    enable_tracing=True
-)
+# Worker processes for `python main.py`, every one serves the API and only the leader runs builds
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+APP_PORT = int(os.getenv("APP_PORT", "1111"))
 
-# initilize cryptography
+# initilize cryptography, key.key is read on first use
 crypt = Encryptor()
 
+def start_background_work():
+    scheduler.start()
+    # Deliveries accepted before a restart are still pending and get dispatched now
+    inbox.start()
+    # Old images, builder cache, worktrees and logs, on an interval and whenever the disk runs low
+    janitor.start()
+    metrics.LEADER.set(1)
+
+def stop_background_work():
+    janitor.stop()
+    inbox.stop()
+    scheduler.stop()
+    metrics.LEADER.set(0)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    started = time.perf_counter()
+    # Sampling and the exporter are configured through the environment, see tracing.py
+    tracing.init_sentry()
+    helpers.first_time_database_init(connection_pool)
+    # With several workers only one runs the scheduler and the inbox, the others take over if it exits
+    leader.start()
+    # Prime the container index and follow docker events so status lookups stay in memory
+    container_state.cache.start()
+    startup_seconds = time.perf_counter() - started
+    metrics.STARTUP_SECONDS.set(startup_seconds, phase="startup")
+    print(f"Worker {os.getpid()} ready: import {import_seconds:.3f}s, startup {startup_seconds:.3f}s, leader {leader.is_leader}")
+    yield
+    container_state.cache.stop()
+    leader.stop()
+    await kubeomatic.client.close()
+
 # initialize FastAPI
-app = FastAPI(docs_url=None, redoc_url=None, openapi_url= None)
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url= None, lifespan=lifespan)
 
-# Initialize connection pool
-connection_pool = ConnectionPool()
+# Initialize connection pool, shared with log.py
+connection_pool = get_pool()
 
 # Configure logging
 LOGS_DIR = "build_logs"
 if not os.path.exists(LOGS_DIR):
     os.makedirs(LOGS_DIR)
-logging.basicConfig(filename=os.path.join(LOGS_DIR, "builds.log"), level=logging.INFO, format="%(asctime)s - %(message)s")
+builds_log_handler = RotatingFileHandler(os.path.join(LOGS_DIR, "builds.log"), maxBytes=int(os.getenv("BUILDS_LOG_MAX_BYTES", str(10 * 1024 * 1024))),
+                                         backupCount=int(os.getenv("BUILDS_LOG_BACKUPS", "5")))
+logging.basicConfig(handlers=[builds_log_handler], level=logging.INFO, format="%(asctime)s - %(message)s")
+
+CD_UNREACHABLE = "Continuous integration is not reachable or running. Make sure you use 'make cd' in your root dir to set this up!"
+
+# Templates are compiled on first use, the engine remembers what it already forwarded per project
+_manifest_engine = None
+
+def get_manifest_engine():
+    global _manifest_engine
+    if _manifest_engine is None:
+        # jinja2 and yaml are only needed by the manifest endpoint
+        import k8s
+        _manifest_engine = k8s.ManifestGen()
+    return _manifest_engine
 
 class Payload(BaseModel):
     repository: Optional[dict]
@@ -36,204 +91,403 @@ class EnvironmentVariables(BaseModel):
     value: str
 
 # Logic / Global / Background functions
-    
-def deploy_project_logic(owner: str, repo: str, background_tasks: BackgroundTasks, webhook = False, revert = False, commit_hash = ""):
+
+async def deploy_project_logic(owner: str, repo: str, webhook = False, revert = False, commit_hash = "", rollback_of = None):
     project_name = repo
-    log_file = f"{project_name}.log"
-    repo_url = f"https://github.com/{owner}/{repo}.git"
-    project_dir = os.path.abspath(os.path.join("projects", project_name))
+
+    try:
+        # Hand the deployment to the build queue, a worker picks it up once a build slot is free
+        job_id = await repository.enqueue_build(scheduler, owner, repo, webhook=webhook, revert=revert, commit_hash=commit_hash, rollback_of=rollback_of)
+    except sqlite3.Error as e:
+        print(f"Error queueing {project_name}: {e}")
+        return {"message": f"Failed to deploy {project_name}"}
+
+    # Provide immediate response to the user
+    return {"message": f"Deployment started for {project_name}. Check status at /status/{project_name}", "job_id": job_id}
+
+def run_deployment(job: dict):
+    owner = job["owner"]
+    project_name = job["repo"]
+    webhook = job["webhook"]
+    revert = job["revert"]
+    commit_hash = job["commit_hash"] or ""
+    job_id = job["id"]
+    cancel_event = job.get("cancel_event")
+
+    log_file = buildlogs.job_log_name(job_id)
     log_dir = os.path.abspath(os.path.join(LOGS_DIR, project_name))
     log_file_path = os.path.join(log_dir, log_file)
-    project_envs = helpers.get_vault_secrets(project_name, connection_pool, crypt)
+    deployed = False
 
-    try:
-        # Check if project already exists locally
-        if os.path.exists(project_dir):
-            if not revert:
-                subprocess.run(["git", "pull"], cwd=project_dir, check=True)
-                # If revert is True, Do Nothing!
-        else:
-            # Clone the repository if it doesn't exist
-            subprocess.run(["git", "clone", repo_url, project_dir], check=True)
-        
-        # Create the log directory if it doesn't exist
-        os.makedirs(log_dir, exist_ok=True)
-
-        # Get the Current Commit information
-        if commit_hash == "":
-            result = subprocess.run(["git", "rev-parse", "HEAD"], cwd=project_dir, stdout=subprocess.PIPE, text=True)
-            commit_hash = result.stdout.strip()
-
-        # Check if Docker Compose file exists
-        compose_file_path = os.path.join(project_dir, "docker-compose.yml")
-        if compose_file_path and os.path.exists(compose_file_path):
-
-            # check if the project has any ENV variables and set them before deployment
-            if project_envs:
-                background_tasks.add_task(helpers.set_project_env, project_envs)
-
-            # Use docker-compose to deploy the project
-            background_tasks.add_task(dockr.deploy_docker_compose, project_name, compose_file_path, log_file_path, webhook, commit_hash)
-        else:
-            # Read exposed ports from Dockerfile
-            dockerfile_path = os.path.join(project_dir, "Dockerfile")
-            exposed_ports = dockr.read_exposed_ports_from_dockerfile(dockerfile_path)
-
-            if project_envs:
-                # convert the dictionary to a string
-                envs_str = ' '.join([f'{key}={value}' for key, value in project_envs.items()])
-            else :
-                envs_str = ""
-
-            # Execute deployment using Dockerfile
-            background_tasks.add_task(dockr.deploy_docker_run, project_name, project_dir, log_file_path, exposed_ports, webhook , commit_hash, envs=envs_str)
+    # Rollbacks restart images that were already built, no build
+    if job.get("rollback_of"):
+        with tracing.job(project_name, job_id, op="rollback"):
+            return run_rollback(job, log_file_path)
+
+    with tracing.job(project_name, job_id):
+        try:
+            # Reverts redeploy with the secret set the earlier build used, everything else takes the latest one
+            with tracing.stage(project_name, "secrets", job_id):
+                secret_version, project_envs = vault.get_current(project_name, connection_pool, crypt)
+                if revert:
+                    previous_version = log.previous_secret_version(project_name)
+                    previous_envs = vault.get_version(project_name, previous_version, connection_pool, crypt) if previous_version else None
+                    if previous_envs is not None:
+                        secret_version, project_envs = previous_version, previous_envs
+                log.record_secret_version(job_id, secret_version)
+
+            # Fetch just the requested commit into the repo's mirror and check it out in a worktree of this job's own
+            with tracing.stage(project_name, "fetch", job_id):
+                commit_hash = gitcache.fetch(owner, project_name, commit_hash, cancel_event=cancel_event)
+                project_dir = gitcache.add_worktree(project_name, job_id, commit_hash, cancel_event=cancel_event)
         
-        # Provide immediate response to the user
-        return {"message": f"Deployment started for {project_name}. Check status at /status/{project_name}"}
+            # Create the log directory if it doesn't exist
+            os.makedirs(log_dir, exist_ok=True)
+
+            log.start_job_log(project_name, job_id, commit_hash)
+
+            # Check if Docker Compose file exists
+            compose_file_path = os.path.join(project_dir, "docker-compose.yml")
+            if compose_file_path and os.path.exists(compose_file_path):
+
+                # Use docker-compose to deploy the project, with the project's secrets in this job's environment only
+                deployed = dockr.deploy_docker_compose(project_name, compose_file_path, log_file_path, webhook, commit_hash, job_id=job_id, cancel_event=cancel_event,
+                                                       env=helpers.project_env(project_envs))
+            else:
+                # Read exposed ports from Dockerfile
+                dockerfile_path = os.path.join(project_dir, "Dockerfile")
+                with tracing.stage(project_name, "ports", job_id):
+                    exposed_ports = dockr.read_exposed_ports_from_dockerfile(dockerfile_path)
+
+                if project_envs:
+                    # convert the dictionary to a string
+                    envs_str = ' '.join([f'{key}={value}' for key, value in project_envs.items()])
+                else :
+                    envs_str = ""
+
+                # Execute deployment using Dockerfile
+                deployed = dockr.deploy_docker_run(project_name, project_dir, log_file_path, exposed_ports, webhook , commit_hash, envs=envs_str, job_id=job_id, cancel_event=cancel_event)
     
-    except subprocess.CalledProcessError as e:
-        print(f"Error deploying {project_name}: {e}")
-        log.log_build_request(project_name, "failure", webhook, commit_hash)
-        return {"message": f"Failed to deploy {project_name}"}
+        except subprocess.CalledProcessError as e:
+            print(f"Error deploying {project_name}: {e}")
+            log.log_build_request(project_name, "failure", webhook, commit_hash, job_id=job_id)
+        except vault.READ_ERRORS as e:
+            print(f"Error reading the secrets of {project_name}: {e}")
+            log.log_build_request(project_name, "failure", webhook, commit_hash, job_id=job_id)
+
+        finally:
+            # Compress the finished log and drop old ones past the retention policy
+            buildlogs.finish_job_log(project_name, job_id, LOGS_DIR)
+            # A successful deploy becomes the project's current checkout, old worktrees are cleaned up
+            gitcache.finish_worktree(project_name, job_id, deployed)
+
+    # The scheduler marks the queued build failed on False
+    return deployed
+
+def run_rollback(job: dict, log_file_path: str):
+    # Restarts the images an earlier job built, with the secrets and the checkout that job deployed with
+    project_name = job["repo"]
+    release = log.get_release(project_name, job["rollback_of"])
+    deployed = False
+    try:
+        if release is None:
+            print(f"Error rolling back {project_name}: job {job['rollback_of']} has no images to restore")
+            log.log_build_request(project_name, "failure", job["webhook"], job["commit_hash"], job_id=job["id"])
+            return False
+
+        secret_version, project_envs = vault.get_current(project_name, connection_pool, crypt)
+        if release["secret_version"]:
+            pinned_envs = vault.get_version(project_name, release["secret_version"], connection_pool, crypt)
+            if pinned_envs is not None:
+                secret_version, project_envs = release["secret_version"], pinned_envs
+        log.record_secret_version(job["id"], secret_version)
+
+        os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
+        log.start_job_log(project_name, job["id"], release["commit_hash"])
+
+        # The compose file at the released commit, not the current one, is what those images run with
+        try:
+            with tracing.stage(project_name, "fetch", job["id"]):
+                commit_hash = gitcache.fetch(job["owner"], project_name, release["commit_hash"], cancel_event=job.get("cancel_event"))
+                project_dir = gitcache.add_worktree(project_name, job["id"], commit_hash, cancel_event=job.get("cancel_event"))
+        except subprocess.CalledProcessError as e:
+            print(f"Error rolling back {project_name}: commit {release['commit_hash']} can not be checked out: {e}")
+            log.log_build_request(project_name, "failure", job["webhook"], release["commit_hash"], job_id=job["id"])
+            return False
+
+        envs_str = ' '.join([f'{key}={value}' for key, value in project_envs.items()])
+        deployed = dockr.rollback(project_name, release["images"], log_file_path, job["webhook"], release["commit_hash"], envs=envs_str,
+                                  job_id=job["id"], cancel_event=job.get("cancel_event"), env=helpers.project_env(project_envs),
+                                  project_dir=project_dir)
+    except vault.READ_ERRORS as e:
+        print(f"Error reading the secrets of {project_name}: {e}")
+        log.log_build_request(project_name, "failure", job["webhook"], release["commit_hash"], job_id=job["id"])
+    finally:
+        buildlogs.finish_job_log(project_name, job["id"], LOGS_DIR)
+        # The rolled back checkout becomes the current one, so restarts and stops use its compose file too
+        gitcache.finish_worktree(project_name, job["id"], deployed)
+    return deployed
+
+# Build queue drained by a bounded pool of workers
+scheduler = BuildScheduler(connection_pool, run_deployment)
+
+def process_delivery(event: str, payload: dict) -> Optional[str]:
+    # Runs on the inbox thread, a push becomes a queued build and everything else is only recorded
+    if event != "push" or payload.get("deleted"):
+        return None
+
+    owner = payload["repository"]["owner"]["login"]
+    repo = payload["repository"]["name"]
+    commit_hash = payload.get("after") or payload["commits"][-1]["id"]
+    return scheduler.enqueue(owner, repo, webhook=True, revert=False, commit_hash=commit_hash)
+
+# Webhook deliveries are stored first and handed to the build queue from here
+inbox = WebhookInbox(connection_pool, process_delivery)
+janitor = Janitor(connection_pool, LOGS_DIR)
+metrics.QUEUE_DEPTH.set_function(scheduler.queue_depth)
+metrics.BUILDS_IN_FLIGHT.set_function(scheduler.in_flight)
+leader = LeaderElection(start_background_work, stop_background_work)
 
 # HTTP REST API ENDPOINTS
 @app.get("/status/{project_name:path}")
-async def show_build_status(project_name: str):
+async def show_build_status(
+    request: Request,
+    project_name: str,
+    job_id: Optional[str] = None,
+    offset: Optional[int] = Query(None, ge=0),
+    tail: Optional[int] = Query(None, ge=1),
+    limit: int = Query(log.LOG_CHUNK_LIMIT, ge=1, le=16 * 1024 * 1024),
+    follow: bool = False
+):
+    # Live output of a running build, as server-sent events when the client asks for them
+    if follow:
+        sse = "text/event-stream" in request.headers.get("accept", "")
+        return StreamingResponse(log.follow_build_log(project_name, job_id, offset or 0, sse=sse),
+                                 media_type="text/event-stream" if sse else "text/plain")
+
     # Return the status and output of the build process for a specific project
-    status = log.get_build_status(project_name)
+    status = await repository.get_build_status(project_name, job_id, offset, tail, limit)
     return status
 
 @app.get("/projects")
 async def get_projects() -> List[str]:
     try:
-        with connection_pool.get_connection() as conn:
-            cur = conn.cursor()
-            # Return the names of all projects for which build logs are available
-            cur.execute("SELECT DISTINCT name FROM projects")
-            projects = [row[0] for row in cur.fetchall()]
-            return projects
-        
+        return await repository.list_projects()
     except sqlite3.Error as e:
-        print(f"Error logging build request: {e}")
+        print(f"Error listing projects: {e}")
+        raise HTTPException(status_code=500, detail="Error listing projects")
 
 @app.get("/jobs")
-async def get_jobs() -> List[Dict[str, str]]:
-    return log.get_jobs()
-
-@app.post("/webhook")
-async def github_webhook(request: Request, background_tasks: BackgroundTasks):
+async def get_jobs(
+    response: Response,
+    limit: int = Query(50, ge=1, le=500),
+    cursor: Optional[str] = None,
+    project: Optional[str] = None,
+    status: Optional[str] = None,
+    trigger: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None,
+    summary: bool = False
+) -> List[Dict]:
+    try:
+        jobs, next_cursor = await repository.list_jobs(limit, cursor, project, status, trigger, since, until, summary)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # The body stays a plain list, the next page is advertised in a header
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return jobs
+
+@app.get("/jobs/{job_id}/timeline")
+async def get_job_timeline(job_id: str) -> Dict:
+    timeline = await repository.get_job_timeline(job_id)
+    if timeline is None:
+        raise HTTPException(status_code=404, detail=f"No job {job_id}")
+    return timeline
+
+@app.post("/gc")
+async def collect_garbage(dry_run: Optional[bool] = None, keep: Optional[int] = Query(None, ge=1)):
+    # Runs the garbage collector now and answers with what it removed, or with ?dry_run=true what it would remove
+    report = await run_in_threadpool(janitor.collect, GC_DRY_RUN if dry_run is None else dry_run, keep or GC_KEEP_RELEASES)
+    if report is None:
+        raise HTTPException(status_code=409, detail="A garbage collection is already running")
+    return report
+
+@app.get("/gc")
+async def list_garbage_collections(limit: int = Query(10, ge=1, le=100)) -> List[Dict]:
+    return await repository.list_gc_runs(janitor, limit)
+
+@app.post("/webhook", status_code=202)
+async def github_webhook(request: Request):
     event = request.headers.get("X-GitHub-Event")
+    signature_256 = request.headers.get("X-Hub-Signature-256")
     signature = request.headers.get("X-Hub-Signature")
 
-    if not event or not signature:
+    if not event or not (signature_256 or signature):
         raise HTTPException(status_code=400, detail="Missing GitHub headers")
 
-    try:
-        payload = await request.json()
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="Invalid JSON payload")
+    # The raw body is read once, verified and stored as is, parsing it is the inbox's job
+    body = await request.body()
+    helpers.verify_signature(body, signature_256, signature)
 
-    if event == "push":
-        # Verify the signature using the secret
-        helpers.verify_signature(request.body(), signature)
+    # Redeliveries carry the same id, senders without one are deduplicated on the payload itself
+    delivery_id = request.headers.get("X-GitHub-Delivery") or hashlib.sha256(body).hexdigest()
+    try:
+        accepted = await repository.receive_webhook(inbox, delivery_id, event, body)
+    except sqlite3.Error as e:
+        print(f"Error storing webhook delivery {delivery_id}: {e}")
+        raise HTTPException(status_code=503, detail="Could not store the delivery, retry later")
 
-        owner = payload["repository"]["owner"]["login"]
-        repo = payload["repository"]["name"]
-        commit_hash = payload["commits"][-1]["id"]
-        
-        return deploy_project_logic(owner, repo, background_tasks, webhook=True, revert=False, commit_hash=commit_hash)
-    
-    return {"message": f"Ignored event: {event}"}
+    if not accepted:
+        return {"message": "Delivery already received", "delivery_id": delivery_id}
+    return {"message": f"Accepted {event} event", "delivery_id": delivery_id}
 
 @app.get("/deploy/{owner}/{repo}")
-async def deploy_project(owner: str, repo: str, background_tasks: BackgroundTasks):
-    return deploy_project_logic(owner, repo, background_tasks)
+async def deploy_project(owner: str, repo: str):
+    return await deploy_project_logic(owner, repo)
 
-@app.post("/kubeconfig")
-async def kubectl_config(file: UploadFile = File(...)):
-    try:
-        # Validate kubeconfig
-        kubeconfig_content = await file.read()
-        if not helpers.is_valid_kubeconfig(kubeconfig_content.decode()):
-            raise HTTPException(status_code=422, detail="Invalid kubeconfig content provided.")
+@app.get("/queue")
+async def get_build_queue() -> List[Dict]:
+    return await repository.list_queue(scheduler)
 
-        # Check if continuous integration is reachable
-        if requests.get("http://kube-o-matic:8555/").status_code != 200:
-            raise HTTPException(status_code=503, detail="Continuous integration is not reachable or running. Make sure you use 'make cd' in your root dir to set this up!")
+@app.get("/metrics")
+async def get_metrics():
+    # Queue depth is read from the database at scrape time, keep that off the event loop
+    return Response(await repository.run(metrics.registry.expose), media_type=metrics.CONTENT_TYPE)
 
-        cd_url = "http://kube-o-matic:8555/"
+@app.post("/kubeconfig")
+async def kubectl_config(file: UploadFile = File(...)):
+    # Validate kubeconfig
+    kubeconfig_content = await file.read()
+    if not helpers.is_valid_kubeconfig(kubeconfig_content.decode(errors="replace")):
+        raise HTTPException(status_code=422, detail="Invalid kubeconfig content provided.")
 
-        # Prepare file data
-        files = {"file": (file.filename, kubeconfig_content, "application/octet-stream")}
+    # Check if continuous integration is reachable, the answer is cached for a while
+    if not await kubeomatic.client.healthy():
+        raise HTTPException(status_code=503, detail=CD_UNREACHABLE)
 
+    try:
         # Send kubeconfig as file
-        r = requests.post(cd_url + "upload", files=files)
+        await kubeomatic.client.upload_kubeconfig(file.filename, kubeconfig_content)
+    except kubeomatic.KubeOMaticError as e:
+        raise HTTPException(status_code=502, detail=f"Error occurred while communicating with the server: {e}")
+
+    return {"message": "Kubeconfig content saved successfully."}
+
+@app.post("/kubernetes/{project_name}/manifests")
+async def forward_manifests(project_name: str, full: bool = False):
+    # Renders the deployed compose file and hands kube-o-matic only the manifests that changed since the last time
+    if not kubeomatic.KUBE_O_MATIC_MANIFESTS:
+        raise HTTPException(status_code=501, detail="Forwarding manifests needs a kube-o-matic that serves POST /manifests, "
+                                                    "set KUBE_O_MATIC_MANIFESTS=true once yours does")
+    checkout = gitcache.current_checkout(project_name)
+    compose_file_path = os.path.join(checkout, "docker-compose.yml") if checkout else None
+    if not compose_file_path or not os.path.exists(compose_file_path):
+        raise HTTPException(status_code=404, detail=f"No deployed docker-compose.yml for {project_name}")
+
+    if not await kubeomatic.client.healthy():
+        raise HTTPException(status_code=503, detail=CD_UNREACHABLE)
+
+    manifest_engine = get_manifest_engine()
+    rendered = await repository.render_manifests(manifest_engine, compose_file_path, project_name)
+    manifests = manifest_engine.changed(rendered)
+    if full:
+        manifests = rendered
+    if not manifests:
+        return {"message": f"Manifests of {project_name} are unchanged", "applied": 0}
 
-        # Check if the request was successful
-        r.raise_for_status()
-
-        return {"message": "Kubeconfig content saved successfully."}
+    try:
+        await kubeomatic.client.apply_manifests(project_name, manifest_engine.to_stream(manifests))
+    except kubeomatic.KubeOMaticUnsupported as e:
+        manifest_engine.forget(project_name)
+        raise HTTPException(status_code=501, detail=f"kube-o-matic can not apply manifests, it needs a POST /manifests endpoint: {e}")
+    except kubeomatic.KubeOMaticError as e:
+        # Nothing is known to be applied now, the next call sends everything again
+        manifest_engine.forget(project_name)
+        raise HTTPException(status_code=502, detail=f"Error occurred while communicating with the server: {e}")
 
-    except requests.RequestException as e:
-        raise HTTPException(status_code=500, detail=f"Error occurred while communicating with the server: {str(e)}")
+    return {"message": f"Forwarded {len(manifests)} manifest(s) of {project_name}", "applied": len(manifests)}
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")    
-    
 @app.post("/vault/{project_name}")
-async def set_vault_secrets(project_name: str, request: Request):
+async def set_vault_secrets(project_name: str, request: Request, response: Response):
     variables = await request.json()
+    if not isinstance(variables, dict) or not all(isinstance(value, str) for value in variables.values()):
+        raise HTTPException(status_code=422, detail="Expected a JSON object of string values")
     
     try:
-        # Encrypt and store each environment variable in the database
-        with connection_pool.get_connection() as conn:
-            cursor = conn.cursor()
-            for key, value in variables.items():
-                encrypted_value = crypt.en(value)
-                
-                # Try to update the existing variable
-                cursor.execute(
-                    "UPDATE project_environment_variables SET variable_value = ? WHERE project_name = ? AND variable_name = ?",
-                    (encrypted_value, project_name, key)
-                )
-                
-                # If no rows were affected by the update, insert a new record
-                if cursor.rowcount == 0:
-                    cursor.execute(
-                        "INSERT INTO project_environment_variables (project_name, variable_name, variable_value) VALUES (?, ?, ?)",
-                        (project_name, key, encrypted_value)
-                    )
-                    
-            conn.commit()
-            
+        # The whole payload is written in one transaction and becomes a new secret version
+        version = await repository.save_vault_secrets(project_name, variables, crypt)
+
     except sqlite3.Error as e:
         raise HTTPException(status_code=500, detail=f"Error setting environment variables: {e}")
     
+    response.headers["X-Vault-Version"] = str(version)
     return {"message": "Environment variables set successfully"}
 
+@app.get("/vault/{project_name}/versions")
+async def get_vault_versions(project_name: str):
+    return {"versions": await repository.list_vault_versions(project_name)}
+
 @app.get("/revert/{owner}/{repo}")
 async def revert_changes(
     owner: str ,
-    repo: str ,
-    background_tasks: BackgroundTasks
+    repo: str,
+    job_id: Optional[str] = None
 ):
+    # Roll straight back to images an earlier job built: the given job, or the release before the current one
+    if job_id:
+        release = await repository.run(log.get_release, repo, job_id)
+        if release is None:
+            raise HTTPException(status_code=404, detail=f"No successful build of {repo} with kept images for job {job_id}")
+    else:
+        release = await repository.run(log.rollback_target, repo)
+
+    if release:
+        queued = await deploy_project_logic(owner, repo, revert=True, commit_hash=release["commit_hash"],
+                                            rollback_of=release["rollback_of"] or release["job_id"])
+        return {"message": f"Reverted changes for project {repo}. Rolling back to {release['commit_hash'][:12]}...", "job_id": queued.get("job_id")}
+
+    # Nothing to restore yet, rebuild the parent of whatever was deployed last; the mirror fetches it if the history is too shallow
+    deployed_commit = await repository.run(log.last_deployed_commit, repo)
+    if not deployed_commit:
+        raise HTTPException(status_code=404, detail=f"Nothing of {repo} has been deployed yet, there is no earlier version to revert to")
     try:
-        subprocess.run(["git", "reset", "--hard", "HEAD^"], cwd=f"projects/{repo}", check=True)
-    except Exception as e:
-            return {"message": f"Failed to git reset {repo}. Error: {str(e)}"}, 500
+        parent_commit = await repository.run(gitcache.parent_commit, owner, repo, deployed_commit)
+    except subprocess.CalledProcessError as e:
+        print(f"Error fetching the parent of {deployed_commit} in {repo}: {e}")
+        parent_commit = None
+    if not parent_commit:
+        raise HTTPException(status_code=409, detail=f"Can not revert {repo}: no images of an earlier build are kept and the parent of {deployed_commit[:12]} could not be fetched")
 
-    # Call deploy_project_logic to rebuild the project
-    background_tasks.add_task(deploy_project_logic, owner, repo ,background_tasks, revert=True)
+    # Queue a rebuild of the project at the parent commit
+    await deploy_project_logic(owner, repo, revert=True, commit_hash=parent_commit)
     
     # Return response indicating success or failure
     return {"message": f"Reverted changes for project {repo}. Rebuilding..."}
 
+@app.get("/containers/{project_name}/logs")
+async def stream_container_logs(project_name: str, tail: Optional[str] = None, since: Optional[str] = None, until: Optional[str] = None,
+                                follow: bool = False):
+    # Every container of the project in one stream ordered by time, "<container> | <timestamp> <line>" per line
+    if tail is not None and tail != "all" and not tail.isdigit():
+        raise HTTPException(status_code=400, detail="tail must be a number of lines or 'all'")
+    try:
+        since_time, until_time = containerlogs.parse_time(since), containerlogs.parse_time(until)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since and until take a unix timestamp or a duration like 10m")
+
+    containers = await run_in_threadpool(containerlogs.project_containers, project_name)
+    if not containers:
+        raise HTTPException(status_code=404, detail=f"No containers found for {project_name}")
+    return StreamingResponse(containerlogs.stream_logs(containers, tail, since_time, until_time, follow), media_type="text/plain")
+
 @app.get("/docker/{action}/{project_name}")
 async def container_management(project_name: str, action:str):
 # Stop and remove containers associated with the project name
     if action == "stop":
         try:
-            dockr.stop_and_remove_container(project_name)
+            await run_in_threadpool(dockr.stop_and_remove_container, project_name)
             return {"message": f"Containers for project {project_name} stopped and removed successfully."}
         
         except Exception as e:
@@ -241,7 +495,7 @@ async def container_management(project_name: str, action:str):
         
     elif action == "restart":
         try:
-            dockr.docker_restart_container(project_name)
+            await run_in_threadpool(dockr.docker_restart_container, project_name)
             return {"message": f"Containers for project {project_name} restarted successfully."}
         
         except Exception as e:
@@ -249,7 +503,7 @@ async def container_management(project_name: str, action:str):
         
     elif action == "log":
         try:
-            logs = dockr.get_container_logs(project_name)
+            logs = await run_in_threadpool(dockr.get_container_logs, project_name)
             if logs:
                 return {"message": f"Containers logs: {logs}."}
             else:
@@ -261,7 +515,10 @@ async def container_management(project_name: str, action:str):
     else:
         return {"message": "use approporiate Actions : stop , restart , log"}
 
+import_seconds = time.perf_counter() - _import_started
+metrics.STARTUP_SECONDS.set(import_seconds, phase="import")
+
 if __name__ == "__main__":
-    helpers.first_time_database_init(connection_pool)
-    container_ip = helpers.get_container_ip()
-    uvicorn.run("main:app", host=container_ip, port=1111)
\ No newline at end of file
+    # APP_HOST=0.0.0.0 skips the container ip lookup, e.g. when running outside docker
+    host = os.getenv("APP_HOST") or helpers.get_container_ip()
+    uvicorn.run("main:app", host=host, port=APP_PORT, workers=WEB_CONCURRENCY)
\ No newline at end of file
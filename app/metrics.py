@@ -0,0 +1,162 @@
+import os, sys, time, threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Prometheus text exposition, kept in-house like the docker client so the service has no extra dependency
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple, object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in sorted(self._values.items())]
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}", *self.samples()]
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], float]):
+        # Read at scrape time instead of being kept up to date
+        self._function = function
+
+    def samples(self) -> List[str]:
+        if self._function is not None:
+            try:
+                self.set(self._function())
+            except Exception as e:
+                print(f"Error collecting {self.name}: {e}")
+        return super().samples()
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    le = 'le="' + _format_value(bound) + '"'
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {counts[-1]}")
+        return lines
+
+class Registry:
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        return "\n".join(metric.expose() for metric in self._metrics) + "\n"
+
+registry = Registry()
+
+# Deploy pipeline
+DEPLOY_STAGE_SECONDS = registry.register(Histogram("prod_auto_deploy_stage_duration_seconds",
+                                                   "Time spent in each deploy stage (fetch, build, up, push, total)", ("project", "stage")))
+DEPLOYS = registry.register(Counter("prod_auto_deploys_total", "Finished deploy jobs by outcome", ("project", "status")))
+QUEUE_DEPTH = registry.register(Gauge("prod_auto_build_queue_depth", "Builds waiting in the queue"))
+BUILDS_IN_FLIGHT = registry.register(Gauge("prod_auto_builds_in_flight", "Builds currently running"))
+
+# Process
+STARTUP_SECONDS = registry.register(Gauge("prod_auto_startup_seconds", "Time this worker took to import and to get through the lifespan startup", ("phase",)))
+LEADER = registry.register(Gauge("prod_auto_leader", "1 on the worker running the build scheduler and the webhook dispatcher"))
+
+# Internals
+DB_QUERY_SECONDS = registry.register(Histogram("prod_auto_db_query_duration_seconds",
+                                               "Time a database connection was held per unit of work", ("kind",)))
+GC_RECLAIMED_BYTES = registry.register(Counter("prod_auto_gc_reclaimed_bytes_total", "Disk space freed by the garbage collector", ("kind",)))
+SUBPROCESS_SPAWNS = registry.register(Counter("prod_auto_subprocess_spawns_total", "Child processes started by the pipeline", ("command",)))
+
+def _count_spawns(event: str, args):
+    # Every child process goes through subprocess.Popen, the audit hook sees them all without touching the call sites
+    if event != "subprocess.Popen":
+        return
+    try:
+        executable, command = args[0], args[1]
+        if not executable:
+            executable = command if isinstance(command, (str, bytes)) else command[0]
+        SUBPROCESS_SPAWNS.inc(command=os.path.basename(os.fsdecode(executable)).split()[0])
+    except Exception:
+        # An audit hook that raises would abort the spawn itself
+        pass
+
+sys.addaudithook(_count_spawns)
@@ -0,0 +1,71 @@
+import os, asyncio, functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict, Tuple
+from db import get_pool
+import log, helpers, vault, tracing
+
+# sqlite3 and file reads block, so endpoints hand them to this pool instead of running them on the event loop
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "8"))
+
+executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+
+# projects
+
+def _list_projects() -> List[str]:
+    with get_pool().get_connection() as conn:
+        # Return the names of all projects for which build logs are available
+        return [row[0] for row in conn.execute("SELECT DISTINCT name FROM projects")]
+
+async def list_projects() -> List[str]:
+    return await run(_list_projects)
+
+# jobs
+
+async def list_jobs(limit: int = 50, cursor: Optional[str] = None, project: Optional[str] = None, status: Optional[str] = None,
+                    trigger: Optional[str] = None, since: Optional[float] = None, until: Optional[float] = None,
+                    summary: bool = False) -> Tuple[List[Dict], Optional[str]]:
+    return await run(log.get_jobs, limit, cursor, project, status, trigger, since, until, summary)
+
+async def get_build_status(project_name: str, job_id: Optional[str] = None, offset: Optional[int] = None,
+                           tail: Optional[int] = None, limit: int = log.LOG_CHUNK_LIMIT) -> Dict:
+    return await run(log.get_build_status, project_name, job_id, offset, tail, limit)
+
+async def get_job_timeline(job_id: str) -> Optional[Dict]:
+    return await run(tracing.get_timeline, job_id)
+
+async def list_queue(scheduler) -> List[Dict]:
+    return await run(scheduler.get_queue)
+
+async def enqueue_build(scheduler, owner: str, repo: str, webhook: bool = False, revert: bool = False, commit_hash: str = "",
+                        rollback_of: Optional[str] = None) -> str:
+    return await run(scheduler.enqueue, owner, repo, webhook=webhook, revert=revert, commit_hash=commit_hash, rollback_of=rollback_of)
+
+# webhooks
+
+async def receive_webhook(inbox, delivery_id: str, event: str, body: bytes) -> bool:
+    return await run(inbox.receive, delivery_id, event, body)
+
+# garbage collection
+
+async def list_gc_runs(janitor, limit: int = 10) -> List[Dict]:
+    return await run(janitor.runs, limit)
+
+# kubernetes
+
+async def render_manifests(engine, compose_file_path: str, project_name: str) -> List[Dict]:
+    return await run(engine.render, compose_file_path, project_name)
+
+# vault
+
+async def save_vault_secrets(project_name: str, variables: Dict[str, str], crypt) -> int:
+    return await run(vault.save_secrets, project_name, variables, get_pool(), crypt)
+
+async def list_vault_versions(project_name: str) -> List[Dict]:
+    return await run(vault.list_versions, project_name, get_pool())
+
+async def get_vault_secrets(project_name: str, crypt) -> Dict[str, str]:
+    return await run(helpers.get_vault_secrets, project_name, get_pool(), crypt)
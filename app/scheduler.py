@@ -0,0 +1,209 @@
+import os, time, uuid, sqlite3, threading
+from typing import Callable, Optional, List, Dict
+from helpers import BuildCancelled
+import log
+
+# Global cap on how many deployments may build at the same time
+MAX_CONCURRENT_BUILDS = int(os.getenv("MAX_CONCURRENT_BUILDS", "2"))
+# How often idle workers re-check the queue when nobody wakes them up (seconds)
+QUEUE_POLL_INTERVAL = float(os.getenv("BUILD_QUEUE_POLL_INTERVAL", "2"))
+# Quiet period after the last push before a queued build may start, newer pushes restart the window (seconds)
+BUILD_DEBOUNCE_SECONDS = float(os.getenv("BUILD_DEBOUNCE_SECONDS", "5"))
+# Abort a running build when a newer commit for the same project arrives
+CANCEL_SUPERSEDED_BUILDS = os.getenv("CANCEL_SUPERSEDED_BUILDS", "false").lower() in ("1", "true", "yes")
+
+QUEUE_COLUMNS = ["id", "owner", "repo", "commit_hash", "webhook", "revert", "status", "enqueued_at", "not_before", "started_at", "finished_at",
+                 "rollback_of"]
+
+class BuildScheduler:
+
+    def __init__(self, connection_pool, handler: Callable[[Dict], None], workers: int = MAX_CONCURRENT_BUILDS,
+                 debounce: float = BUILD_DEBOUNCE_SECONDS, cancel_superseded: bool = CANCEL_SUPERSEDED_BUILDS):
+        self.connection_pool = connection_pool
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.debounce = debounce
+        self.cancel_superseded = cancel_superseded
+        self._threads = []
+        self._running: Dict[str, Dict] = {}
+        self._running_lock = threading.Lock()
+        self._wakeup = threading.Condition()
+        self._stopping = threading.Event()
+
+    def enqueue(self, owner: str, repo: str, webhook: bool = False, revert: bool = False, commit_hash: str = "",
+                rollback_of: Optional[str] = None) -> str:
+        now = time.time()
+        # Rollbacks only restart images that already exist, there is nothing to wait for
+        not_before = now if rollback_of else now + self.debounce
+        superseded = []
+
+        with self.connection_pool.get_connection() as conn:
+            # Latest commit wins: a push for a project that is still waiting in line just retargets that build
+            row = None
+            if not revert:
+                row = conn.execute('''SELECT id, commit_hash, webhook FROM build_queue
+                                      WHERE repo = ? AND status = 'queued' AND revert = 0
+                                      ORDER BY enqueued_at LIMIT 1''', (repo,)).fetchone()
+
+            if row and row[1] != commit_hash:
+                job_id = row[0]
+                conn.execute("UPDATE build_queue SET owner = ?, commit_hash = ?, webhook = ?, not_before = ? WHERE id = ?",
+                             (owner, commit_hash, int(webhook), now + self.debounce, job_id))
+                superseded.append((row[1], bool(row[2])))
+            elif row:
+                job_id = row[0]
+            else:
+                job_id = uuid.uuid4().hex
+                conn.execute('''INSERT INTO build_queue (id, owner, repo, commit_hash, webhook, revert, status, enqueued_at, not_before, rollback_of)
+                                VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?)''',
+                             (job_id, owner, repo, commit_hash, int(webhook), int(revert), now, not_before, rollback_of))
+            conn.commit()
+
+        # Keep the history complete even for commits that never got their own build
+        for old_commit, old_webhook in superseded:
+            if old_commit:
+                log.log_build_request(repo, "superseded", old_webhook, old_commit)
+
+        if self.cancel_superseded and not revert:
+            self.cancel_running(repo, commit_hash)
+
+        self.notify()
+        return job_id
+
+    def cancel_running(self, repo: str, commit_hash: str = "") -> bool:
+        with self._running_lock:
+            job = self._running.get(repo)
+        if job is None or (commit_hash and job["commit_hash"] == commit_hash):
+            return False
+
+        print(f"Cancelling build {job['id']} of {repo}, superseded by {commit_hash or 'a newer push'}")
+        job["cancel_event"].set()
+        return True
+
+    def notify(self):
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def start(self):
+        if self._threads:
+            return
+
+        self._stopping.clear()
+        self.recover()
+
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work, name=f"build-worker-{i}", daemon=True)
+            worker.start()
+            self._threads.append(worker)
+
+    def stop(self, timeout: float = 5):
+        self._stopping.set()
+        with self._wakeup:
+            self._wakeup.notify_all()
+        for worker in self._threads:
+            worker.join(timeout)
+        self._threads = []
+
+    def recover(self) -> int:
+        # Anything still marked running was interrupted by a crash or restart, put it back in line
+        try:
+            with self.connection_pool.get_connection() as conn:
+                cur = conn.execute("UPDATE build_queue SET status = 'queued', started_at = NULL WHERE status = 'running'")
+                conn.commit()
+                if cur.rowcount:
+                    print(f"Resuming {cur.rowcount} interrupted build(s)")
+                return cur.rowcount
+        except sqlite3.Error as e:
+            print(f"Error recovering build queue: {e}")
+            return 0
+
+    def get_queue(self, include_finished: bool = False) -> List[Dict]:
+        query = f"SELECT {', '.join(QUEUE_COLUMNS)} FROM build_queue"
+        if not include_finished:
+            query += " WHERE status IN ('queued', 'running')"
+        query += " ORDER BY enqueued_at"
+
+        with self.connection_pool.get_connection() as conn:
+            rows = conn.execute(query).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def queue_depth(self) -> int:
+        with self.connection_pool.get_connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM build_queue WHERE status = 'queued'").fetchone()[0]
+
+    def in_flight(self) -> int:
+        with self._running_lock:
+            return len(self._running)
+
+    def _to_dict(self, row) -> Dict:
+        job = dict(zip(QUEUE_COLUMNS, row))
+        job["webhook"] = bool(job["webhook"])
+        job["revert"] = bool(job["revert"])
+        return job
+
+    def _claim(self) -> Optional[Dict]:
+        with self.connection_pool.get_connection() as conn:
+            while True:
+                # Never hand out two builds of the same project at once, they share one checkout
+                row = conn.execute(f'''SELECT {', '.join(QUEUE_COLUMNS)} FROM build_queue
+                                       WHERE status = 'queued' AND COALESCE(not_before, 0) <= ?
+                                       AND repo NOT IN (SELECT repo FROM build_queue WHERE status = 'running')
+                                       ORDER BY enqueued_at LIMIT 1''', (time.time(),)).fetchone()
+                if row is None:
+                    return None
+
+                # Only one worker can flip a row from queued to running, losers just try the next one
+                started_at = time.time()
+                cur = conn.execute('''UPDATE build_queue SET status = 'running', started_at = ?
+                                      WHERE id = ? AND status = 'queued'
+                                      AND repo NOT IN (SELECT repo FROM build_queue WHERE status = 'running')''',
+                                   (started_at, row[0]))
+                conn.commit()
+                if cur.rowcount == 1:
+                    job = self._to_dict(row)
+                    job["status"] = "running"
+                    job["started_at"] = started_at
+                    return job
+
+    def _finish(self, job_id: str, status: str):
+        with self.connection_pool.get_connection() as conn:
+            conn.execute("UPDATE build_queue SET status = ?, finished_at = ? WHERE id = ?", (status, time.time(), job_id))
+            conn.commit()
+
+    def _work(self):
+        while not self._stopping.is_set():
+            try:
+                job = self._claim()
+            except sqlite3.Error as e:
+                print(f"Error claiming build from queue: {e}")
+                job = None
+
+            if job is None:
+                with self._wakeup:
+                    self._wakeup.wait(QUEUE_POLL_INTERVAL)
+                continue
+
+            job["cancel_event"] = threading.Event()
+            with self._running_lock:
+                self._running[job["repo"]] = job
+
+            status = "finished"
+            try:
+                # Handlers report a deploy that didn't go through by returning False
+                if self.handler(job) is False:
+                    status = "failed"
+            except BuildCancelled:
+                print(f"Build {job['id']} for {job['repo']} was superseded and cancelled")
+                log.log_build_request(job["repo"], "superseded", job["webhook"], job["commit_hash"], job_id=job["id"])
+                status = "cancelled"
+            except Exception as e:
+                print(f"Build {job['id']} for {job['repo']} crashed: {e}")
+                status = "failed"
+            finally:
+                with self._running_lock:
+                    self._running.pop(job["repo"], None)
+
+            try:
+                self._finish(job["id"], status)
+            except sqlite3.Error as e:
+                print(f"Error finishing build {job['id']}: {e}")
@@ -0,0 +1,94 @@
+import os, time, sqlite3
+from contextlib import contextmanager, nullcontext
+from typing import Optional, Dict
+from db import get_pool
+from helpers import BuildCancelled
+import metrics
+
+# sentry: traces and errors go to SENTRY_DSN | none: nothing leaves the host, stage timings are still kept in job_stages
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "sentry").lower()
+SENTRY_DSN = os.getenv("SENTRY_DSN", "https://4f856c3765722c946a61baf82463fd8a@o4503956234764288.ingest.sentry.io/4506832041017344")
+# Share of requests and deploy jobs traced (0 to 1), errors are always reported
+SENTRY_TRACES_SAMPLE_RATE = float(os.getenv("SENTRY_TRACES_SAMPLE_RATE", "0.1"))
+# Share of traced transactions that are also profiled
+SENTRY_PROFILES_SAMPLE_RATE = float(os.getenv("SENTRY_PROFILES_SAMPLE_RATE", "0"))
+
+INSERT_STAGE = '''INSERT INTO job_stages (job_id, project_name, stage, started_at, finished_at, duration, status)
+                  VALUES (?, ?, ?, ?, ?, ?, ?)'''
+
+# Only imported once Sentry is initialised, the SDK is a large share of the app's import time
+sentry_sdk = None
+
+def init_sentry() -> bool:
+    global sentry_sdk
+    if TRACING_EXPORTER != "sentry" or not SENTRY_DSN:
+        return False
+    if sentry_sdk is None:
+        import sentry_sdk as sdk
+        sdk.init(dsn=SENTRY_DSN, traces_sample_rate=SENTRY_TRACES_SAMPLE_RATE, profiles_sample_rate=SENTRY_PROFILES_SAMPLE_RATE)
+        sentry_sdk = sdk
+    return True
+
+@contextmanager
+def job(project_name: str, job_id: str, op: str = "deploy"):
+    # One transaction per deploy job, the stages inside it become its spans
+    started = time.monotonic()
+    with sentry_sdk.start_transaction(op=op, name=project_name) if sentry_sdk else nullcontext() as transaction:
+        if transaction is not None:
+            transaction.set_tag("job_id", job_id)
+        try:
+            yield
+        finally:
+            metrics.DEPLOY_STAGE_SECONDS.observe(time.monotonic() - started, project=project_name, stage="total")
+
+@contextmanager
+def stage(project_name: str, stage_name: str, job_id: Optional[str] = None):
+    started_at, started = time.time(), time.monotonic()
+    status = "success"
+    with sentry_sdk.start_span(op="deploy.stage", name=stage_name) if sentry_sdk else nullcontext():
+        try:
+            yield
+        except BuildCancelled:
+            status = "cancelled"
+            raise
+        except BaseException:
+            status = "failure"
+            raise
+        finally:
+            duration = time.monotonic() - started
+            metrics.DEPLOY_STAGE_SECONDS.observe(duration, project=project_name, stage=stage_name)
+            if job_id:
+                # Handed to the shared writer without waiting, a deploy never blocks on its own bookkeeping
+                get_pool().write([(INSERT_STAGE, (job_id, project_name, stage_name, started_at, started_at + duration, duration, status))], wait=False)
+
+def get_timeline(job_id: str) -> Optional[Dict]:
+    pool = get_pool()
+    # Stage rows are written in the background, make sure the ones already submitted are visible
+    pool.flush()
+    try:
+        with pool.get_connection() as conn:
+            job = conn.execute("SELECT repo, status, enqueued_at, started_at, finished_at FROM build_queue WHERE id = ?", (job_id,)).fetchone()
+            rows = conn.execute("SELECT stage, started_at, finished_at, duration, status FROM job_stages WHERE job_id = ? ORDER BY started_at, id",
+                                (job_id,)).fetchall()
+    except sqlite3.Error as e:
+        print(f"Error reading timeline of {job_id}: {e}")
+        return None
+    if job is None and not rows:
+        return None
+
+    project_name, status, enqueued_at, started_at, finished_at = job or (None, None, None, None, None)
+    origin = started_at or (rows[0][1] if rows else None)
+    return {
+        "job_id": job_id,
+        "project_name": project_name,
+        "status": status,
+        "enqueued_at": enqueued_at,
+        "started_at": started_at,
+        "finished_at": finished_at,
+        "queued_for": started_at - enqueued_at if started_at and enqueued_at else None,
+        "duration": finished_at - started_at if finished_at and started_at else None,
+        # offset is seconds since the job started, so the stages can be laid out as a waterfall
+        "stages": [{"stage": stage_name, "started_at": stage_started, "finished_at": stage_finished, "duration": duration,
+                    "offset": stage_started - origin, "status": stage_status}
+                   for stage_name, stage_started, stage_finished, duration, stage_status in rows],
+    }
@@ -1,8 +1,14 @@
-import pytest
+import pytest, os, time, threading, json, struct, socketserver
+from http.server import BaseHTTPRequestHandler
 from fastapi.testclient import TestClient
-from main import app
+from main import app, connection_pool
+from db import ConnectionPool
+from scheduler import BuildScheduler
+import asyncio
+import helpers, dockr, docker_api, container_state, buildlogs, repository
 
 client = TestClient(app)
+helpers.first_time_database_init(connection_pool)
 
 owner = "miladhzzzz"
 repo = "Power-DNS"
@@ -13,6 +19,54 @@ def test_set_vault_secrets():
     assert response.status_code == 200
     assert response.json() == {"message": "Environment variables set successfully"}
 
+def test_vault_cache_is_invalidated_on_write(scratch_pool, monkeypatch):
+    import main, vault
+    monkeypatch.setattr(repository, "get_pool", lambda: scratch_pool)
+    vault.invalidate()
+
+    assert client.post("/vault/cached", json={"TOKEN": "one"}).status_code == 200
+    assert helpers.get_vault_secrets("cached", scratch_pool, main.crypt) == {"TOKEN": "one"}
+
+    # reads come from memory until the next write drops them
+    with scratch_pool.get_connection() as conn:
+        conn.execute("DELETE FROM project_environment_variables")
+    assert helpers.get_vault_secrets("cached", scratch_pool, main.crypt) == {"TOKEN": "one"}
+
+    assert client.post("/vault/cached", json={"TOKEN": "two"}).status_code == 200
+    assert helpers.get_vault_secrets("cached", scratch_pool, main.crypt) == {"TOKEN": "two"}
+
+def test_vault_cache_sees_writes_from_other_workers(scratch_pool, monkeypatch):
+    import main, vault
+    class OtherWorkerPool(ConnectionPool):
+        DB_FILE = scratch_pool.DB_FILE
+    other_pool = OtherWorkerPool(max_connections=2)
+    vault.invalidate()
+
+    vault.save_secrets("rotated", {"TOKEN": "old"}, scratch_pool, main.crypt)
+    assert vault.get_current("rotated", scratch_pool, main.crypt) == (1, {"TOKEN": "old"})
+
+    # the other worker's write can't reach this worker's cache
+    monkeypatch.setattr(vault, "invalidate", lambda project_name=None: None)
+    vault.save_secrets("rotated", {"TOKEN": "new"}, other_pool, main.crypt)
+    assert vault.get_current("rotated", scratch_pool, main.crypt) == (2, {"TOKEN": "new"})
+
+def test_vault_writes_are_bulk_and_versioned(scratch_pool, monkeypatch):
+    import main, vault
+    monkeypatch.setattr(repository, "get_pool", lambda: scratch_pool)
+    vault.invalidate()
+
+    first = client.post("/vault/versioned", json={"A": "1", "B": "2"})
+    second = client.post("/vault/versioned", json={"B": "3"})
+    assert (first.headers["X-Vault-Version"], second.headers["X-Vault-Version"]) == ("1", "2")
+    assert client.post("/vault/versioned", json=["A"]).status_code == 422
+
+    # one row per variable however often it is written, every version keeps its full set
+    with scratch_pool.get_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM project_environment_variables WHERE project_name = 'versioned'").fetchone()[0] == 2
+    assert vault.get_current("versioned", scratch_pool, main.crypt) == (2, {"A": "1", "B": "3"})
+    assert vault.get_version("versioned", 1, scratch_pool, main.crypt) == {"A": "1", "B": "2"}
+    assert [v["version"] for v in client.get("/vault/versioned/versions").json()["versions"]] == [2, 1]
+
 def test_deploy_project():
     response = client.get(f"/deploy/{owner}/{repo}")
     assert response.status_code == 200
@@ -23,6 +77,17 @@ def test_get_projects():
     assert response.status_code == 200
     assert response.json() is not None
 
+def test_repository_runs_off_the_event_loop():
+    async def main():
+        loop_thread = threading.current_thread().name
+        worker_thread = await repository.run(lambda: threading.current_thread().name)
+        projects = await repository.list_projects()
+        return loop_thread, worker_thread, projects
+
+    loop_thread, worker_thread, projects = asyncio.run(main())
+    assert worker_thread.startswith("db") and worker_thread != loop_thread
+    assert isinstance(projects, list)
+
 def test_get_projects_status():
     response = client.get(f"/status/{repo}")
     assert response.status_code == 200
@@ -33,11 +98,478 @@ def test_get_jobs():
     assert response.status_code == 200
     assert response.json() is not None
 
+def test_get_jobs_paginated(scratch_pool, monkeypatch):
+    import log
+    monkeypatch.setattr(log, "connection_pool", scratch_pool)
+    for i in range(5):
+        log.log_build_request("paged", "success" if i % 2 else "failure", bool(i % 2), f"commit-{i}")
+
+    first = client.get("/jobs", params={"project": "paged", "limit": 2, "summary": True})
+    assert first.status_code == 200
+    assert [job["commit_hash"] for job in first.json()] == ["commit-4", "commit-3"]
+
+    second = client.get("/jobs", params={"project": "paged", "limit": 2, "summary": True, "cursor": first.headers["X-Next-Cursor"]})
+    assert [job["commit_hash"] for job in second.json()] == ["commit-2", "commit-1"]
+    # the project's totals come from its jobs, whatever page they are on
+    assert (second.json()[0]["success_count"], second.json()[0]["failure_count"]) == ("2", "3")
+
+    failures = client.get("/jobs", params={"project": "paged", "status": "failure", "trigger": "manual", "summary": True})
+    assert [job["commit_hash"] for job in failures.json()] == ["commit-4", "commit-2", "commit-0"]
+
+    assert client.get("/jobs", params={"cursor": "not-a-cursor"}).status_code == 400
+
+def test_build_status_serves_only_the_current_job(scratch_pool, monkeypatch, tmp_path):
+    import log
+    monkeypatch.setattr(log, "connection_pool", scratch_pool)
+    monkeypatch.setattr(log, "LOGS_DIR", str(tmp_path))
+    scheduler = BuildScheduler(scratch_pool, lambda job: None, debounce=0)
+    job_ids = []
+
+    for build in ("old", "new"):
+        job_id = scheduler.enqueue("owner", "segmented")
+        scheduler._claim()
+        with open(log.start_job_log("segmented", job_id, build), "a") as f:
+            f.write("".join(f"{build} line {i}\n" for i in range(3)))
+        log.log_build_request("segmented", "success", False, build, job_id=job_id)
+        scheduler._finish(job_id, "finished")
+        job_ids.append(job_id)
+
+    status = client.get("/status/segmented").json()
+    assert status["status"] == "success"
+    assert "old" not in status["output"] and status["output"].endswith("new line 2\n")
+
+    assert client.get("/status/segmented", params={"tail": 1}).json()["output"] == "new line 2\n"
+    first = client.get("/status/segmented", params={"offset": 0, "limit": 10}).json()
+    second = client.get("/status/segmented", params={"offset": first["next_offset"], "limit": 10}).json()
+    assert len(first["output"]) == 10 and second["offset"] == 10
+    assert (first["output"] + second["output"]).startswith("==== job ")
+
+    followed = client.get("/status/segmented", params={"follow": True, "offset": 0})
+    assert followed.text.startswith("==== job ") and followed.text.endswith("new line 2\n")
+
+    # finished logs get compressed and are still served transparently
+    buildlogs.finish_job_log("segmented", job_ids[0], str(tmp_path))
+    assert (tmp_path / "segmented" / f"{job_ids[0]}.log.gz").exists()
+    old = client.get("/status/segmented", params={"job_id": job_ids[0], "tail": 2}).json()
+    assert old["output"] == "old line 1\nold line 2\n"
+
+def test_build_log_retention(tmp_path, monkeypatch):
+    monkeypatch.setattr(buildlogs, "LOG_RETENTION_COUNT", 2)
+    project_dir = tmp_path / "retained"
+    project_dir.mkdir()
+    for i in range(4):
+        path = project_dir / f"job{i}.log"
+        path.write_text("x")
+        os.utime(path, (time.time() - 10 + i, time.time() - 10 + i))
+
+    buildlogs.apply_retention("retained", keep=["job0.log"], logs_dir=str(tmp_path))
+    assert sorted(os.listdir(project_dir)) == ["job0.log", "job3.log"]
+
 def test_revert_changes():
     response = client.get(f"/revert/{owner}/{repo}")
     assert response.status_code == 200
     assert f"Reverted changes for project {repo}. Rebuilding..." in response.json()["message"]
 
+def test_rollback_steps_back_through_released_images(scratch_pool, monkeypatch):
+    import log
+    monkeypatch.setattr(log, "connection_pool", scratch_pool)
+    for commit in ["a" * 40, "b" * 40, "c" * 40]:
+        log.log_build_request("shop", "success", True, commit, job_id=f"job-{commit[0]}", images={"shop": f"shop:{commit[:12]}"})
+        time.sleep(0.01)
+
+    target = log.rollback_target("shop")
+    assert (target["job_id"], target["images"]) == ("job-b", {"shop": "shop:bbbbbbbbbbbb"})
+
+    # a rollback is queued without the debounce and a second revert steps back from what it restored
+    scheduler = BuildScheduler(scratch_pool, lambda job: None)
+    job_id = scheduler.enqueue("owner", "shop", revert=True, commit_hash=target["commit_hash"], rollback_of=target["job_id"])
+    queued = scheduler.get_queue()[0]
+    assert queued["rollback_of"] == "job-b" and queued["not_before"] == queued["enqueued_at"]
+    log.log_build_request("shop", "success", False, target["commit_hash"], job_id=job_id, images=target["images"])
+    assert log.rollback_target("shop")["job_id"] == "job-a"
+    assert log.get_release("shop", "job-c")["commit_hash"] == "c" * 40
+    assert log.get_release("shop", "missing") is None
+
+def test_revert_without_a_release_reports_what_is_missing(scratch_pool, monkeypatch):
+    import log, gitcache
+    monkeypatch.setattr(log, "connection_pool", scratch_pool)
+    response = client.get("/revert/owner/never-deployed")
+    assert response.status_code == 404 and "deployed" in response.json()["detail"]
+
+    log.log_build_request("no-history", "success", False, "d" * 40)
+    monkeypatch.setattr(gitcache, "parent_commit", lambda owner, repo, commit: None)
+    response = client.get("/revert/owner/no-history")
+    assert response.status_code == 409 and "dddddddddddd" in response.json()["detail"]
+
+def test_build_context_hash_and_cache_result(tmp_path, scratch_pool, monkeypatch):
+    import buildcache, log
+    context = tmp_path / "context"
+    (context / "node_modules").mkdir(parents=True)
+    (context / "Dockerfile").write_text("FROM scratch\n")
+    (context / ".dockerignore").write_text("node_modules\n*.log\n")
+    first = buildcache.context_hash(str(context))
+
+    # ignored files don't count, anything docker would send does
+    (context / "node_modules" / "dep.js").write_text("x")
+    (context / "debug.log").write_text("x")
+    assert buildcache.context_hash(str(context)) == first
+    (context / "app.py").write_text("print()")
+    assert buildcache.context_hash(str(context)) != first
+
+    output = tmp_path / "build.log"
+    output.write_bytes(b"old output\n#5 [1/2] FROM base\n#5 CACHED\n#6 [2/2] RUN make\n#6 0.1 building\n")
+    assert buildcache.cache_result(str(output), len(b"old output\n")) == "partial"
+    assert buildcache.cache_result(str(output), output.stat().st_size) is None
+
+    monkeypatch.setattr(log, "connection_pool", scratch_pool)
+    with scratch_pool.get_connection() as conn:
+        conn.execute("INSERT INTO build_queue (id, repo, status, enqueued_at) VALUES ('built', 'api', 'running', 1)")
+    log.record_build_cache("built", first, "miss")
+    log.log_build_request("api", "success", False, "f" * 40, job_id="built", images={"api": "api:ffffffffffff"})
+    assert log.find_release_by_context("api", first)["images"] == {"api": "api:ffffffffffff"}
+    assert log.get_jobs(summary=True, project="api")[0][0]["build_cache"] == "miss"
+
+def test_metrics_endpoint():
+    import metrics
+    metrics.DEPLOY_STAGE_SECONDS.observe(42, project="metrics-demo", stage="build")
+    helpers.run_cancellable(["true"])
+
+    response = client.get("/metrics")
+    assert response.status_code == 200 and response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert 'prod_auto_deploy_stage_duration_seconds_bucket{project="metrics-demo",stage="build",le="60"} 1' in body
+    assert 'prod_auto_deploy_stage_duration_seconds_bucket{project="metrics-demo",stage="build",le="30"} 0' in body
+    assert "prod_auto_build_queue_depth " in body and "prod_auto_builds_in_flight 0" in body
+    assert 'prod_auto_subprocess_spawns_total{command="true"}' in body
+    assert 'prod_auto_db_query_duration_seconds_count{kind="query"}' in body
+
+def test_job_timeline(scratch_pool, monkeypatch):
+    import tracing
+    monkeypatch.setattr(tracing, "get_pool", lambda: scratch_pool)
+    with scratch_pool.get_connection() as conn:
+        conn.execute("INSERT INTO build_queue (id, repo, status, enqueued_at, started_at) VALUES ('traced', 'api', 'running', 1, 3)")
+
+    with tracing.job("api", "traced"):
+        with tracing.stage("api", "fetch", "traced"):
+            pass
+        with pytest.raises(RuntimeError), tracing.stage("api", "build", "traced"):
+            raise RuntimeError("broken Dockerfile")
+
+    response = client.get("/jobs/traced/timeline")
+    assert response.status_code == 200
+    timeline = response.json()
+    assert timeline["project_name"] == "api" and timeline["queued_for"] == 2
+    assert [(s["stage"], s["status"]) for s in timeline["stages"]] == [("fetch", "success"), ("build", "failure")]
+    assert all(s["duration"] >= 0 and s["finished_at"] >= s["started_at"] for s in timeline["stages"])
+    assert client.get("/jobs/unknown/timeline").status_code == 404
+
+def test_webhook_is_verified_stored_once_and_dispatched(scratch_pool, monkeypatch):
+    import main, hmac, hashlib
+    from inbox import WebhookInbox
+    queued = []
+    inbox = WebhookInbox(scratch_pool, lambda event, payload: queued.append((event, payload["after"])) or "job-1")
+    monkeypatch.setattr(main, "inbox", inbox)
+    monkeypatch.setattr(helpers, "GITHUB_WEBHOOK_SECRET", "s3cret")
+
+    body = json.dumps({"after": "c" * 40, "repository": {"name": "api", "owner": {"login": "me"}}}).encode()
+    signature = "sha256=" + hmac.new(b"s3cret", body, hashlib.sha256).hexdigest()
+    headers = {"X-GitHub-Event": "push", "X-GitHub-Delivery": "delivery-1", "X-Hub-Signature-256": signature}
+
+    assert client.post("/webhook", content=body, headers={**headers, "X-Hub-Signature-256": "sha256=forged"}).status_code == 401
+    first = client.post("/webhook", content=body, headers=headers)
+    assert first.status_code == 202 and first.json()["delivery_id"] == "delivery-1"
+    # GitHub's retry of the same delivery is acknowledged but not stored again
+    retry = client.post("/webhook", content=body, headers=headers)
+    assert retry.status_code == 202 and retry.json()["message"] == "Delivery already received"
+    assert queued == [] and inbox.pending() == 1
+
+    assert inbox.drain() == 1
+    assert queued == [("push", "c" * 40)]
+    with scratch_pool.get_connection() as conn:
+        assert conn.execute("SELECT status, job_id FROM webhook_inbox WHERE delivery_id = 'delivery-1'").fetchone() == ("processed", "job-1")
+
+def test_get_build_queue():
+    response = client.get("/queue")
+    assert response.status_code == 200
+    assert isinstance(response.json(), list)
+
+@pytest.fixture
+def scratch_pool(tmp_path):
+    class ScratchPool(ConnectionPool):
+        DB_FILE = str(tmp_path / "builds.db")
+
+    pool = ScratchPool(max_connections=4)
+    helpers.first_time_database_init(pool)
+    return pool
+
+def test_connection_pool_is_tuned_and_transactional(scratch_pool):
+    with scratch_pool.get_connection() as conn:
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+    with pytest.raises(RuntimeError):
+        with scratch_pool.get_connection() as conn:
+            conn.execute("INSERT INTO projects (name) VALUES ('rolled-back')")
+            raise RuntimeError("boom")
+
+    # concurrent writers all land, batched by the single writer thread
+    writers = [threading.Thread(target=scratch_pool.write, args=([("INSERT INTO projects (name) VALUES (?)", (f"p{i}",))],))
+               for i in range(20)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    assert scratch_pool.write([("INSERT INTO projects (name) VALUES (?)", ("p0",))]) is False
+
+    with scratch_pool.get_connection() as conn:
+        names = {row[0] for row in conn.execute("SELECT name FROM projects")}
+    assert "rolled-back" not in names and {f"p{i}" for i in range(20)} <= names
+
+def test_scheduler_caps_concurrency_and_resumes(scratch_pool):
+    running, peak, lock = [], [], threading.Lock()
+
+    def handler(job):
+        with lock:
+            running.append(job["id"])
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(job["id"])
+
+    scheduler = BuildScheduler(scratch_pool, handler, workers=2, debounce=0)
+    ids = [scheduler.enqueue("owner", f"repo-{i}") for i in range(6)]
+
+    # pretend the previous process died halfway through a build
+    with scratch_pool.get_connection() as conn:
+        conn.execute("UPDATE build_queue SET status = 'running' WHERE id = ?", (ids[0],))
+        conn.commit()
+
+    scheduler.start()
+    deadline = time.time() + 5
+    while scheduler.get_queue() and time.time() < deadline:
+        time.sleep(0.05)
+    scheduler.stop()
+
+    finished = [job["id"] for job in scheduler.get_queue(include_finished=True) if job["status"] == "finished"]
+    assert sorted(finished) == sorted(ids)
+    assert max(peak) <= 2
+
+def test_failed_deploys_are_failed_in_the_queue(scratch_pool, monkeypatch):
+    import main, log, vault, gitcache
+    from cryptography.fernet import InvalidToken
+    logged, finished = [], []
+    monkeypatch.setattr(log, "log_build_request", lambda project_name, status, *args, **kwargs: logged.append(status))
+    monkeypatch.setattr(gitcache, "finish_worktree", lambda repo, job_id, deployed: finished.append(deployed))
+    def unreadable(*args):
+        raise InvalidToken()
+    monkeypatch.setattr(vault, "get_current", unreadable)
+
+    # a vault that can't be read fails the job like any other deploy error, its worktree is still cleaned up
+    job = {"id": "vault-job", "owner": "owner", "repo": "locked", "webhook": False, "revert": False, "commit_hash": "abc"}
+    assert main.run_deployment(job) is False
+    assert logged == ["failure"] and finished == [False]
+
+    scheduler = BuildScheduler(scratch_pool, lambda job: False, workers=1, debounce=0)
+    job_id = scheduler.enqueue("owner", "repo")
+    scheduler.start()
+    deadline = time.time() + 5
+    while scheduler.get_queue() and time.time() < deadline:
+        time.sleep(0.05)
+    scheduler.stop()
+    assert [job["status"] for job in scheduler.get_queue(include_finished=True) if job["id"] == job_id] == ["failed"]
+
+def test_scheduler_coalesces_pushes_per_project(scratch_pool):
+    scheduler = BuildScheduler(scratch_pool, lambda job: None, workers=1, debounce=60)
+    first = scheduler.enqueue("owner", "repo", webhook=True, commit_hash="aaa")
+    second = scheduler.enqueue("owner", "repo", webhook=True, commit_hash="bbb")
+    other = scheduler.enqueue("owner", "other-repo", webhook=True, commit_hash="ccc")
+
+    queue = scheduler.get_queue()
+    assert first == second != other
+    assert [job["commit_hash"] for job in queue] == ["bbb", "ccc"]
+
+def test_cancellable_command_is_killed():
+    cancel_event = threading.Event()
+    threading.Timer(0.2, cancel_event.set).start()
+    started = time.time()
+    with pytest.raises(helpers.BuildCancelled):
+        helpers.run_cancellable(["sleep", "30"], cancel_event, poll_interval=0.05)
+    assert time.time() - started < 5
+
+    # piped output is drained while polling and handed back like subprocess.run does, even past the pipe buffer
+    result = helpers.run_cancellable(["python", "-c", "print('x' * 200000)"], threading.Event(), capture_output=True, text=True, poll_interval=0.05)
+    assert result.returncode == 0 and len(result.stdout.strip()) == 200000
+    with pytest.raises(dockr.subprocess.CalledProcessError) as failed:
+        helpers.run_cancellable(["sh", "-c", "echo oops >&2; exit 3"], threading.Event(), check=True, stderr=dockr.subprocess.PIPE, text=True)
+    assert failed.value.stderr.strip() == "oops"
+
+def test_project_secrets_stay_out_of_the_process_environment(tmp_path, monkeypatch):
+    envs = []
+    def run(command, cancel_event=None, **kwargs):
+        if command[0] == "docker-compose":
+            envs.append(kwargs.get("env"))
+        return dockr.subprocess.CompletedProcess(command, 0, "")
+    monkeypatch.setattr(dockr.subprocess, "run", run)
+    monkeypatch.setattr(dockr, "run_cancellable", run)
+    monkeypatch.setattr(dockr.buildcache, "FAST_BUILDS", False)
+    monkeypatch.setattr(dockr, "tag_release_images", lambda *args, **kwargs: {})
+    monkeypatch.setattr(dockr, "docker_push_images", lambda *args, **kwargs: None)
+    monkeypatch.setattr(dockr.logs, "log_build_request", lambda *args, **kwargs: None)
+
+    dockr.deploy_docker_compose("secret-project", str(tmp_path / "docker-compose.yml"), str(tmp_path / "build.log"), False, "abc",
+                                env=helpers.project_env({"SECRET_PROJECT_TOKEN": "s3cr3t"}))
+    assert "SECRET_PROJECT_TOKEN" not in os.environ
+    assert envs and all(env["SECRET_PROJECT_TOKEN"] == "s3cr3t" for env in envs)
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    containers = {"power-dns-web-1": "running", "power-dns-db-1": "exited", "unrelated": "running"}
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type="application/json", status=200):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/_ping":
+            return self.reply(b"OK", "text/plain")
+        if path == "/containers/json":
+            return self.reply([{"Id": name, "Names": [f"/{name}"]} for name in self.containers])
+        name = path.split("/")[2]
+        if name not in self.containers:
+            return self.reply({"message": "No such container"}, status=404)
+        if path.endswith("/logs"):
+            lines = [(1, b"hello\n"), (2, b"oops\n")]
+            if "timestamps=1" in self.path:
+                # web and db log in turns, a merged stream has to interleave them
+                first = 0 if "web" in name else 1
+                lines = [(stream, f"2024-01-01T00:00:0{first + 2 * i}.000000000Z ".encode() + text) for i, (stream, text) in enumerate(lines)]
+            frames = b"".join(struct.pack(">BxxxI", stream, len(text)) + text for stream, text in lines)
+            return self.reply(frames, "application/vnd.docker.raw-stream")
+        self.reply({"Id": name, "Name": f"/{name}", "State": {"Status": self.containers[name], "StartedAt": "start", "FinishedAt": "end"}})
+
+@pytest.fixture
+def fake_docker(tmp_path, monkeypatch):
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    socket_path = str(tmp_path / "docker.sock")
+    server = Server(socket_path, FakeDockerHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    fake_client = docker_api.DockerClient(socket_path)
+    monkeypatch.setattr(dockr, "docker", fake_client)
+    yield server
+    server.shutdown()
+    fake_client.close()
+
+def test_project_containers_through_docker_api(fake_docker):
+    containers = dockr.get_project_containers("Power-DNS")
+    assert sorted((c["container_name"], c["status"]) for c in containers) == [("power-dns-db-1", "exited"), ("power-dns-web-1", "running")]
+    assert dockr.get_container_logs("power-dns-web-1") == {"power-dns-web-1": "hello\noops\n"}
+
+def test_container_logs_are_streamed_in_time_order(fake_docker):
+    response = client.get("/containers/power-dns/logs", params={"tail": "10"})
+    assert response.status_code == 200
+    assert [line.split(" ", 3)[::3] for line in response.text.splitlines()] == [
+        ["power-dns-web-1", "hello"], ["power-dns-db-1", "hello"], ["power-dns-web-1", "oops"], ["power-dns-db-1", "oops"]]
+    assert client.get("/containers/power-dns/logs", params={"tail": "lots"}).status_code == 400
+    assert client.get("/containers/nothing-here/logs").status_code == 404
+
+def test_container_state_cache_follows_events(fake_docker):
+    cache = container_state.ContainerStateCache(dockr.docker)
+    cache.prime()
+    assert [c["container_name"] for c in cache.project_containers("power-dns")] == ["power-dns-db-1", "power-dns-web-1"]
+
+    cache.apply_event({"Type": "container", "Action": "destroy", "id": "power-dns-db-1"})
+    cache.apply_event({"Type": "container", "Action": "exec_start: sh", "id": "power-dns-web-1"})
+    assert [c["container_name"] for c in cache.project_containers("power-dns")] == ["power-dns-web-1"]
+    assert cache.container_names("power-dns") == ["power-dns-web-1"]
+
+def test_push_only_changed_images_in_parallel(monkeypatch):
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def push(image, registry_url):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.05)
+        with lock:
+            active[0] -= 1
+        return 100
+
+    monkeypatch.setattr(dockr, "REGISTRY_PUSH_PARALLELISM", 2)
+    monkeypatch.setattr(dockr, "_local_image_id", lambda image: f"sha256:{image}")
+    monkeypatch.setattr(dockr, "_registry_config_digest", lambda image, registry_url: "sha256:base:1" if image == "base:1" else None)
+    monkeypatch.setattr(dockr, "_push_image", push)
+
+    result = dockr.docker_push_images(["web", "web:abc", "worker", "base:1", "web"])
+    assert sorted(result["pushed"]) == ["web", "web:abc", "worker"] and result["skipped"] == ["base:1"]
+    assert result["bytes"] == 300 and peak[0] == 2
+    assert dockr._pushed_bytes([{"id": "l1", "status": "Pushing", "progressDetail": {"current": 5, "total": 50}},
+                                {"id": "l1", "status": "Pushed"}, {"id": "l2", "status": "Layer already exists"}]) == 50
+
+def test_blue_green_waits_for_health(monkeypatch):
+    states = iter([{"Running": True, "Health": {"Status": "starting"}}, {"Running": True, "Health": {"Status": "healthy"}}])
+    monkeypatch.setattr(dockr, "HEALTH_CHECK_INTERVAL", 0.01)
+    monkeypatch.setattr(dockr, "_inspect_container", lambda name: {"State": next(states)})
+    assert dockr.wait_until_healthy("shop-1234", 8080) == (True, "healthy")
+
+    # a crashing container or one that never answers keeps the old version in place
+    monkeypatch.setattr(dockr, "_inspect_container", lambda name: {"State": {"Running": False, "ExitCode": 1}})
+    assert dockr.wait_until_healthy("shop-1234", 8080) == (False, "exited with code 1")
+    monkeypatch.setattr(dockr, "HEALTH_CHECK_TIMEOUT", 0.05)
+    monkeypatch.setattr(dockr, "_inspect_container", lambda name: {"State": {"Running": True}, "NetworkSettings": {"Networks": {}}})
+    assert dockr.wait_until_healthy("shop-1234", 8080)[0] is False
+
+    labels = dockr.traefik_labels("Shop", 8080)
+    assert labels["traefik.http.routers.shop.rule"] == "PathPrefix(`/shop`)"
+    assert labels["traefik.http.services.shop.loadbalancer.server.port"] == "8080"
+
+def test_blue_green_rollback_keeps_serving_until_the_release_is_healthy(tmp_path, monkeypatch):
+    calls, results = [], []
+    monkeypatch.setattr(dockr, "DEPLOY_STRATEGY", "bluegreen")
+    monkeypatch.setattr(dockr, "compose_file", lambda project_name: str(tmp_path / "missing.yml"))
+    monkeypatch.setattr(dockr, "restore_images", lambda images, log: None)
+    monkeypatch.setattr(dockr, "_image_ports", lambda image: [8080])
+    monkeypatch.setattr(dockr, "run_cancellable", lambda command, cancel_event=None, **kwargs: calls.append(("run", command[command.index("--name") + 1])))
+    monkeypatch.setattr(dockr.subprocess, "run", lambda command, **kwargs: calls.append(tuple(command[1:3])))
+    monkeypatch.setattr(dockr, "_remove_container", lambda name: calls.append(("remove", name)))
+    monkeypatch.setattr(dockr, "stop_and_remove_container", lambda name: calls.append(("stop", name)))
+    monkeypatch.setattr(dockr.logs, "log_build_request", lambda project_name, status, *args, **kwargs: results.append(status))
+
+    # the release does not come up, the running container is left alone
+    monkeypatch.setattr(dockr, "wait_until_healthy", lambda name, port, cancel_event=None: (False, "exited with code 1"))
+    assert dockr.rollback("shop", {"shop": "shop:abc"}, str(tmp_path / "build.log"), False, "abc", job_id="12345678-job") is False
+    assert ("stop", "shop") not in calls and ("remove", "shop-12345678") in calls and results == ["failure"]
+
+    calls.clear()
+    monkeypatch.setattr(dockr, "wait_until_healthy", lambda name, port, cancel_event=None: (True, "healthy"))
+    assert dockr.rollback("shop", {"shop": "shop:abc"}, str(tmp_path / "build.log"), False, "abc", job_id="12345678-job") is True
+    assert calls[-2:] == [("stop", "shop"), ("rename", "shop-12345678")] and results[-1] == "success"
+
+def test_compose_rollback_uses_the_released_compose_file(tmp_path, monkeypatch):
+    commands = []
+    release_dir, current_dir = tmp_path / "release", tmp_path / "current"
+    for checkout in (release_dir, current_dir):
+        checkout.mkdir()
+        (checkout / "docker-compose.yml").write_text("services: {}\n")
+    monkeypatch.setattr(dockr, "compose_file", lambda project_name: str(current_dir / "docker-compose.yml"))
+    monkeypatch.setattr(dockr, "restore_images", lambda images, log: None)
+    monkeypatch.setattr(dockr, "run_cancellable", lambda command, cancel_event=None, **kwargs: commands.append(command))
+    monkeypatch.setattr(dockr.logs, "log_build_request", lambda *args, **kwargs: None)
+
+    assert dockr.rollback("shop", {"web": "web:abc"}, str(tmp_path / "build.log"), False, "abc", project_dir=str(release_dir))
+    assert commands[-1][commands[-1].index("-f") + 1] == str(release_dir / "docker-compose.yml")
+
 # >>>>>>!!!! IF YOU WANT TO test THE CONTAINER MANAGEMENT MAKE SURE YOU HAVE ALL THE COMPONENTS UP AND RUNNING!!!!!<<<<<
 
 # @pytest.mark.parametrize("action", ["log", "restart", "stop"])
@@ -52,3 +584,231 @@ def test_revert_changes():
 #         assert "Containers logs:" in response.json()["message"]
 #     else:
 #         assert "use approporiate Actions" in response.json()["message"]
+
+def test_git_mirror_checks_out_pinned_commits(tmp_path, monkeypatch):
+    import gitcache, subprocess
+    monkeypatch.setattr(gitcache, "GIT_MIRROR_DIR", str(tmp_path / "mirrors"))
+    monkeypatch.setattr(gitcache, "GIT_WORKTREE_DIR", str(tmp_path / "worktrees"))
+    monkeypatch.setattr(gitcache, "GIT_WORKTREE_KEEP", 2)
+
+    source = tmp_path / "source"
+    git = lambda *args: subprocess.run(["git", "-C", str(source), "-c", "user.name=t", "-c", "user.email=t@t", *args],
+                                       check=True, capture_output=True, text=True).stdout.strip()
+    source.mkdir()
+    git("init", "-q")
+    commits = []
+    for n in range(3):
+        (source / "VERSION").write_text(str(n))
+        git("add", "VERSION")
+        git("commit", "-q", "-m", str(n))
+        commits.append(git("rev-parse", "HEAD"))
+
+    gitcache.ensure_mirror("owner", "demo")
+    gitcache._git("demo", "remote", "set-url", "origin", f"file://{source}")
+
+    # an older commit is fetched on its own, shallow, and checked out exactly
+    assert gitcache.fetch("owner", "demo", commits[1]) == commits[1]
+    path = gitcache.add_worktree("demo", "job1", commits[1])
+    assert open(os.path.join(path, "VERSION")).read() == "1"
+    assert gitcache.parent_commit("owner", "demo", commits[1]) == commits[0]
+
+    assert gitcache.fetch("owner", "demo") == commits[2]
+    for n, job_id in enumerate(["job2", "job3", "job4"]):
+        gitcache.add_worktree("demo", job_id, commits[2])
+        os.utime(os.path.join(gitcache.worktree_root("demo"), job_id), (time.time() + n, time.time() + n))
+    gitcache.finish_worktree("demo", "job2", deployed=True)
+    gitcache.finish_worktree("demo", "job4", deployed=False)
+
+    # the deployed worktree stays current, only the newest other one is kept
+    assert gitcache.current_checkout("demo").endswith("job2")
+    assert sorted(os.listdir(gitcache.worktree_root("demo"))) == ["current", "job2", "job4"]
+
+def test_relative_bind_mounts_outlive_the_worktree(tmp_path, monkeypatch):
+    import gitcache, shutil, yaml
+    monkeypatch.setattr(gitcache, "PROJECT_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.chdir(tmp_path)
+    # an older version wrote the uploads into its projects/<repo> clone
+    (tmp_path / "projects" / "demo" / "uploads").mkdir(parents=True)
+    (tmp_path / "projects" / "demo" / "uploads" / "avatar.png").write_text("png")
+    compose = {"services": {"db": {"volumes": ["./pgdata:/var/lib/postgresql/data", "./conf/db.conf:/etc/db.conf:ro", "named:/cache",
+                                               "../outside:/outside", {"type": "bind", "source": "./uploads", "target": "/uploads"}]}}}
+    for job in ("job1", "job2"):
+        checkout = tmp_path / job
+        (checkout / "conf").mkdir(parents=True)
+        (checkout / "conf" / "db.conf").write_text("tracked")
+        (checkout / "docker-compose.yml").write_text(yaml.dump(compose))
+        dockr.persist_bind_mounts("demo", str(checkout / "docker-compose.yml"))
+
+    # what the first deploy wrote is there for the second, tracked files stay as checked out and nothing escapes the checkout
+    (tmp_path / "job1" / "pgdata" / "PG_VERSION").write_text("16")
+    assert (tmp_path / "job2" / "pgdata" / "PG_VERSION").read_text() == "16"
+    assert os.path.islink(tmp_path / "job2" / "uploads") and not os.path.islink(tmp_path / "job2" / "conf" / "db.conf")
+    assert not (tmp_path / "outside").exists() and not (tmp_path / "job1" / "named").exists()
+    assert (tmp_path / "job2" / "uploads" / "avatar.png").read_text() == "png"
+    assert not (tmp_path / "projects" / "demo" / "uploads").exists()
+
+    # pruning a worktree removes the link, not the data
+    shutil.rmtree(tmp_path / "job1")
+    assert (tmp_path / "data" / "demo" / "pgdata" / "PG_VERSION").exists()
+
+def test_manifests_render_in_one_stream_and_only_when_changed(tmp_path):
+    import k8s, yaml
+    compose = tmp_path / "docker-compose.yml"
+    compose.write_text(yaml.dump({"services": {"web_app": {"image": "web:1", "ports": ["8080:80"]}, "worker": {"image": "worker:1"}}}))
+    engine = k8s.ManifestGen()
+
+    documents = list(yaml.safe_load_all(engine.generate_kubernetes_manifests(str(compose), "demo")))
+    assert [(d["kind"], d["metadata"]["name"]) for d in documents] == [("Deployment", "web-app"), ("Service", "web-app"), ("Deployment", "worker")]
+    assert documents[1]["spec"]["ports"][0]["targetPort"] == 80
+
+    # nothing changed, nothing to apply
+    assert engine.generate_kubernetes_manifests(str(compose), "demo") == ""
+
+    compose.write_text(yaml.dump({"services": {"web_app": {"image": "web:1", "ports": ["8080:80"]}, "worker": {"image": "worker:2"}}}))
+    changed = engine.changed(engine.render_many({"demo": str(compose), "other": {"services": {"api": {"image": "api"}}}}))
+    assert [(m["project"], m["service"]) for m in changed] == [("demo", "worker"), ("other", "api")]
+    assert engine.to_objects(changed)[0]["spec"]["template"]["spec"]["containers"][0]["image"] == "worker:2"
+
+class FakeKubeOMaticHandler(BaseHTTPRequestHandler):
+    # Local stand-in for kube-o-matic: answers the health probe, records uploads and can fail a few requests first
+    protocol_version = "HTTP/1.1"
+    received = []
+    failures = 0
+    missing = ()
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status=200, body=b"ok"):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.received.append(("GET", self.path, b""))
+        self.reply()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if FakeKubeOMaticHandler.failures:
+            FakeKubeOMaticHandler.failures -= 1
+            return self.reply(503, b"busy")
+        if self.path in FakeKubeOMaticHandler.missing:
+            return self.reply(404, b"not found")
+        self.received.append(("POST", self.path, body))
+        self.reply()
+
+@pytest.fixture
+def kube_o_matic(monkeypatch):
+    from http.server import ThreadingHTTPServer
+    import kubeomatic
+    FakeKubeOMaticHandler.received, FakeKubeOMaticHandler.failures, FakeKubeOMaticHandler.missing = [], 0, ()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeKubeOMaticHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(kubeomatic, "client", kubeomatic.KubeOMaticClient(f"http://127.0.0.1:{server.server_address[1]}", backoff=0.01))
+    yield FakeKubeOMaticHandler
+    server.shutdown()
+
+def test_kubeconfig_goes_through_the_pooled_cd_client(kube_o_matic, monkeypatch):
+    import kubeomatic
+    kubeconfig = b"apiVersion: v1\nkind: Config\nclusters: []\nusers: []\ncontexts: []\n"
+    assert client.post("/kubeconfig", files={"file": ("config", b"nope")}).status_code == 422
+
+    # a 503 is retried, the health probe is only made once
+    kube_o_matic.failures = 1
+    for _ in range(2):
+        assert client.post("/kubeconfig", files={"file": ("config", kubeconfig)}).status_code == 200
+    assert [(method, path) for method, path, _ in kube_o_matic.received] == [("GET", "/"), ("POST", "/upload"), ("POST", "/upload")]
+    assert kubeconfig in kube_o_matic.received[1][2]
+
+    monkeypatch.setattr(kubeomatic, "client", kubeomatic.KubeOMaticClient("http://127.0.0.1:9", retries=0, timeout=1))
+    assert client.post("/kubeconfig", files={"file": ("config", kubeconfig)}).status_code == 503
+
+def test_manifests_are_forwarded_in_bulk_once(kube_o_matic, monkeypatch, tmp_path):
+    import gitcache, kubeomatic, yaml
+    (tmp_path / "docker-compose.yml").write_text(yaml.dump({"services": {"web": {"image": "web:1", "ports": ["80"]}}}))
+    monkeypatch.setattr(gitcache, "current_checkout", lambda project: str(tmp_path))
+
+    # off by default, released kube-o-matic has no manifests endpoint
+    assert client.post("/kubernetes/bulk-demo/manifests").status_code == 501
+    assert not kube_o_matic.received
+    monkeypatch.setattr(kubeomatic, "KUBE_O_MATIC_MANIFESTS", True)
+
+    assert client.post("/kubernetes/bulk-demo/manifests").json()["applied"] == 2
+    assert client.post("/kubernetes/bulk-demo/manifests").json()["applied"] == 0
+    assert client.post("/kubernetes/bulk-demo/manifests", params={"full": True}).json()["applied"] == 2
+
+    uploads = [body for method, path, body in kube_o_matic.received if path == "/manifests"]
+    assert len(uploads) == 2
+    assert [d["kind"] for d in yaml.safe_load_all(uploads[0])] == ["Deployment", "Service"]
+
+    # a kube-o-matic without the endpoint is reported as such, not as a failing server
+    kube_o_matic.missing = ("/manifests",)
+    response = client.post("/kubernetes/bulk-demo/manifests", params={"full": True})
+    assert response.status_code == 501 and "POST /manifests" in response.json()["detail"]
+
+def test_only_one_worker_leads(tmp_path):
+    from leader import LeaderElection
+    events = []
+    path = str(tmp_path / "leader.lock")
+    first = LeaderElection(lambda: events.append("first"), lambda: events.append("first resigned"), path=path, retry_interval=0.05)
+    second = LeaderElection(lambda: events.append("second"), lambda: events.append("second resigned"), path=path, retry_interval=0.05)
+
+    first.start()
+    second.start()
+    assert first.is_leader and not second.is_leader
+
+    first.stop()
+    deadline = time.monotonic() + 5
+    while not second.is_leader and time.monotonic() < deadline:
+        time.sleep(0.01)
+    second.stop()
+    assert events == ["first", "first resigned", "second", "second resigned"]
+
+def test_janitor_keeps_recent_releases_and_reports_what_it_frees(scratch_pool, tmp_path, monkeypatch):
+    import log, janitor, gitcache
+    monkeypatch.setattr(log, "connection_pool", scratch_pool)
+    monkeypatch.setattr(gitcache, "GIT_WORKTREE_DIR", str(tmp_path / "projects" / ".worktrees"))
+    # never talk to the host's docker daemon, only the file system parts run for real
+    for step in ("_containers", "_images", "_dangling_images", "_build_cache"):
+        monkeypatch.setattr(janitor.Janitor, step, lambda self, section, dry_run, *args: None)
+    for commit in ["a" * 40, "b" * 40, "c" * 40]:
+        log.log_build_request("shop", "success", True, commit, job_id=f"job-{commit[0]}", images={"shop": f"shop:{commit[:12]}"})
+
+    collector = janitor.Janitor(scratch_pool, str(tmp_path / "logs"), str(tmp_path / "projects"))
+    assert collector.release_tags(keep=2) == ({"shop:bbbbbbbbbbbb", "shop:cccccccccccc"}, {"shop:aaaaaaaaaaaa"})
+
+    # logs past the budget of a project that hasn't built since, and checkouts from before worktrees, one still mounted
+    monkeypatch.setattr(buildlogs, "LOG_RETENTION_COUNT", 1)
+    project_dir = tmp_path / "logs" / "shop"
+    project_dir.mkdir(parents=True)
+    for i in range(3):
+        (project_dir / f"job{i}.log").write_text("x" * 10000)
+        os.utime(project_dir / f"job{i}.log", (time.time() - 10 + i, time.time() - 10 + i))
+    for name in ("shop", "db"):
+        (tmp_path / "projects" / name / "data").mkdir(parents=True)
+        (tmp_path / "projects" / ".worktrees" / name / "job-c").mkdir(parents=True)
+        os.symlink("job-c", tmp_path / "projects" / ".worktrees" / name / "current")
+    monkeypatch.setattr(janitor.Janitor, "_mount_sources", lambda self: [str(tmp_path / "projects" / "db" / "data")])
+
+    # checkouts are only listed unless removing them is turned on
+    kept = collector.collect(dry_run=False)
+    assert kept["sections"]["checkouts"]["removed"] == []
+    assert [s["path"] for s in kept["sections"]["checkouts"]["skipped"]] == [str(tmp_path / "projects" / "db"), str(tmp_path / "projects" / "shop")]
+    assert len(os.listdir(project_dir)) == 1
+    for i in range(2):
+        (project_dir / f"job{i}.log").write_text("x" * 10000)
+        os.utime(project_dir / f"job{i}.log", (time.time() - 10 + i, time.time() - 10 + i))
+
+    monkeypatch.setattr(janitor, "GC_REMOVE_CHECKOUTS", True)
+    dry = collector.collect(dry_run=True)
+    assert len(dry["sections"]["logs"]["removed"]) == 2 and dry["sections"]["logs"]["bytes"] > 0
+    assert dry["sections"]["checkouts"]["removed"] == [str(tmp_path / "projects" / "shop")]
+    assert len(os.listdir(project_dir)) == 3 and (tmp_path / "projects" / "shop").exists()
+
+    report = collector.collect(dry_run=False)
+    assert os.listdir(project_dir) == ["job2.log"] and not (tmp_path / "projects" / "shop").exists()
+    assert (tmp_path / "projects" / "db" / "data").exists()
+    assert report["sections"]["logs"]["bytes"] == dry["sections"]["logs"]["bytes"]
+    assert [run["dry_run"] for run in collector.runs()] == [False, True, False]
@@ -0,0 +1,156 @@
+import os, time, json, sqlite3
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional, Dict, List, Tuple
+from cryptography.fernet import InvalidToken
+
+# Decrypted secrets are kept per project for this long (seconds), a newer version written by any worker is picked up on the next read
+VAULT_CACHE_TTL = float(os.getenv("VAULT_CACHE_TTL", "300"))
+# Least recently used projects are evicted past this many entries
+VAULT_CACHE_SIZE = int(os.getenv("VAULT_CACHE_SIZE", "128"))
+
+# What reading a project's secrets can fail with: the database, an unreadable key file or a key the stored tokens weren't sealed with
+READ_ERRORS = (sqlite3.Error, OSError, InvalidToken, ValueError)
+
+class SecretCache:
+
+    def __init__(self, ttl: float = VAULT_CACHE_TTL, max_entries: int = VAULT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    # Keys are a project name for its current secrets or (project name, version) for a pinned set
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, project_name: Optional[str] = None):
+        with self._lock:
+            if project_name is None:
+                self._entries.clear()
+            else:
+                # Pinned (project, version) entries never change, only the current view of the project goes stale
+                self._entries.pop(project_name, None)
+
+cache = SecretCache()
+
+UPSERT_VARIABLE = '''INSERT INTO project_environment_variables (project_name, variable_name, variable_value) VALUES (?, ?, ?)
+                     ON CONFLICT (project_name, variable_name) DO UPDATE SET variable_value = excluded.variable_value'''
+
+def seal(secrets: Dict[str, str], crypt) -> bytes:
+    # A whole secret set is stored as a single token, restoring it costs one decrypt
+    return crypt.en(json.dumps(secrets, sort_keys=True))
+
+def unseal(token: bytes, crypt) -> Dict[str, str]:
+    return json.loads(crypt.de(token))
+
+def load_secrets(project_name: str, connection_pool, crypt) -> Tuple[Optional[int], Dict[str, str]]:
+    with connection_pool.get_connection() as conn:
+        row = conn.execute("SELECT version, secrets FROM vault_versions WHERE project_name = ? ORDER BY version DESC LIMIT 1",
+                           (project_name,)).fetchone()
+        if row:
+            return row[0], unseal(row[1], crypt)
+
+        # Projects whose secrets predate versioning only have the per-variable rows
+        rows = conn.execute(
+            "SELECT variable_name, variable_value FROM project_environment_variables WHERE project_name = ?",
+            (project_name,)
+        ).fetchall()
+    return None, {variable_name: crypt.de(encrypted_value) for variable_name, encrypted_value in rows}
+
+def latest_version(project_name: str, connection_pool) -> Optional[int]:
+    with connection_pool.get_connection() as conn:
+        return conn.execute("SELECT MAX(version) FROM vault_versions WHERE project_name = ?", (project_name,)).fetchone()[0]
+
+def get_current(project_name: str, connection_pool, crypt) -> Tuple[Optional[int], Dict[str, str]]:
+    entry = cache.get(project_name)
+    if entry is not None:
+        # A write on another worker only dropped that worker's cache, a cheap version check decides whether ours is still current
+        try:
+            if latest_version(project_name, connection_pool) == entry[0]:
+                return entry[0], dict(entry[1])
+        except sqlite3.Error as e:
+            print(f"Error checking vault version of {project_name}: {e}")
+
+    try:
+        version, secrets = load_secrets(project_name, connection_pool, crypt)
+    except sqlite3.Error as e:
+        # Don't remember a failed read, the next deploy should try again
+        print(f"Error retrieving environment variables: {e}")
+        return None, {}
+
+    cache.put(project_name, (version, secrets))
+    return version, dict(secrets)
+
+def get_secrets(project_name: str, connection_pool, crypt) -> Dict[str, str]:
+    return get_current(project_name, connection_pool, crypt)[1]
+
+def get_version(project_name: str, version: int, connection_pool, crypt) -> Optional[Dict[str, str]]:
+    key = (project_name, version)
+    secrets = cache.get(key)
+    if secrets is not None:
+        return dict(secrets)
+
+    with connection_pool.get_connection() as conn:
+        row = conn.execute("SELECT secrets FROM vault_versions WHERE project_name = ? AND version = ?", (project_name, version)).fetchone()
+    if row is None:
+        return None
+
+    secrets = unseal(row[0], crypt)
+    cache.put(key, secrets)
+    return dict(secrets)
+
+def list_versions(project_name: str, connection_pool) -> List[Dict]:
+    with connection_pool.get_connection() as conn:
+        rows = conn.execute("SELECT version, created_at, variable_count FROM vault_versions WHERE project_name = ? ORDER BY version DESC",
+                            (project_name,)).fetchall()
+    return [{"version": version, "created_at": created_at, "variables": count} for version, created_at, count in rows]
+
+def save_secrets(project_name: str, variables: Dict[str, str], connection_pool, crypt) -> int:
+    # Encrypt everything before taking the write lock, then land rows and the new version in one transaction
+    encrypted = [(project_name, key, crypt.en(value)) for key, value in variables.items()]
+
+    try:
+        with connection_pool.get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT version, secrets FROM vault_versions WHERE project_name = ? ORDER BY version DESC LIMIT 1",
+                               (project_name,)).fetchone()
+            if row:
+                version, secrets = row[0] + 1, unseal(row[1], crypt)
+            else:
+                version = 1
+                secrets = {name: crypt.de(value) for name, value in conn.execute(
+                    "SELECT variable_name, variable_value FROM project_environment_variables WHERE project_name = ?", (project_name,))}
+
+            conn.executemany(UPSERT_VARIABLE, encrypted)
+
+            secrets.update(variables)
+            conn.execute("INSERT INTO vault_versions (project_name, version, created_at, variable_count, secrets) VALUES (?, ?, ?, ?, ?)",
+                         (project_name, version, time.time(), len(secrets), seal(secrets, crypt)))
+    finally:
+        # Even a failed write may have changed some rows, never serve the old values again
+        invalidate(project_name)
+
+    return version
+
+def invalidate(project_name: Optional[str] = None):
+    cache.invalidate(project_name)